@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from config import SEARCH_BATCH_SIZE, SEARCH_BATCH_WAIT_MS
+from logger import LOGGER
+
+
+class MicroBatcher(object):
+    """
+    Queue concurrent requests and run them as one batch, a batch is flushed when it
+    reaches max_batch_size or the first request has waited max_wait_ms.
+    Each caller gets its own result back through a future.
+    """
+
+    def __init__(self, batch_fn: callable,
+                 max_batch_size: int = SEARCH_BATCH_SIZE,
+                 max_wait_ms: float = SEARCH_BATCH_WAIT_MS):
+        """
+        :param batch_fn: takes a list of requests, returns a list of results in the same order
+        :param max_batch_size: max number of requests in one batch
+        :param max_wait_ms: max wait in milliseconds to fill a batch
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request) -> Future:
+        """
+        Queue a request
+        :param request: request passed to batch_fn
+        :return: future of the result
+        """
+        future = Future()
+        self.queue.put((request, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            closed = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if closed:
+                return
+
+    def _flush(self, batch: list):
+        requests = [request for request, _ in batch]
+        LOGGER.debug(f"Flush batch of {len(requests)} requests")
+        try:
+            results = self.batch_fn(requests)
+        except Exception as e:
+            LOGGER.error(f"Batch of {len(requests)} requests failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        if results is None or len(results) != len(batch):
+            e = ValueError(f"Batch of {len(requests)} requests got {'no' if results is None else len(results)} results")
+            LOGGER.error(str(e))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+def primary_features_batch_fn(model) -> callable:
+    """
+    Batch function of primary feature extraction
+    :param model: ImageFeatureModel or InferencePool
+    :return: batch function, requests are (url, content, key)
+    """
+
+    def wrapper(requests: list[(str, bytes, str)]) -> list:
+        urls = [url for url, _, _ in requests]
+        contents = [content for _, content, _ in requests]
+        keys = [key for _, _, key in requests]
+        return model.extract_primary_features_batch(urls, keys=keys, contents=contents)
+
+    return wrapper
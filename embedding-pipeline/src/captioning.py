@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from towhee import ops
+
+from checkpoint import Checkpoint
+from config import (
+    CAPTION_BATCH_SIZE,
+    CAPTION_FIELD,
+    DECODE_MIN_SIZE,
+    ES_INDEX,
+    MINIO_PROXY_ENDPOINT,
+)
+from embedding import list_object_names, image_key
+from es_helpers import EsClient, bulk_update_field_ops
+from logger import LOGGER
+from model import ImageCaptioning, decode_image
+
+
+def do_es_captioning(
+        bucket_name: str,
+        model: ImageCaptioning,
+        es_cli: EsClient,
+        index_name: str = ES_INDEX,
+        field: str = CAPTION_FIELD,
+        batch_size: int = CAPTION_BATCH_SIZE,
+        max_count: int = 0,
+        resume: bool = True) -> int:
+    """
+    Caption the images of the bucket and write the captions to their es documents.
+    Images are downloaded while the previous batch is captioned, each batch is written
+    with one bulk update, and only the images whose document was updated are recorded in
+    the checkpoint, so a restarted job skips them and retries the failed ones.
+    :param bucket_name: bucket name
+    :param model: captioning model
+    :param es_cli: es client
+    :param index_name: index of the image documents, document ids are the image keys
+    :param field: document field of the captions
+    :param batch_size: images in one caption batch
+    :param max_count: max number of images, 0 means all
+    :param resume: skip the images finished by the last run, start over otherwise
+    :return: number of documents updated
+    """
+    checkpoint = Checkpoint(f'caption.{index_name}.{bucket_name}')
+    if not resume:
+        checkpoint.reset()
+    object_names = [name for name in list_object_names(bucket_name, max_count) if name not in checkpoint]
+    batches = [object_names[i:i + batch_size] for i in range(0, len(object_names), batch_size)]
+    LOGGER.info(f"Start to caption {len(object_names)} files, {len(checkpoint)} done before")
+
+    decode_op = ops.image_decode.cv2_rgb()
+    update_docs = bulk_update_field_ops(es_cli, index_name, field)
+    success_count = 0
+    processed = 0
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        pending = _fetch_batch(executor, decode_op, bucket_name, batches[0]) if len(batches) > 0 else []
+        for j, batch_names in enumerate(batches):
+            imgs = [future.result() for future in pending]
+            # download the next batch while this one is captioned
+            if j + 1 < len(batches):
+                pending = _fetch_batch(executor, decode_op, bucket_name, batches[j + 1])
+
+            owners = [i for i, img in enumerate(imgs) if img is not None]
+            captions = model.generate_captions([imgs[i] for i in owners])
+            updates = [(image_key(batch_names[i]), caption) for i, caption in zip(owners, captions)
+                       if len(caption) > 0]
+            if len(updates) > 0:
+                updated = set(update_docs(updates))
+                success_count += len(updated)
+                checkpoint.add([name for name in batch_names if image_key(name) in updated])
+            processed += len(batch_names)
+            LOGGER.info(f"Caption files {processed}/{len(object_names)}, updated count: {success_count}")
+
+    return success_count
+
+
+def _fetch_batch(executor: ThreadPoolExecutor, decode_op: callable,
+                 bucket_name: str, object_names: list[str]) -> list[Future]:
+    return [executor.submit(decode_image, decode_op,
+                            f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{name}', DECODE_MIN_SIZE)
+            for name in object_names]
@@ -0,0 +1,53 @@
+import os
+import threading
+
+from config import CHECKPOINT_PATH
+from logger import LOGGER
+
+
+class Checkpoint(object):
+    """
+    Progress of a resumable bucket job, an append-only file with a finished object name per line,
+    a restarted job skips the names in it. add may be called from many threads.
+    """
+
+    def __init__(self, job_name: str, path: str = CHECKPOINT_PATH):
+        """
+        :param job_name: job name, the file name of the checkpoint
+        :param path: directory of the checkpoints
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, f'{job_name}.ckpt')
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.done = set(line.rstrip('\n') for line in f if len(line.strip()) > 0)
+            LOGGER.info(f"Resume from checkpoint {self.path}, {len(self.done)} objects done")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, names: list[str]):
+        """
+        Mark the objects as finished, the names are synced to disk before return
+        :param names: object names
+        """
+        with self.lock:
+            names = [name for name in names if name not in self.done]
+            if len(names) == 0:
+                return
+            with open(self.path, 'a') as f:
+                f.write(''.join(f'{name}\n' for name in names))
+                f.flush()
+                os.fsync(f.fileno())
+            self.done.update(names)
+
+    def reset(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.done = set()
@@ -3,8 +3,42 @@ import os
 ############### Number of log files ###############
 LOGS_NUM = int(os.getenv("logs_num", "0"))
 
+############### Model Configuration ###############
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+MAX_OBJECTS = int(os.getenv("MAX_OBJECTS", "4"))  # objects cropped and embedded per image, 0 means no limit
+OBJECT_RANK = os.getenv("OBJECT_RANK", "score")  # rank objects by score or area
+DECODE_MIN_SIZE = int(os.getenv("DECODE_MIN_SIZE", "0"))  # min side of reduced jpeg decode, 0 means full size
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")  # torch or onnx
+YOLO_MODEL = os.getenv("YOLO_MODEL", "yolov8n.pt")
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "tmp/onnx-models")
+ONNX_QUANTIZE = os.getenv("ONNX_QUANTIZE", "false").lower() == "true"
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))  # 0 means onnxruntime default
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))  # 0 means inference in the http server process
+INFERENCE_WORKER_THREADS = int(os.getenv("INFERENCE_WORKER_THREADS", "1"))  # torch threads of each worker
+INFERENCE_START_TIMEOUT = float(os.getenv("INFERENCE_START_TIMEOUT", "300"))  # seconds for workers to load the model
+INFERENCE_TASK_TIMEOUT = float(os.getenv("INFERENCE_TASK_TIMEOUT", "60"))  # seconds to wait for a task result
+VECTOR_TYPE = os.getenv("VECTOR_TYPE", "float32")  # float32, float16 or int8 compact vectors
+VECTOR_SCALE_PATH = os.getenv("VECTOR_SCALE_PATH", "tmp/vector-scales")  # fitted int8 scale of each model
+TEXT_EMBEDDING_CACHE_SIZE = int(os.getenv("TEXT_EMBEDDING_CACHE_SIZE", "4096"))  # cached text query vectors
+PROJECTION_ENABLED = os.getenv("PROJECTION_ENABLED", "false").lower() == "true"  # pca of the stored vectors
+PROJECTION_PATH = os.getenv("PROJECTION_PATH", "tmp/projections")  # fitted projection matrix of each model
+CAPTION_BATCH_SIZE = int(os.getenv("CAPTION_BATCH_SIZE", "8"))  # images downloaded and written per batch
+CAPTION_FIELD = os.getenv("CAPTION_FIELD", "caption")  # es field of the captions
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "tmp/checkpoints")  # progress of resumable bucket jobs
+
+############### Embedding Cache Configuration ###############
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "false").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "tmp/embedding-cache")
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "1024"))  # entries
+EMBEDDING_CACHE_DISK_SIZE_MB = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE_MB", "512"))
+
 ############### Detectserver Configuration ###############
 HTTP_PORT = os.getenv("HTTP_PORT", "8090")
+SEARCH_BATCH_SIZE = int(os.getenv("SEARCH_BATCH_SIZE", "8"))  # max /search requests in one batch, 1 means no batching
+SEARCH_BATCH_WAIT_MS = float(os.getenv("SEARCH_BATCH_WAIT_MS", "5"))  # max wait to fill a batch
+SEARCH_IMAGE_CACHE_SIZE = int(os.getenv("SEARCH_IMAGE_CACHE_SIZE", "128"))  # decoded search images for /search/box
+SEARCH_IMAGE_CACHE_TTL = float(os.getenv("SEARCH_IMAGE_CACHE_TTL", "300"))  # seconds
+TEXT_SEARCH_ENABLED = os.getenv("TEXT_SEARCH_ENABLED", "false").lower() == "true"  # load clip for /search/text
 
 ############### Minio Configuration ###############
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "localhost:9000")
@@ -24,6 +58,7 @@ METRIC_TYPE = os.getenv("METRIC_TYPE", "IP")
 NLIST = int(os.getenv("NLIST", "8192"))
 DEFAULT_TABLE = os.getenv("DEFAULT_TABLE", "milvus_imgsch_tab")
 TOP_K = int(os.getenv("TOP_K", "10"))
+MILVUS_INSERT_BATCH = int(os.getenv("MILVUS_INSERT_BATCH", "1000"))  # vectors of one milvus insert and its mysql rows
 
 ############### MySQL Configuration ###############
 MYSQL_HOST = os.getenv("MYSQL_HOST", "127.0.0.1")
@@ -31,6 +66,7 @@ MYSQL_PORT = int(os.getenv("MYSQL_PORT", "3306"))
 MYSQL_USER = os.getenv("MYSQL_USER", "root")
 MYSQL_PWD = os.getenv("MYSQL_PWD", "helloworld123")
 MYSQL_DB = os.getenv("MYSQL_DB", "imgsch_db")
+MYSQL_LOAD_DATA_ROWS = int(os.getenv("MYSQL_LOAD_DATA_ROWS", "1000"))  # batches this large use load data, 0 never
 
 ############### Data Path ###############
 UPLOAD_PATH = os.getenv("UPLOAD_PATH", "tmp/search-images")
@@ -39,3 +75,22 @@ UPLOAD_PATH = os.getenv("UPLOAD_PATH", "tmp/search-images")
 ES_HOST = os.getenv("ES_HOST", "localhost")
 ES_PORT = int(os.getenv("ES_PORT", "9200"))
 ES_INDEX = os.getenv("ES_INDEX", "imgsch")
+CLIP_ES_INDEX = os.getenv("CLIP_ES_INDEX", "imgsch_clip")
+CLIP_VECTOR_DIMENSION = int(os.getenv("CLIP_VECTOR_DIMENSION", "512"))
+ES_BULK_DOCS = int(os.getenv("ES_BULK_DOCS", "500"))  # flush the bulk writer after this many documents
+ES_BULK_BYTES = int(os.getenv("ES_BULK_BYTES", str(10 * 1024 * 1024)))  # or after this many bytes
+ES_BULK_RETRIES = int(os.getenv("ES_BULK_RETRIES", "3"))  # retries of documents rejected with 429
+
+############### Local Vector Store Configuration ###############
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "tmp/vector-store")  # memory-mapped in-process indexes
+VECTOR_STORE_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float32")  # float32 or float16 vectors on disk
+VECTOR_STORE_NLIST = int(os.getenv("VECTOR_STORE_NLIST", "1024"))
+VECTOR_STORE_NPROBE = int(os.getenv("VECTOR_STORE_NPROBE", "16"))
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"  # exact rerank of es candidates
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "200"))  # es candidates of the first pass
+
+############### Ingestion Configuration ###############
+INGEST_DOWNLOAD_WORKERS = int(os.getenv("INGEST_DOWNLOAD_WORKERS", "8"))  # threads downloading bucket images
+INGEST_WRITE_WORKERS = int(os.getenv("INGEST_WRITE_WORKERS", "2"))  # threads writing to the index
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "64"))  # max downloaded images waiting for the model
+INGEST_DOWNLOAD_TIMEOUT = float(os.getenv("INGEST_DOWNLOAD_TIMEOUT", "30"))  # seconds
@@ -3,13 +3,18 @@ import json
 import requests
 from towhee import pipe
 
-from config import DEFAULT_TABLE, VECTOR_DIMENSION
-from config import ES_INDEX, MINIO_PROXY_ENDPOINT
-from es_helpers import EsClient, insert_img_doc_ops, create_img_index
+from checkpoint import Checkpoint
+from config import DEFAULT_TABLE
+from config import ES_INDEX, CLIP_ES_INDEX, INFERENCE_BACKEND, MINIO_PROXY_ENDPOINT
+from es_helpers import EsClient, EsBulkWriter, insert_img_doc_ops, bulk_img_doc_ops, create_img_index, create_clip_index
+from image_helper import is_md5
+from ingestion import IngestionEngine
+from local_helpers import LocalIndexClient, insert_img_docs_ops as local_insert_img_docs_ops
 from logger import LOGGER
-from milvus_helpers import MilvusClient, insert_milvus_ops
-from model import ImageFeatureModel, extract_features_ops
-from mysql_helpers import MysqlClient, insert_mysql_ops
+from milvus_helpers import MilvusClient, MilvusBatchWriter, insert_milvus_ops
+from model import ImageFeatureModel, ImageText, ObjectFeature, BoundingBox, extract_features_ops
+from vector_codec import vector_json
+from mysql_helpers import MysqlClient, insert_mysql_ops, insert_mysql_batch_ops
 
 
 def do_milvus_embedding(
@@ -18,38 +23,64 @@ def do_milvus_embedding(
         milvus_client: MilvusClient,
         mysql_cli: MysqlClient,
         table_name: str = DEFAULT_TABLE,
-        dim: int = VECTOR_DIMENSION) -> int:
-    collection = milvus_client.create_collection(table_name, dim)
+        dim: int = None,
+        incremental: bool = False) -> int:
+    """
+    Embed the objects of the images of the bucket into Milvus and their boxes into MySQL
+    :param bucket_name: bucket name
+    :param model: model instance
+    :param milvus_client: milvus client
+    :param mysql_cli: mysql client
+    :param table_name: collection and table name
+    :param dim: vector dimension, the dimension of the model by default
+    :param incremental: only embed the images not in the table, the checkpoint or the skip list, otherwise rebuild
+    :return: number of images processed successfully
+    """
+    # the index is built after the bulk load, an index on an empty collection slows every insert
+    new_collection = not (incremental and milvus_client.exist_collection(table_name))
+    milvus_client.create_collection(table_name, model.dim if dim is None else dim, index=False, drop=not incremental)
     LOGGER.info(f"Collection information: {table_name}")
 
-    mysql_cli.create_table(table_name)
+    mysql_cli.create_table(table_name, drop=not incremental)
     LOGGER.info(f"Table information: {table_name}")
 
-    lst_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}'
-    LOGGER.info(f"List url: {lst_url}")
-    response = requests.get(lst_url)
-    LOGGER.debug(f"Response: {response}")
-    response.raise_for_status()  # Raise an exception if the request was unsuccessful
+    # the table keeps the image urls of the inserted objects
+    checkpoint = Checkpoint(f'embed.milvus.{table_name}.{bucket_name}')
+    # images without objects are skipped until the detector config changes
+    skipped = Checkpoint(f'skip.milvus.{table_name}.{bucket_name}.{INFERENCE_BACKEND}.min{model.decode_min_size}')
+    img_urls = [f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{name}' for name in list_object_names(bucket_name)]
+    total = len(img_urls)
+    if incremental:
+        done = mysql_cli.image_keys(table_name)
+        img_urls = [img_url for img_url in img_urls
+                    if img_url not in done and img_url not in checkpoint and img_url not in skipped]
+    else:
+        checkpoint.reset()
+        skipped.reset()
+    LOGGER.info(f"Start to process {len(img_urls)} files, {total - len(img_urls)} already indexed")
 
-    object_names = json.loads(response.content)
-    total = len(object_names)
-    LOGGER.info(f"Start to process {total} files")
-    success_count = 0
-    for i, object_name in enumerate(object_names):
-        LOGGER.info(f"Process file {object_name}, {i + 1}/{total}")
-        img_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{object_name}'
-        try:
-            ok = embedding_milvus_pipe(img_url, model, milvus_client, mysql_cli, table_name)
-            if ok:
-                success_count += 1
-
-            LOGGER.info(f"Process file {object_name} successfully, succ count: {success_count}/{total}")
-        except Exception as e:
-            LOGGER.error(f"Process file {object_name} failed: {e}")
-            continue
+    insert_mysql_rows = mysql_rows_ops(insert_mysql_batch_ops(mysql_cli, table_name))
+
+    def on_flush(ids: list[int], metas: list[(str, str, float, str)]):
+        insert_mysql_rows(ids, metas)
+        checkpoint.add(list(dict.fromkeys(img_url for img_url, _, _, _ in metas)))
+
+    writer = MilvusBatchWriter(milvus_client, table_name, on_flush)
+    # one writer, the mysql connection and the milvus buffer are not thread safe
+    engine = IngestionEngine(
+        lambda urls, contents: model.extract_features_batch(urls, contents=contents),
+        lambda urls, res: insert_milvus_features(urls, res, model, writer, skipped),
+        write_workers=1)
+    try:
+        success_count = engine.run(img_urls)
+    finally:
+        # the buffered vectors are written even if the job fails
+        writer.close(index=new_collection)
+    # the table has all the rows of the finished job
+    checkpoint.reset()
 
-    LOGGER.info(f"Process {success_count} files successfully, total: {total}")
-    LOGGER.info(f"Load {collection.num_entities} entities rows")
+    LOGGER.info(f"Process {success_count} files successfully, total: {len(img_urls)}")
+    LOGGER.info(f"Load {writer.success_count} entities rows, {writer.failed_count} failed")
 
     return success_count
 
@@ -70,6 +101,7 @@ def embedding_milvus_pipe(img_url: str,
 
     LOGGER.debug(f"Process file from url: {img_url}")
     res = p_insert(img_url)
+    milvus_client.load_collection(table_name)
     size = res.size
     print(f'Insert {size} vectors')
     for i in range(size):
@@ -82,40 +114,136 @@ def embedding_milvus_pipe(img_url: str,
     return True
 
 
+def embedding_milvus_batch(img_urls: list[str],
+                           model: ImageFeatureModel,
+                           milvus_client: MilvusClient,
+                           mysql_cli: MysqlClient,
+                           table_name: str = DEFAULT_TABLE) -> int:
+    """
+    Embed a batch of images and insert the object vectors to Milvus and MySQL
+    :param img_urls: image urls
+    :param model: model instance
+    :param milvus_client: milvus client
+    :param mysql_cli: mysql client
+    :param table_name: table name
+    :return: number of images processed successfully
+    """
+    writer = MilvusBatchWriter(milvus_client, table_name, mysql_rows_ops(insert_mysql_batch_ops(mysql_cli, table_name)))
+    success_count = insert_milvus_features(img_urls, model.extract_features_batch(img_urls), model, writer)
+    writer.close()
+    return success_count
+
+
+def insert_milvus_features(img_urls: list[str],
+                           res: list[list[ObjectFeature]],
+                           model: ImageFeatureModel,
+                           writer: MilvusBatchWriter,
+                           skipped: Checkpoint = None) -> int:
+    """
+    Buffer the object vectors of a batch of images in the milvus writer
+    :param img_urls: image urls
+    :param res: object features of each image, None if the image failed to decode
+    :param model: model instance, decodes the vectors
+    :param writer: milvus batch writer
+    :param skipped: skip list of the job, the urls of the images without objects are added
+    :return: number of images with buffered vectors
+    """
+    count = 0
+    empty = []
+    for img_url, obj_feats in zip(img_urls, res):
+        if obj_feats is None:
+            # failed images are retried by the next job
+            LOGGER.info(f"no result of {img_url}")
+            continue
+        if len(obj_feats) == 0:
+            LOGGER.info(f"no object of {img_url}")
+            empty.append(img_url)
+            continue
+        # the objects of an image go in the same batch
+        vectors = [model.codec.decode(obj_feat.features).tolist() for obj_feat in obj_feats]
+        metas = [(img_url, ','.join(str(item) for item in obj_feat.bbox.box),
+                  obj_feat.bbox.score, obj_feat.bbox.label) for obj_feat in obj_feats]
+        writer.add_batch(vectors, metas)
+        count += 1
+    if skipped is not None and len(empty) > 0:
+        skipped.add(empty)
+    return count
+
+
+def mysql_rows_ops(insert_mysql_batch: callable):
+    def wrapper(ids: list[int], metas: list[(str, str, float, str)]):
+        """
+        Insert the rows of the vectors inserted to Milvus in one transaction
+        :param ids: milvus ids
+        :param metas: (image url, box, score, label) of each vector
+        """
+        rows = [(vec_id, img_url, sbox, score, label) for vec_id, (img_url, sbox, score, label) in zip(ids, metas)]
+        count = insert_mysql_batch(rows)
+        # the rows were rolled back, the writer counts the vectors as failed
+        if count == 0 and len(rows) > 0:
+            raise RuntimeError(f"Failed to insert {len(rows)} rows to mysql")
+        if count < len(rows):
+            LOGGER.warning(f"Insert {count}/{len(rows)} rows to mysql, rows of existing boxes are skipped")
+        LOGGER.debug(f"Insert {count}/{len(rows)} rows to mysql")
+
+    return wrapper
+
+
 def do_es_embedding(
         bucket_name: str,
         model: ImageFeatureModel,
         es_cli: EsClient,
         index_name: str = ES_INDEX,
-        max_count: int = 0) -> int:
-    create_img_index(es_cli, index_name)
-
-    lst_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}'
-    LOGGER.info(f"List url: {lst_url}")
-    response = requests.get(lst_url)
-    LOGGER.debug(f"Response: {response}")
-    response.raise_for_status()  # Raise an exception if the request was unsuccessful
-
-    object_names = json.loads(response.content)
-    if 0 < max_count < len(object_names):
-        object_names = object_names[:max_count]
+        max_count: int = 0,
+        rerank_cli: LocalIndexClient = None,
+        incremental: bool = False) -> int:
+    """
+    Embed the primary objects of the images of the bucket into Elasticsearch
+    :param bucket_name: bucket name
+    :param model: model instance
+    :param es_cli: es client
+    :param index_name: index name
+    :param max_count: max number of images, 0 means all
+    :param rerank_cli: local index client, the vectors are stored in it for the rerank too
+    :param incremental: only embed the images not in the index or the checkpoint, otherwise embed all again
+    :return: number of documents inserted successfully
+    """
+    create_img_index(es_cli, index_name, dims=model.dim)
+    # the rerank vectors are kept in the local index of the same name
+    if rerank_cli is not None:
+        rerank_cli.create_index(index_name, model.dim)
 
+    # the checkpoint keeps the flushed ids the index may not have refreshed yet
+    checkpoint = Checkpoint(f'embed.es.{index_name}.{bucket_name}')
+    object_names = list_object_names(bucket_name, max_count)
     total = len(object_names)
-    LOGGER.info(f"Start to process {total} files")
-    success_count = 0
-    for i, object_name in enumerate(object_names):
-        LOGGER.info(f"Process file {object_name}, {i + 1}/{total}")
-        img_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{object_name}'
-        try:
-            ok = embedding_es_pipe(img_url, model, es_cli, index_name)
-            if ok:
-                success_count += 1
-
-            LOGGER.info(f"Process file {object_name} successfully, succ count: {success_count}/{total}")
-        except Exception as e:
-            LOGGER.error(f"Process file {object_name} failed: {e}")
-            continue
+    if incremental:
+        done = es_cli.scan_values(index_name, 'image_key')
+        # the documents without rerank vector are embedded again
+        if rerank_cli is not None:
+            done &= rerank_cli.ids(index_name)
+        object_names = [name for name in object_names
+                        if image_key(name) not in done and image_key(name) not in checkpoint]
+    else:
+        checkpoint.reset()
+    LOGGER.info(f"Start to process {len(object_names)} files, {total - len(object_names)} already indexed")
 
+    # the rerank vectors and the checkpoint only get the documents accepted by each flush
+    writer = EsBulkWriter(es_cli, index_name, on_flush=es_flush_ops(model, checkpoint, index_name, rerank_cli))
+    insert_docs = es_insert_docs_ops(model, es_cli, index_name, writer=writer)
+    engine = IngestionEngine(extract_primary_ops(model),
+                             lambda urls, res: insert_primary_features(urls, res, insert_docs))
+    try:
+        engine.run([f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{name}' for name in object_names])
+    finally:
+        # the buffered documents are written even if the job fails
+        success_count = writer.close()
+        if len(writer.failed) > 0:
+            LOGGER.error(f"Failed to insert {len(writer.failed)} documents: "
+                         f"{[doc['_id'] for doc, _ in writer.failed]}")
+    # the refreshed index has all the documents of the finished job
+    if es_cli.refresh(index_name):
+        checkpoint.reset()
     return success_count
 
 
@@ -125,7 +253,7 @@ def embedding_es_pipe(img_url: str,
                       index_name: str = ES_INDEX) -> bool:
     p_insert = (
         pipe.input('url')
-        .map('url', 'key', lambda x: x.split('/')[-1].split('.')[0])
+        .map('url', 'key', image_key)
         .filter(('key',), ('key',), 'key', lambda x: x is not None and len(x) > 0)
         .map('url', ('sbox', 'label', 'score', 'features'), extract_features_ops(model))
         .filter(('features',), ('features',), 'features', lambda x: x is not None and len(x) > 0)
@@ -143,3 +271,230 @@ def embedding_es_pipe(img_url: str,
         it = res.get()
         LOGGER.info(f'inserted: {it}')
     return True
+
+
+def embedding_es_batch(img_urls: list[str],
+                       model: ImageFeatureModel,
+                       es_cli: EsClient,
+                       index_name: str = ES_INDEX,
+                       rerank_cli: LocalIndexClient = None) -> int:
+    """
+    Embed the primary objects of a batch of images and insert them to Elasticsearch
+    :param img_urls: image urls
+    :param model: model instance
+    :param es_cli: es client
+    :param index_name: index name
+    :param rerank_cli: local index client, the vectors are stored in it for the rerank too
+    :return: number of images inserted successfully
+    """
+    insert_docs = es_insert_docs_ops(model, es_cli, index_name, rerank_cli)
+    return insert_primary_features(img_urls, extract_primary_ops(model)(img_urls), insert_docs)
+
+
+def es_insert_docs_ops(model: ImageFeatureModel,
+                       es_cli: EsClient,
+                       index_name: str = ES_INDEX,
+                       rerank_cli: LocalIndexClient = None,
+                       writer: EsBulkWriter = None):
+    """
+    Insert image documents to Elasticsearch, and to the local index for the rerank if given
+    :param model: model instance
+    :param es_cli: es client
+    :param index_name: index name
+    :param rerank_cli: local index client, the vectors are stored in it for the rerank too
+    :param writer: bulk writer of the index, its on_flush writes the rerank vectors, see es_flush_ops
+    :return: (records) -> number of documents inserted or buffered
+    """
+    insert_es_doc = insert_img_doc_ops(es_cli, index_name) if writer is None else bulk_img_doc_ops(writer)
+    insert_local_docs = None
+    if rerank_cli is not None and writer is None:
+        insert_local_docs = local_insert_img_docs_ops(rerank_cli, index_name, model.codec)
+
+    def wrapper(records: list[tuple]) -> int:
+        inserted = [record for record in records if insert_es_doc(*record)]
+        # the vectors of the batch are appended to the local index at once
+        if insert_local_docs is not None and len(inserted) > 0:
+            insert_local_docs(inserted)
+        return len(inserted)
+
+    return wrapper
+
+
+def es_flush_ops(model: ImageFeatureModel,
+                 checkpoint: Checkpoint,
+                 index_name: str = ES_INDEX,
+                 rerank_cli: LocalIndexClient = None):
+    """
+    Handle the documents accepted by a flush of the es bulk writer
+    :param model: model instance
+    :param checkpoint: checkpoint of the job, the ids of the documents are added
+    :param index_name: index name
+    :param rerank_cli: local index client, the vectors of the documents are stored in it for the rerank
+    :return: (docs) -> None, on_flush of EsBulkWriter
+    """
+
+    def wrapper(docs: list[dict]):
+        # the rerank vectors are written before the checkpoint, so a checkpointed image has both
+        if rerank_cli is not None:
+            count = rerank_cli.insert_batch(index_name, [{
+                '_id': doc['_id'],
+                '_source': dict(doc['_source'], features=model.codec.decode(doc['_source']['features'])),
+            } for doc in docs])
+            if count < len(docs):
+                raise RuntimeError(f"Inserted {count}/{len(docs)} rerank vectors to {index_name}")
+        checkpoint.add([doc['_id'] for doc in docs])
+
+    return wrapper
+
+
+def extract_primary_ops(model: ImageFeatureModel):
+    def wrapper(img_urls: list[str], contents: list[bytes] = None) -> list[(ObjectFeature, list[BoundingBox])]:
+        """
+        Extract primary object features of a batch of bucket images
+        :param img_urls: image urls
+        :param contents: downloaded image bytes of the urls, None means fetch the urls
+        :return: (object feature, candidate bbox list) of each image
+        """
+        # object keys of the bucket are md5 of the contents, reuse the cached embeddings of them
+        cache_keys = [key if is_md5(key) else None for key in (image_key(img_url) for img_url in img_urls)]
+        return model.extract_primary_features_batch(img_urls, keys=cache_keys, contents=contents)
+
+    return wrapper
+
+
+def insert_primary_features(img_urls: list[str],
+                            res: list[(ObjectFeature, list[BoundingBox])],
+                            insert_docs: callable) -> int:
+    """
+    Insert the primary object features of a batch of images with one call
+    :param img_urls: image urls
+    :param res: (object feature, candidate bbox list) of each image
+    :param insert_docs: (records) -> number of documents inserted, records are the arguments of insert_img_doc_ops
+    :return: number of images inserted successfully
+    """
+    records = []
+    for img_url, (obj_feat, _) in zip(img_urls, res):
+        key = image_key(img_url)
+        if len(key) == 0 or obj_feat is None or obj_feat.features is None or len(obj_feat.features) == 0:
+            LOGGER.info(f"no result of {img_url}")
+            continue
+        bbox = obj_feat.bbox
+        sbox = ','.join(str(item) for item in bbox.box)
+        records.append((key, img_url, sbox, bbox.score, bbox.label, obj_feat.features, key))
+    if len(records) == 0:
+        return 0
+    success_count = insert_docs(records)
+    LOGGER.debug(f'inserted {success_count} of {len(records)} documents')
+    return success_count
+
+
+def do_local_embedding(
+        bucket_name: str,
+        model: ImageFeatureModel,
+        local_cli: LocalIndexClient,
+        index_name: str = ES_INDEX,
+        max_count: int = 0,
+        build_index: bool = True) -> int:
+    """
+    Embed the primary objects of the images of the bucket into the in-process local index
+    :param bucket_name: bucket name
+    :param model: model instance
+    :param local_cli: local index client
+    :param index_name: index name
+    :param max_count: max number of images, 0 means all
+    :param build_index: train the IVF index after the insertion
+    :return: number of images inserted successfully
+    """
+    local_cli.create_index(index_name, model.dim)
+    insert_docs = local_insert_img_docs_ops(local_cli, index_name, model.codec)
+
+    object_names = list_object_names(bucket_name, max_count)
+    LOGGER.info(f"Start to process {len(object_names)} files")
+    # one writer, the vectors of each batch are appended at once
+    engine = IngestionEngine(extract_primary_ops(model),
+                             lambda urls, res: insert_primary_features(urls, res, insert_docs), write_workers=1)
+    success_count = engine.run([f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{name}' for name in object_names])
+
+    if build_index and success_count > 0:
+        local_cli.build_index(index_name)
+    return success_count
+
+
+def do_es_clip_embedding(
+        bucket_name: str,
+        model: ImageText,
+        es_cli: EsClient,
+        index_name: str = CLIP_ES_INDEX,
+        max_count: int = 0) -> int:
+    """
+    Embed the images of the bucket with clip and insert them to the clip index for text search
+    :param bucket_name: bucket name
+    :param model: clip image text model
+    :param es_cli: es client
+    :param index_name: clip index name
+    :param max_count: max number of images, 0 means all
+    :return: number of images inserted successfully
+    """
+    create_clip_index(es_cli, index_name)
+    writer = EsBulkWriter(es_cli, index_name)
+
+    object_names = list_object_names(bucket_name, max_count)
+    LOGGER.info(f"Start to process {len(object_names)} files")
+    # the downloaded images are embedded in batches
+    engine = IngestionEngine(lambda urls, contents: model.generate_image_embeddings(contents),
+                             lambda urls, vecs: insert_clip_docs(urls, vecs, writer))
+    try:
+        engine.run([f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{name}' for name in object_names])
+    finally:
+        success_count = writer.close()
+        if len(writer.failed) > 0:
+            LOGGER.error(f"Failed to insert {len(writer.failed)} documents: "
+                         f"{[doc['_id'] for doc, _ in writer.failed]}")
+    return success_count
+
+
+def insert_clip_docs(img_urls: list[str], vecs: list, writer: EsBulkWriter) -> int:
+    """
+    Buffer the clip documents of a batch of images
+    :param img_urls: image urls
+    :param vecs: normalized image vectors, None if the embedding failed
+    :param writer: bulk writer of the clip index
+    :return: number of documents buffered
+    """
+    count = 0
+    for img_url, vec in zip(img_urls, vecs):
+        key = image_key(img_url)
+        if len(key) == 0 or vec is None:
+            LOGGER.info(f"no result of {img_url}")
+            continue
+        writer.add({'_id': key, '_source': {'image_key': key, 'image_url': img_url, 'features': vector_json(vec)}})
+        count += 1
+    return count
+
+
+def list_object_names(bucket_name: str, max_count: int = 0) -> list[str]:
+    """
+    List object names of the bucket from the minio proxy
+    :param bucket_name: bucket name
+    :param max_count: max number of names, 0 means all
+    :return: object names
+    """
+    lst_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}'
+    LOGGER.info(f"List url: {lst_url}")
+    response = requests.get(lst_url)
+    LOGGER.debug(f"Response: {response}")
+    response.raise_for_status()  # Raise an exception if the request was unsuccessful
+
+    object_names = json.loads(response.content)
+    if 0 < max_count < len(object_names):
+        object_names = object_names[:max_count]
+    return object_names
+
+
+def image_key(img_url: str) -> str:
+    """
+    Image key of the url, the object name without suffix
+    :param img_url: image url
+    :return: image key
+    """
+    return img_url.split('/')[-1].split('.')[0]
@@ -0,0 +1,200 @@
+import dbm
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config import (
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MEMORY_SIZE,
+    EMBEDDING_CACHE_DISK_SIZE_MB,
+)
+from logger import LOGGER
+
+
+class EmbeddingCache(object):
+    """
+    Content addressed cache of embeddings, keyed by image md5 and model name, each entry is a
+    normalized vector with a json-able meta dict, e.g. the detected boxes.
+    Two tiers: an in-memory LRU of entries, and a disk tier of a memory-mapped float32 vector
+    file with fixed slots, the oldest slot is overwritten when the size limit is reached.
+    The disk tier has a single owner: the first cache opened on the directory holds an exclusive
+    file lock, caches opened on it by other processes or models only have the memory tier, since
+    the dbm does not support concurrent writers and the slots of a stale index may be reused.
+    """
+
+    def __init__(self, model_name: str,
+                 path: str = EMBEDDING_CACHE_PATH,
+                 memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE,
+                 disk_size_mb: int = EMBEDDING_CACHE_DISK_SIZE_MB):
+        self.model_name = model_name
+        self.memory_size = memory_size
+        self.disk_size = disk_size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.lru = OrderedDict()
+
+        self.cache_dir = os.path.join(path, model_name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.cache_dir, 'vectors.f32')
+        self.lock_file = open(os.path.join(self.cache_dir, 'lock'), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.writable = True
+        except OSError:
+            self.writable = False
+            LOGGER.warning(f"Embedding cache {self.cache_dir} is owned by another cache, memory tier only")
+        self.meta = None
+        self.vectors = None
+        self.capacity = 0
+        if self.writable:
+            self.meta = dbm.open(os.path.join(self.cache_dir, 'meta'), 'c')
+        if self.meta is not None and b'__dim__' in self.meta:
+            self._open_vectors(int(self.meta[b'__dim__']))
+
+    def get(self, md5: str) -> (dict, np.ndarray):
+        """
+        Get cache entry of the image
+        :param md5: md5 of the image content
+        :return: (meta, vector), None if missed
+        """
+        with self.lock:
+            entry = self.lru.get(md5)
+            if entry is not None:
+                self.lru.move_to_end(md5)
+                return entry
+            if self.meta is None or self.vectors is None or md5 not in self.meta:
+                return None
+            record = json.loads(self.meta[md5])
+            entry = (record['meta'], np.array(self.vectors[record['slot']]))
+            self._put_memory(md5, entry)
+            LOGGER.debug(f"Embedding cache disk hit of {md5}, model: {self.model_name}")
+            return entry
+
+    def put(self, md5: str, meta: dict, vector: np.ndarray):
+        """
+        Put cache entry of the image to both tiers, only the memory tier if the disk tier is not owned
+        :param md5: md5 of the image content
+        :param meta: json-able meta of the entry
+        :param vector: normalized vector
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        with self.lock:
+            self._put_memory(md5, (meta, vector))
+            if self.meta is None:
+                return
+            if self.vectors is None:
+                self.meta[b'__dim__'] = str(len(vector))
+                self._open_vectors(len(vector))
+            if self.capacity == 0 or len(vector) != self.vectors.shape[1]:
+                return
+            if md5 in self.meta:
+                slot = json.loads(self.meta[md5])['slot']
+            else:
+                slot = int(self.meta[b'__next__'])
+                self.meta[b'__next__'] = str((slot + 1) % self.capacity)
+                slot_key = f'__slot_{slot}__'
+                if slot_key in self.meta:
+                    # evict the oldest entry of the slot
+                    evicted = self.meta[slot_key]
+                    if evicted in self.meta:
+                        del self.meta[evicted]
+                self.meta[slot_key] = md5
+            self.vectors[slot] = vector
+            self.meta[md5] = json.dumps({'slot': slot, 'meta': meta})
+
+    def flush(self):
+        with self.lock:
+            if isinstance(self.vectors, np.memmap):
+                self.vectors.flush()
+            if hasattr(self.meta, 'sync'):
+                self.meta.sync()
+
+    def close(self):
+        """
+        Flush and close the disk tier, release the owner lock
+        """
+        if self.lock_file is None:
+            return
+        self.flush()
+        with self.lock:
+            if self.meta is not None:
+                self.meta.close()
+                self.meta = None
+            self.vectors = None
+            self.capacity = 0
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _put_memory(self, md5: str, entry: (dict, np.ndarray)):
+        if self.memory_size <= 0:
+            return
+        self.lru[md5] = entry
+        self.lru.move_to_end(md5)
+        while len(self.lru) > self.memory_size:
+            self.lru.popitem(last=False)
+
+    def _open_vectors(self, dim: int):
+        self.capacity = self.disk_size // (dim * 4)
+        if self.capacity == 0:
+            self.vectors = np.zeros((0, dim), dtype=np.float32)
+            return
+        size = self.capacity * dim * 4
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) == size:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(self.capacity, dim))
+            return
+        # new cache or the size limit changed, start over
+        for key in list(self.meta.keys()):
+            if key != b'__dim__':
+                del self.meta[key]
+        self.meta[b'__next__'] = '0'
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='w+', shape=(self.capacity, dim))
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory LRU cache, entries optionally expire after a ttl
+    """
+
+    def __init__(self, max_size: int, ttl: float = 0):
+        """
+        :param max_size: max number of entries, 0 means no cache
+        :param ttl: seconds an entry lives after it is put, 0 means no expiry
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Get the entry and mark it as recently used
+        :param key: entry key
+        :return: entry value, None if missed or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expire_at = entry
+            if expire_at is not None and expire_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        expire_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self.lock:
+            self.entries[key] = (value, expire_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,11 +1,15 @@
+import json
 import sys
+import threading
 
 from elasticsearch import Elasticsearch, helpers
 
 from config import (
-    ES_HOST, ES_PORT, ES_INDEX,
+    ES_HOST, ES_PORT, ES_INDEX, VECTOR_TYPE, VECTOR_DIMENSION, CLIP_ES_INDEX, CLIP_VECTOR_DIMENSION, CAPTION_FIELD,
+    ES_BULK_DOCS, ES_BULK_BYTES, ES_BULK_RETRIES,
 )
 from logger import LOGGER
+from vector_codec import es_element_type, vector_json
 
 
 class EsClient(object):
@@ -76,6 +80,114 @@ class EsClient(object):
             LOGGER.error(f"Failed to insert documents: {e}")
             return 0
 
+    def stream_batch(self, index_name: str, docs: list[dict],
+                     chunk_bytes: int = ES_BULK_BYTES,
+                     max_retries: int = ES_BULK_RETRIES) -> (int, list[(dict, str)]):
+        """
+        Insert batch documents with streaming bulk requests, documents failed to insert are returned
+        :param index_name: index name in Elasticsearch
+        :param docs: documents to insert, in the format of insert_batch
+        :param chunk_bytes: max bytes of one bulk request
+        :param max_retries: retries of documents rejected with 429, with exponential backoff
+        :return: number of documents inserted, (document, error) of the failed documents
+        """
+        success = 0
+        failed = []
+        try:
+            for ok, info in helpers.streaming_bulk(
+                    self.es, docs, index=index_name, chunk_size=len(docs), max_chunk_bytes=chunk_bytes,
+                    max_retries=max_retries, raise_on_error=False, raise_on_exception=False):
+                if ok:
+                    success += 1
+                else:
+                    failed.append(info)
+        except Exception as e:
+            LOGGER.error(f"Failed to stream documents: {e}")
+            return 0, [(doc, str(e)) for doc in docs]
+        if len(failed) == 0:
+            return success, []
+        # failed items are reported with the document id, map them back to the documents
+        docs_by_id = {doc.get('_id'): doc for doc in docs}
+        res = []
+        for info in failed:
+            item = next(iter(info.values()))
+            res.append((docs_by_id.get(item.get('_id'), item.get('data')), str(item.get('error', item))))
+        LOGGER.error(f"Failed to insert {len(res)} documents, first error: {res[0][1]}")
+        return success, res
+
+    def scan_values(self, index_name: str, field: str) -> set[str]:
+        """
+        Values of a field of all documents
+        :param index_name: index name in Elasticsearch
+        :param field: field name, eg: image_key
+        :return: distinct values, empty if the index does not exist
+        """
+        if not self.exist_index(index_name):
+            return set()
+        try:
+            hits = helpers.scan(self.es, index=index_name, query={"_source": [field], "query": {"match_all": {}}})
+            return set(hit['_source'][field] for hit in hits if field in hit['_source'])
+        except Exception as e:
+            LOGGER.error(f"Failed to scan {field} of index {index_name}: {e}")
+            return set()
+
+    def refresh(self, index_name: str) -> bool:
+        """
+        Make the inserted documents searchable, the image index refreshes every 180s by itself
+        :param index_name: index name in Elasticsearch
+        :return:
+        """
+        try:
+            self.es.indices.refresh(index=index_name)
+            return True
+        except Exception as e:
+            LOGGER.error(f"Failed to refresh index {index_name}: {e}")
+            return False
+
+    def msearch(self, index_name: str, bodies: list[dict]) -> list[list[dict]]:
+        """
+        Run many queries in one multi search request
+        :param index_name: index name in Elasticsearch
+        :param bodies: query bodies
+        :return: hits of each query, empty for failed queries
+        """
+        searches = []
+        for body in bodies:
+            searches.append({'index': index_name})
+            searches.append(body)
+        try:
+            res = self.es.msearch(searches=searches)
+        except Exception as e:
+            LOGGER.error(f"Failed to multi search documents: {e}")
+            return [[] for _ in bodies]
+        hits_list = []
+        for response in res['responses']:
+            if 'error' in response:
+                LOGGER.error(f"Failed to query documents: {response['error']}")
+                hits_list.append([])
+                continue
+            hits_list.append(response['hits']['hits'])
+        return hits_list
+
+    def update_batch(self, index_name: str, actions: list[dict]) -> list[str]:
+        """
+        Partial update of batch documents, documents failed to update are logged and skipped
+        :param index_name: index name in Elasticsearch
+        :param actions: update actions, each action is a dict
+            eg: {"_op_type": "update", "_id": 1, "doc": {"caption": "a man rides a bicycle"}},
+        :return: ids of the documents updated
+        """
+        try:
+            _, errors = helpers.bulk(self.es, actions, index=index_name, raise_on_error=False)
+        except Exception as e:
+            LOGGER.error(f"Failed to update documents: {e}")
+            return []
+        if len(errors) == 0:
+            return [action['_id'] for action in actions]
+        LOGGER.error(f"Failed to update {len(errors)} documents, first error: {errors[0]}")
+        failed_ids = set(str(next(iter(error.values())).get('_id')) for error in errors)
+        return [action['_id'] for action in actions if str(action['_id']) not in failed_ids]
+
     def query(self, index_name: str, body: dict) -> list[dict]:
         """
         Query documents
@@ -117,19 +229,135 @@ def insert_img_doc_ops(es_cli: EsClient, index_name: str = ES_INDEX):
     def wrapper(img_key: str, img_url: str,
                 bbox: str, bbox_score: float, label: str,
                 features: list[float], id: str = None) -> bool:
-        doc = {
-            'image_key': img_key,
-            'image_url': img_url,
-            'bbox': bbox,
-            'bbox_score': bbox_score,
-            'label': label,
-            'features': features,
-        }
-        return es_cli.insert_doc(index_name, doc, id)
+        return es_cli.insert_doc(index_name, _img_doc(img_key, img_url, bbox, bbox_score, label, features), id)
 
     return wrapper
 
 
+def bulk_img_doc_ops(writer: 'EsBulkWriter'):
+    """
+    Buffer image document in the bulk writer, same arguments as insert_img_doc_ops
+    :param writer: es bulk writer
+    :param (img_key, img_url, bbox, bbox_score, label, features, id)
+    :return: true once buffered, not inserted yet, the writer counts and reports the documents
+        that Elasticsearch accepts when it flushes them
+    """
+
+    def wrapper(img_key: str, img_url: str,
+                bbox: str, bbox_score: float, label: str,
+                features: list[float], id: str = None) -> bool:
+        writer.add({'_id': id, '_source': _img_doc(img_key, img_url, bbox, bbox_score, label, features)})
+        return True
+
+    return wrapper
+
+
+def _img_doc(img_key: str, img_url: str, bbox: str, bbox_score: float, label: str, features: list[float]) -> dict:
+    return {
+        'image_key': img_key,
+        'image_url': img_url,
+        'bbox': bbox,
+        'bbox_score': bbox_score,
+        'label': label,
+        'features': vector_json(features),
+    }
+
+
+class EsBulkWriter(object):
+    """
+    Buffered bulk writer of an index, documents are flushed with streaming bulk requests
+    when the buffer reaches the document count or byte size, failed documents are kept
+    for retry. add may be called from many threads.
+    """
+
+    def __init__(self, es_cli: EsClient, index_name: str = ES_INDEX,
+                 flush_docs: int = ES_BULK_DOCS, flush_bytes: int = ES_BULK_BYTES,
+                 on_flush: callable = None):
+        """
+        :param es_cli: es client
+        :param index_name: index name
+        :param flush_docs: flush after this many documents
+        :param flush_bytes: flush after this many bytes of json
+        :param on_flush: (docs) -> None, called with the documents inserted by each flush
+        """
+        self.es_cli = es_cli
+        self.index_name = index_name
+        self.flush_docs = max(1, flush_docs)
+        self.flush_bytes = flush_bytes
+        self.lock = threading.Lock()
+        self.docs = []
+        self.size = 0
+        self.success_count = 0
+        self.failed = []
+        self.on_flush = on_flush
+
+    def add(self, doc: dict):
+        """
+        Buffer document, flush the buffer if it is full
+        :param doc: document in the format of EsClient.insert_batch
+        """
+        size = len(json.dumps(doc['_source']))
+        with self.lock:
+            self.docs.append(doc)
+            self.size += size
+            if len(self.docs) < self.flush_docs and self.size < self.flush_bytes:
+                return
+            docs = self._take()
+        self._send(docs)
+
+    def flush(self) -> int:
+        """
+        Write the buffered documents
+        :return: number of documents inserted by this flush
+        """
+        with self.lock:
+            docs = self._take()
+        return self._send(docs)
+
+    def retry_failed(self) -> int:
+        """
+        Write the failed documents again, the documents failing again stay in failed
+        :return: number of documents inserted
+        """
+        with self.lock:
+            docs = [doc for doc, _ in self.failed if doc is not None]
+            self.failed = []
+        return self._send(docs)
+
+    def close(self) -> int:
+        """
+        Flush the buffer and retry the failed documents once
+        :return: number of documents inserted by the writer
+        """
+        self.flush()
+        if len(self.failed) > 0:
+            LOGGER.info(f"Retry {len(self.failed)} failed documents")
+            self.retry_failed()
+        return self.success_count
+
+    def _take(self) -> list[dict]:
+        docs = self.docs
+        self.docs = []
+        self.size = 0
+        return docs
+
+    def _send(self, docs: list[dict]) -> int:
+        if len(docs) == 0:
+            return 0
+        success, failed = self.es_cli.stream_batch(self.index_name, docs, self.flush_bytes)
+        with self.lock:
+            self.success_count += success
+            self.failed.extend(failed)
+        if self.on_flush is not None and success > 0:
+            failed_ids = set(doc.get('_id') for doc, _ in failed if doc is not None)
+            try:
+                self.on_flush([doc for doc in docs if doc.get('_id') not in failed_ids])
+            except Exception as e:
+                LOGGER.error(f"Failed to handle the flush of {self.index_name}: {e}")
+        LOGGER.debug(f"Flush {len(docs)} documents to {self.index_name}, {success} succeeded")
+        return success
+
+
 def bulk_docs_ops(es_cli: EsClient, index_name: str = ES_INDEX):
     def wrapper(docs: list[dict]) -> int:
         """
@@ -142,6 +370,19 @@ def bulk_docs_ops(es_cli: EsClient, index_name: str = ES_INDEX):
     return wrapper
 
 
+def bulk_update_field_ops(es_cli: EsClient, index_name: str = ES_INDEX, field: str = CAPTION_FIELD):
+    def wrapper(updates: list[(str, str)]) -> list[str]:
+        """
+        Update a field of batch documents in Elasticsearch
+        :param updates: (document id, field value) list
+        :return: ids of the documents updated
+        """
+        actions = [{'_op_type': 'update', '_id': id, 'doc': {field: value}} for id, value in updates]
+        return es_cli.update_batch(index_name, actions)
+
+    return wrapper
+
+
 def knn_query_docs_ops(es_cli: EsClient, index_name: str = ES_INDEX):
     def wrapper(vec: list[float], k: int = 10, num_candidates: int = 100) -> list[(str, str, str, float, str, float)]:
         """
@@ -151,10 +392,76 @@ def knn_query_docs_ops(es_cli: EsClient, index_name: str = ES_INDEX):
         :param num_candidates: number of candidates
         :return: list of records: (image_key, image_url, bbox, bbox_score, label, score)
         """
+        knn_query = _knn_body(vec, k, num_candidates)
+        hits = es_cli.query(index_name, knn_query)
+        if len(hits) == 0:
+            LOGGER.debug(f"No hits found for query: {knn_query}")
+            return []
+        return _img_doc_records(hits)
+
+    return wrapper
+
+
+def knn_msearch_docs_ops(es_cli: EsClient, index_name: str = ES_INDEX):
+    def wrapper(vecs: list[list[float]], k: int = 10,
+                num_candidates: int = 100) -> list[list[(str, str, str, float, str, float)]]:
+        """
+        Query documents of many vectors with one multi search request
+        :param vecs: query vectors
+        :param k: k nearest neighbors
+        :param num_candidates: number of candidates
+        :return: list of records of each vector: (image_key, image_url, bbox, bbox_score, label, score)
+        """
+        if len(vecs) == 0:
+            return []
+        hits_list = es_cli.msearch(index_name, [_knn_body(vec, k, num_candidates) for vec in vecs])
+        return [_img_doc_records(hits) for hits in hits_list]
+
+    return wrapper
+
+
+def _knn_body(vec: list[float], k: int, num_candidates: int) -> dict:
+    return {
+        "knn": {
+            "field": "features",
+            "query_vector": vector_json(vec),
+            "k": k,
+            "num_candidates": num_candidates
+        },
+        "_source": {
+            "excludes": ["features"]
+        }
+    }
+
+
+def _img_doc_records(hits: list[dict]) -> list[(str, str, str, float, str, float)]:
+    res = []
+    for hit in hits:
+        source = hit['_source']
+        res.append((
+            source['image_key'],
+            source['image_url'],
+            source['bbox'],
+            source['bbox_score'],
+            source['label'],
+            hit['_score'],
+        ))
+    return res
+
+
+def knn_query_clip_ops(es_cli: EsClient, index_name: str = CLIP_ES_INDEX):
+    def wrapper(vec: list[float], k: int = 10, num_candidates: int = 100) -> list[(str, str, float)]:
+        """
+        Query clip image documents from Elasticsearch
+        :param vec: query vector, e.g. a clip text embedding
+        :param k: k nearest neighbors
+        :param num_candidates: number of candidates
+        :return: list of records: (image_key, image_url, score)
+        """
         knn_query = {
             "knn": {
                 "field": "features",
-                "query_vector": vec,
+                "query_vector": vector_json(vec),
                 "k": k,
                 "num_candidates": num_candidates
             },
@@ -165,26 +472,24 @@ def knn_query_docs_ops(es_cli: EsClient, index_name: str = ES_INDEX):
 
         hits = es_cli.query(index_name, knn_query)
         if len(hits) == 0:
-            LOGGER.debug(f"No hits found for query: {knn_query}")
+            LOGGER.debug(f"No clip hits found in index: {index_name}")
             return []
-        res = []
-        for hit in hits:
-            source = hit['_source']
-            res.append((
-                source['image_key'],
-                source['image_url'],
-                source['bbox'],
-                source['bbox_score'],
-                source['label'],
-                hit['_score'],
-            ))
-
-        return res
+        return [(hit['_source']['image_key'], hit['_source']['image_url'], hit['_score']) for hit in hits]
 
     return wrapper
 
 
-def create_img_index(es_cli: EsClient, index_name: str = ES_INDEX) -> bool:
+def create_img_index(es_cli: EsClient, index_name: str = ES_INDEX, vector_type: str = VECTOR_TYPE,
+                     dims: int = VECTOR_DIMENSION) -> bool:
+    """
+    Create image index
+    :param es_cli: es client
+    :param index_name: index name
+    :param vector_type: float32, float16 or int8, int8 vectors are indexed as byte vectors
+    :param dims: vector dimension, the projected dimension if the model has a projection
+    :return: true if the index exists or is created
+    """
+    element_type = es_element_type(vector_type)
     body = {
         "settings": {
             "index": {
@@ -214,9 +519,58 @@ def create_img_index(es_cli: EsClient, index_name: str = ES_INDEX) -> bool:
                     "type": "text",
                     "index": True
                 },
+                CAPTION_FIELD: {
+                    "type": "text",
+                    "index": True
+                },
+                "features": {
+                    "type": "dense_vector",
+                    "dims": dims,
+                    "element_type": element_type,
+                    "index": True,
+                    # cosine of byte vectors scores the same as dot_product of normalized float vectors
+                    "similarity": "cosine" if element_type == 'byte' else "dot_product",
+                    "index_options": {
+                        "type": "hnsw",
+                        "m": 16,
+                        "ef_construction": 256
+                    }
+                }
+            }
+        }
+    }
+
+    return es_cli.create_index(index_name=index_name, body=body)
+
+
+def create_clip_index(es_cli: EsClient, index_name: str = CLIP_ES_INDEX, dims: int = CLIP_VECTOR_DIMENSION) -> bool:
+    """
+    Create index of clip image embeddings, searched by clip text embeddings
+    :param es_cli: es client
+    :param index_name: index name
+    :param dims: clip vector dimension
+    :return: true if the index exists or is created
+    """
+    body = {
+        "settings": {
+            "index": {
+                "refresh_interval": "180s",
+                "number_of_replicas": "0"
+            }
+        },
+        "mappings": {
+            "properties": {
+                "image_key": {
+                    "type": "keyword",
+                    "index": True
+                },
+                "image_url": {
+                    "type": "text",
+                    "index": False
+                },
                 "features": {
                     "type": "dense_vector",
-                    "dims": 768,
+                    "dims": dims,
                     "index": True,
                     "similarity": "dot_product",
                     "index_options": {
@@ -1,22 +1,34 @@
+import asyncio
+
 import requests
 import uvicorn
 from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
 import image_helper
+from batcher import MicroBatcher, primary_features_batch_fn
 from config import (
     HTTP_PORT,
+    ES_INDEX,
+    INFERENCE_WORKERS,
     MINIO_PROXY_ENDPOINT,
+    RERANK_ENABLED,
+    SEARCH_BATCH_SIZE,
+    TEXT_SEARCH_ENABLED,
 )
 from embedding import (
     # do_milvus_embedding,
     do_es_embedding,
+    do_es_clip_embedding,
 )
 from es_helpers import EsClient
+from inference_pool import InferencePool
+from local_helpers import LocalIndexClient, rerank_docs_ops
 from logger import LOGGER
-from model import VitBase224
-from search import do_es_search
+from model import VitBase224, ClipVitBasePatch16
+from search import do_es_search, do_es_multi_search, es_search_features, es_text_search_features
 
 app = FastAPI()
 origins = ["*"]
@@ -31,8 +43,23 @@ app.add_middleware(
 
 # MYSQL_CLIENT = MysqlClient()
 # MILVUS_CLIENT = MilvusClient()
-VIT_MODEL = VitBase224()
+# inference runs in worker processes if configured, the pool has the same extract api as the model
+VIT_MODEL = InferencePool(VitBase224) if INFERENCE_WORKERS > 0 else VitBase224()
 ES_CLIENT = EsClient()
+# concurrent /search requests are flushed to the model as one batch
+SEARCH_BATCHER = MicroBatcher(primary_features_batch_fn(VIT_MODEL)) if SEARCH_BATCH_SIZE > 1 else None
+# clip text queries are embedded in batches too, repeated texts are served from its cache
+CLIP_MODEL = ClipVitBasePatch16() if TEXT_SEARCH_ENABLED else None
+TEXT_BATCHER = MicroBatcher(CLIP_MODEL.generate_text_embeddings) if CLIP_MODEL is not None else None
+# es candidates are reranked with the exact vectors of the local index
+RERANK_CLIENT = LocalIndexClient() if RERANK_ENABLED else None
+RERANK = rerank_docs_ops(RERANK_CLIENT, ES_INDEX, VIT_MODEL.codec) if RERANK_ENABLED else None
+
+
+@app.on_event("shutdown")
+def shutdown():
+    # flush the embedding cache and stop the inference workers
+    VIT_MODEL.close()
 
 
 @app.get("/ping")
@@ -51,34 +78,66 @@ def ping(q: str):
 
 
 @app.get('/load')
-def load_img(img_bucket: str, table_name: str):
+def load_img(img_bucket: str, table_name: str, incremental: bool = False):
     try:
-        LOGGER.debug(f"detect image bucket: {img_bucket}, table_name: {table_name}")
-        count = do_es_embedding(img_bucket, VIT_MODEL, ES_CLIENT, table_name)
+        LOGGER.debug(f"detect image bucket: {img_bucket}, table_name: {table_name}, incremental: {incremental}")
+        count = do_es_embedding(img_bucket, VIT_MODEL, ES_CLIENT, table_name,
+                                rerank_cli=RERANK_CLIENT, incremental=incremental)
         return JSONResponse({'status': True, 'msg': 'success', 'data': count})
     except Exception as e:
         LOGGER.error(f"Get image error: {e}")
         return {'status': False, 'msg': e}, 400
 
 
-@app.post("/search")
-async def search(file: UploadFile = File(...)):
-    contents = await file.read()
-    resize_img = image_helper.thumbnail_bytes(contents, 450, 60)
-    key = image_helper.md5_content(resize_img)
+@app.get('/load/clip')
+def load_clip_img(img_bucket: str, index_name: str):
+    if CLIP_MODEL is None:
+        return JSONResponse({'status': False, 'msg': 'text search is disabled'})
+    try:
+        LOGGER.debug(f"load clip image bucket: {img_bucket}, index_name: {index_name}")
+        count = do_es_clip_embedding(img_bucket, CLIP_MODEL, ES_CLIENT, index_name)
+        return JSONResponse({'status': True, 'msg': 'success', 'data': count})
+    except Exception as e:
+        LOGGER.error(f"Load clip image error: {e}")
+        return {'status': False, 'msg': e}, 400
 
-    files = {
-        'file': (key, resize_img, 'image/jpeg'),
+
+@app.get("/search/text")
+async def search_text(q: str):
+    if TEXT_BATCHER is None:
+        return JSONResponse({'status': False, 'msg': 'text search is disabled'})
+    q = q.strip()
+    if len(q) == 0:
+        return JSONResponse({'status': False, 'msg': 'empty query'})
+    vec = await asyncio.wrap_future(TEXT_BATCHER.submit(q))
+    if vec is None:
+        return JSONResponse({'status': False, 'msg': 'text embedding failed'})
+    res_list = await run_in_threadpool(es_text_search_features, vec, ES_CLIENT)
+    if len(res_list) == 0:
+        return JSONResponse({'status': False, 'msg': 'no result found'})
+
+    data = {
+        'text': q,
+        'results': [item.to_dict() for item in res_list]
     }
+    return JSONResponse({'status': True, 'msg': 'success', 'data': data})
 
-    bucket_name = 'search'
-    upload_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{key}'
-    response = requests.post(upload_url, files=files)
-    if response.status_code != 200:
+
+@app.post("/search")
+async def search(file: UploadFile = File(...)):
+    contents = await file.read()
+    uploaded = await upload_search_image(contents)
+    if uploaded is None:
         return JSONResponse({'status': False, 'msg': 'upload image failed'})
 
-    img_url = upload_url
-    obj_feat, candidate_box, res_list = do_es_search(img_url, VIT_MODEL, ES_CLIENT)
+    img_url, resize_img, key = uploaded
+    if SEARCH_BATCHER is not None:
+        obj_feat, candidate_box = await asyncio.wrap_future(SEARCH_BATCHER.submit((img_url, resize_img, key)))
+        obj_feat, candidate_box, res_list = await run_in_threadpool(es_search_features, obj_feat, candidate_box,
+                                                                    ES_CLIENT, ES_INDEX, RERANK)
+    else:
+        obj_feat, candidate_box, res_list = do_es_search(img_url, VIT_MODEL, ES_CLIENT,
+                                                         img_content=resize_img, img_key=key, rerank=RERANK)
     if obj_feat is None:
         return JSONResponse({'status': False, 'msg': 'image detect or extract failed'})
     if len(res_list) == 0:
@@ -95,6 +154,85 @@ async def search(file: UploadFile = File(...)):
     return JSONResponse({'status': True, 'msg': 'success', 'data': data})
 
 
+@app.post("/search/objects")
+async def search_objects(file: UploadFile = File(...)):
+    contents = await file.read()
+    uploaded = await upload_search_image(contents)
+    if uploaded is None:
+        return JSONResponse({'status': False, 'msg': 'upload image failed'})
+
+    img_url, resize_img, key = uploaded
+    # all the objects are embedded in one batch and searched with one multi search
+    res = await run_in_threadpool(do_es_multi_search, img_url, VIT_MODEL, ES_CLIENT,
+                                  img_content=resize_img, img_key=key, rerank=RERANK)
+    if len(res) == 0:
+        return JSONResponse({'status': False, 'msg': 'image detect or extract failed'})
+
+    data = {
+        'search_img': img_url,
+        'objects': [{
+            'bbox': obj_feat.bbox.to_dict(),
+            'results': [item.to_dict() for item in res_list[:10]],
+        } for obj_feat, res_list in res]
+    }
+
+    return JSONResponse({'status': True, 'msg': 'success', 'data': data})
+
+
+@app.get("/search/box")
+async def search_box(key: str, box: str):
+    if not image_helper.is_md5(key):
+        return JSONResponse({'status': False, 'msg': 'invalid key'})
+    try:
+        x1, y1, x2, y2 = [int(item) for item in box.split(',')]
+    except ValueError:
+        return JSONResponse({'status': False, 'msg': 'invalid box, expect x1,y1,x2,y2'})
+    if x2 <= x1 or y2 <= y1:
+        return JSONResponse({'status': False, 'msg': 'invalid box, expect x1,y1,x2,y2'})
+
+    # the image uploaded by /search, its decoded data and detections are cached for a while
+    img_url = f'http://{MINIO_PROXY_ENDPOINT}/file/search/{key}'
+    try:
+        obj_feat = await run_in_threadpool(VIT_MODEL.extract_box_features, img_url, (x1, y1, x2, y2), key)
+    except ValueError as e:
+        return JSONResponse({'status': False, 'msg': f'invalid box, {e}'})
+    obj_feat, _, res_list = await run_in_threadpool(es_search_features, obj_feat, [], ES_CLIENT, ES_INDEX, RERANK)
+    if obj_feat is None:
+        return JSONResponse({'status': False, 'msg': 'image detect or extract failed'})
+    if len(res_list) == 0:
+        return JSONResponse({'status': False, 'msg': 'no result found'})
+
+    data = {
+        'search_img': obj_feat.url,
+        'bbox': obj_feat.bbox.to_dict(),
+        'results': [item.to_dict() for item in res_list[:10]]
+    }
+
+    return JSONResponse({'status': True, 'msg': 'success', 'data': data})
+
+
+async def upload_search_image(contents: bytes) -> (str, bytes, str):
+    """
+    Thumbnail the search image and upload it to the search bucket
+    :param contents: uploaded image bytes
+    :return: (image url, thumbnail bytes, thumbnail md5), None if upload failed
+    """
+    # blocking steps run in the thread pool, so that concurrent requests can meet in one batch
+    resize_img = await run_in_threadpool(image_helper.thumbnail_bytes, contents, 450, 60)
+    key = image_helper.md5_content(resize_img)
+
+    files = {
+        'file': (key, resize_img, 'image/jpeg'),
+    }
+
+    bucket_name = 'search'
+    upload_url = f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{key}'
+    response = await run_in_threadpool(requests.post, upload_url, files=files)
+    if response.status_code != 200:
+        return None
+    return upload_url, resize_img, key
+
+
 def start_http_server():
     LOGGER.info(f"http listen on: {HTTP_PORT}")
     uvicorn.run(app, host="0.0.0.0", port=int(HTTP_PORT))
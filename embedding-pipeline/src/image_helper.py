@@ -1,11 +1,12 @@
 import hashlib
 import io
 import os
+import re
 
 import cv2
 import numpy as np
 import requests
-from PIL import Image
+from PIL import Image, ImageOps
 from towhee import ops
 
 from logger import LOGGER
@@ -58,6 +59,15 @@ def md5_content(content: bytes) -> str:
     return hashlib.md5(content).hexdigest()
 
 
+def is_md5(s: str) -> bool:
+    """
+    Check the string is a md5 hex digest
+    :param s: string to check
+    :return: True if s is a md5 hex digest
+    """
+    return s is not None and re.fullmatch(r'[0-9a-f]{32}', s) is not None
+
+
 def get_images(path):
     pics = []
     for f in os.listdir(path):
@@ -172,6 +182,52 @@ def load_from_bytes(bs: bytes) -> np.ndarray:
         LOGGER.error('Load image from bytes failed, error msg: %s' % str(e))
 
 
+def load_rgb_from_bytes(bs: bytes) -> np.ndarray:
+    """
+    Decode image bytes to a RGB ndarray, exif orientation is applied like the cv2 decode op of urls
+    :param bs: encoded image bytes
+    :return: RGB image, None if decode failed
+    """
+    try:
+        bgr_img = cv2.imdecode(np.asarray(bytearray(bs), dtype=np.uint8), cv2.IMREAD_COLOR)
+    except Exception as e:
+        LOGGER.error('Load image from bytes failed, error msg: %s' % str(e))
+        return None
+    if bgr_img is None:
+        return None
+    return cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+
+
+def load_reduced_rgb_from_bytes(bs: bytes, min_size: int) -> (np.ndarray, float):
+    """
+    Decode image bytes to a RGB ndarray, jpeg images are decoded at the smallest
+    DCT scale (1/2, 1/4 or 1/8) whose short side is still at least min_size
+    :param bs: encoded image bytes
+    :param min_size: min short side of the decoded image, 0 means full size
+    :return: RGB image, scale of the original size to the decoded size
+    """
+    image = Image.open(io.BytesIO(bs))
+    full_size = max(image.size)
+    if min_size > 0 and image.format == 'JPEG':
+        image.draft('RGB', (min_size, min_size))
+    # apply exif orientation like load_rgb_from_bytes and the cv2 decode op of urls
+    image = ImageOps.exif_transpose(image)
+    rgb = np.asarray(image.convert('RGB'))
+    return rgb, full_size / max(rgb.shape[:2])
+
+
+def read_bytes(image_path: str) -> bytes:
+    """
+    Read image bytes from url or local file
+    :param image_path: url or local file path
+    :return: image bytes, None if failed
+    """
+    if image_path.startswith('http://') or image_path.startswith('https://'):
+        return http_download(image_path)
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+
 def load_from_local(image_path: str) -> np.ndarray:
     return cv2.imread(image_path)
 
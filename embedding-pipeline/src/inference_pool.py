@@ -0,0 +1,452 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+from towhee import ops
+from towhee._types import Image
+
+from config import (
+    DECODE_MIN_SIZE,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_ENABLED,
+    INFERENCE_BACKEND,
+    INFERENCE_START_TIMEOUT,
+    INFERENCE_TASK_TIMEOUT,
+    INFERENCE_WORKERS,
+    INFERENCE_WORKER_THREADS,
+    SEARCH_IMAGE_CACHE_SIZE,
+    SEARCH_IMAGE_CACHE_TTL,
+)
+from embedding_cache import LRUCache
+from logger import LOGGER
+from model import (
+    BoundingBox,
+    ObjectFeature,
+    box_bbox,
+    cache_primary_features,
+    cache_search_image,
+    cached_primary_features,
+    create_cache,
+    decode_image,
+    fill_search_image,
+    image_scale,
+    scaled_image,
+    search_image,
+    _crop_box,
+)
+from projection import vector_dimension
+from vector_codec import VectorCodec
+
+# no result within the poll interval
+_EMPTY = object()
+# dead workers are respawned up to this many times
+_MAX_RESTARTS = 16
+
+
+class InferencePool(object):
+    """
+    Pool of inference worker processes with the extract api of ImageFeatureModel, arrays go through shared memory
+    """
+
+    def __init__(self, model_cls: type,
+                 workers: int = INFERENCE_WORKERS,
+                 threads: int = INFERENCE_WORKER_THREADS,
+                 backend: str = INFERENCE_BACKEND,
+                 cache_enabled: bool = EMBEDDING_CACHE_ENABLED,
+                 start_timeout: float = INFERENCE_START_TIMEOUT,
+                 task_timeout: float = INFERENCE_TASK_TIMEOUT):
+        """
+        :param model_cls: ImageFeatureModel subclass, e.g. VitBase224
+        :param workers: number of worker processes
+        :param threads: torch threads of each worker
+        :param backend: inference backend of the workers
+        :param cache_enabled: cache primary features by image md5, the cache lives in this process
+        :param start_timeout: seconds for the workers to load the model
+        :param task_timeout: seconds to wait for the result of a task
+        """
+        self.decode_op = ops.image_decode.cv2_rgb()
+        self.crop_op = ops.towhee.image_crop()
+        self.decode_min_size = DECODE_MIN_SIZE
+        # decoded search images stay in this process, only the chosen crop goes to a worker
+        self.image_cache = LRUCache(SEARCH_IMAGE_CACHE_SIZE, SEARCH_IMAGE_CACHE_TTL)
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = {}
+        # worker pid of each started task
+        self.owners = {}
+        self.task_timeout = task_timeout
+        self.closed = False
+        self.restarts = 0
+
+        self.ctx = mp.get_context('spawn')
+        self.worker_args = (model_cls, backend, threads)
+        self.task_queue = self.ctx.Queue()
+        self.result_queue = self.ctx.Queue()
+        self.processes = [self._start_worker() for _ in range(max(workers, 1))]
+
+        # wait for the workers to load the model
+        self.model_name = None
+        ready = 0
+        deadline = time.monotonic() + start_timeout
+        while ready < len(self.processes):
+            try:
+                self.model_name = self.result_queue.get(timeout=1.0)
+                ready += 1
+            except queue.Empty:
+                if time.monotonic() < deadline and all(p.is_alive() for p in self.processes):
+                    continue
+                for p in self.processes:
+                    p.terminate()
+                raise RuntimeError(f"Inference workers failed to start, {ready}/{len(self.processes)} ready")
+        self.cache = create_cache(self.model_name, backend) if cache_enabled else None
+        self.codec = VectorCodec(self.model_name)
+        self.dim = vector_dimension(self.model_name)
+
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+        LOGGER.info(f"Start {len(self.processes)} inference workers of {self.model_name}")
+
+    def extract_primary_features(self, url: str, content: bytes = None,
+                                 key: str = None) -> (ObjectFeature, list[BoundingBox]):
+        """
+        Extract primary object feature in a worker process
+        :param url: url or local file path
+        :param content: encoded image bytes of the url, decoded instead of fetching the url if given
+        :param key: md5 of the image content, looks up and fills the embedding cache if given
+        :return: object features, candidate bbox list: (box, label, score)
+        """
+        cached = cached_primary_features(self.cache, key, url, self.codec)
+        if cached is not None:
+            fill_search_image(self.image_cache, key, self._decode, url if content is None else content, cached)
+            return cached
+        img = self._decode(url if content is None else content)
+        if img is None:
+            return None, []
+        obj_feat, candidate_list = self.submit('primary', [img], url).result(self.task_timeout)
+        cache_primary_features(self.cache, key, obj_feat, candidate_list, self.codec)
+        cache_search_image(self.image_cache, key, img, [obj_feat.bbox] + candidate_list)
+        return obj_feat, candidate_list
+
+    def extract_primary_features_batch(self, urls: list[str],
+                                       batch_size: int = EMBEDDING_BATCH_SIZE,
+                                       keys: list[str] = None,
+                                       contents: list[bytes] = None) -> list[(ObjectFeature, list[BoundingBox])]:
+        """
+        Extract primary object features of a batch of images, the images are spread over the workers
+        :param urls: url or local file path list
+        :param batch_size: unused, each worker embeds one image at a time
+        :param keys: md5 of the image contents, None items are not cached
+        :param contents: encoded image bytes of the urls, None items are fetched from the url
+        :return: (object feature, candidate bbox list) of each image, in the same order as urls
+        """
+        if keys is None:
+            keys = [None] * len(urls)
+        if contents is None:
+            contents = [None] * len(urls)
+        res = [(None, []) for _ in urls]
+        futures = {}
+        for i, url in enumerate(urls):
+            cached = cached_primary_features(self.cache, keys[i], url, self.codec)
+            if cached is not None:
+                fill_search_image(self.image_cache, keys[i], self._decode,
+                                  url if contents[i] is None else contents[i], cached)
+                res[i] = cached
+                continue
+            img = self._decode(url if contents[i] is None else contents[i])
+            if img is not None:
+                futures[i] = (self.submit('primary', [img], url), img)
+        for i, (future, img) in futures.items():
+            res[i] = future.result(self.task_timeout)
+            cache_primary_features(self.cache, keys[i], *res[i], self.codec)
+            cache_search_image(self.image_cache, keys[i], img, [res[i][0].bbox] + res[i][1])
+        return res
+
+    def extract_objects_features(self, url: str, content: bytes = None, key: str = None) -> list[ObjectFeature]:
+        """
+        Extract features of the primary object and all the candidate objects in a worker process
+        :param url: url or local file path
+        :param content: encoded image bytes of the url, decoded instead of fetching the url if given
+        :param key: md5 of the image content, fills the primary feature cache if given
+        :return: object features, the primary object first, empty if decode failed
+        """
+        img = self._decode(url if content is None else content)
+        if img is None:
+            return []
+        obj_feats = self.submit('objects', [img], url).result(self.task_timeout)
+        if len(obj_feats) > 0:
+            cache_primary_features(self.cache, key, obj_feats[0], [item.bbox for item in obj_feats[1:]], self.codec)
+        cache_search_image(self.image_cache, key, img, [item.bbox for item in obj_feats])
+        return obj_feats
+
+    def extract_box_features(self, url: str, box: tuple[int, int, int, int], key: str = None) -> ObjectFeature:
+        """
+        Extract features of a box chosen in a searched image, the crop is embedded in a worker process
+        :param url: url of the searched image, decoded if the key is not cached
+        :param box: box in the coordinates of the full image
+        :param key: md5 of the image content
+        :return: object features of the box, labeled if it is a detected box, None if decode failed
+        """
+        img, bboxes = search_image(self.image_cache, key, self._decode, url)
+        if img is None:
+            return None
+        bbox = box_bbox(img, box, bboxes)
+        vecs = self.embed([np.asarray(crop) for crop in _crop_box(self.crop_op, img, bbox.box)])
+        return ObjectFeature(url=url, bbox=bbox, features=self.codec.encode(vecs[0]) if len(vecs) > 0 else None)
+
+    def extract_features_batch(self, urls: list[str],
+                               batch_size: int = EMBEDDING_BATCH_SIZE,
+                               contents: list[bytes] = None) -> list[list[ObjectFeature]]:
+        """
+        Extract features of detected objects for a batch of images, the images are spread over the workers
+        :param urls: url or local file path list
+        :param batch_size: unused, each worker embeds the crops of one image in one batch
+        :param contents: encoded image bytes of the urls, None items are fetched from the url
+        :return: object features of each image, in the same order as urls, None if the image failed to decode
+        """
+        if contents is None:
+            contents = [None] * len(urls)
+        futures = {}
+        for i, url in enumerate(urls):
+            img = self._decode(url if contents[i] is None else contents[i])
+            if img is not None:
+                futures[i] = self.submit('features', [img], url)
+        res = [None for _ in urls]
+        for i, future in futures.items():
+            res[i] = future.result(self.task_timeout)
+        return res
+
+    def embed(self, crops: list[np.ndarray]) -> list[np.ndarray]:
+        """
+        Embed cropped images in a worker process
+        :param crops: cropped RGB images
+        :return: normalized vectors, in the same order as crops
+        """
+        if len(crops) == 0:
+            return []
+        return self.submit('embed', crops).result(self.task_timeout)
+
+    def submit(self, kind: str, arrays: list[np.ndarray], url: str = '') -> Future:
+        """
+        Copy the arrays to shared memory and submit a task to the workers
+        :param kind: task kind: primary, features, objects or embed
+        :param arrays: decoded image or crops
+        :param url: url of the image, only kept in the result
+        :return: future of the task result
+        """
+        if len(self.processes) == 0:
+            raise RuntimeError("No inference worker is alive")
+        shm, specs = _pack(arrays)
+        future = Future()
+        task_id = next(self.task_ids)
+        with self.lock:
+            self.pending[task_id] = (future, kind, url, shm)
+        # scale of a reduced decode, so that the worker reports boxes of the full image
+        scale = image_scale(arrays[0]) if kind != 'embed' else 1.0
+        self.task_queue.put((task_id, kind, shm.name if shm is not None else None, specs, url, scale))
+        return future
+
+    def close(self):
+        self.closed = True
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for p in self.processes:
+            p.join(self.task_timeout)
+            if p.is_alive():
+                p.terminate()
+        self.result_queue.put(None)
+        self.collector.join()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _decode(self, src):
+        return decode_image(self.decode_op, src, self.decode_min_size)
+
+    def _start_worker(self):
+        p = self.ctx.Process(target=_worker_main, args=self.worker_args + (self.task_queue, self.result_queue),
+                             daemon=True)
+        p.start()
+        return p
+
+    def _collect(self):
+        checked_at = time.monotonic()
+        while True:
+            try:
+                item = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                item = _EMPTY
+            # check the workers every second, also while the other workers keep returning results
+            if time.monotonic() - checked_at >= 1.0:
+                self._check_workers()
+                checked_at = time.monotonic()
+            if item is _EMPTY:
+                continue
+            if item is None:
+                return
+            if isinstance(item, str):
+                LOGGER.info(f"Inference worker of {item} is ready")
+                continue
+            if len(item) == 2:
+                # a worker took the task
+                task_id, pid = item
+                with self.lock:
+                    if task_id in self.pending:
+                        self.owners[task_id] = pid
+                continue
+            task_id, err, meta, shm_name, specs = item
+            with self.lock:
+                task = self.pending.pop(task_id, None)
+                self.owners.pop(task_id, None)
+            if task is None:
+                # the task was failed when a worker exited
+                if shm_name is not None:
+                    _release(SharedMemory(name=shm_name))
+                continue
+            future, kind, url, in_shm = task
+            _release(in_shm)
+            if err is not None:
+                future.set_exception(RuntimeError(f"Inference task {kind} of {url} failed: {err}"))
+                continue
+
+            out_shm = SharedMemory(name=shm_name) if shm_name is not None else None
+            vecs = [np.array(vec) for vec in _unpack(out_shm, specs)]
+            _release(out_shm)
+            try:
+                future.set_result(_build_result(kind, url, meta, vecs, self.codec))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _check_workers(self):
+        """
+        Respawn the exited worker processes and fail the pending tasks not started by a live worker
+        """
+        if self.closed:
+            return
+        dead = [p for p in self.processes if not p.is_alive()]
+        if len(dead) == 0:
+            return
+        for p in dead:
+            LOGGER.error(f"Inference worker {p.pid} exited with code {p.exitcode}")
+            self.processes.remove(p)
+            if self.restarts < _MAX_RESTARTS:
+                self.restarts += 1
+                self.processes.append(self._start_worker())
+        if len(self.processes) == 0:
+            LOGGER.error("No inference worker is alive, new tasks are refused")
+        live = set(p.pid for p in self.processes)
+        with self.lock:
+            # a task not started yet may have been taken by the dead worker
+            failed = [task_id for task_id in self.pending if self.owners.get(task_id) not in live]
+            pending = [self.pending.pop(task_id) for task_id in failed]
+            for task_id in failed:
+                self.owners.pop(task_id, None)
+        for future, kind, url, in_shm in pending:
+            _release(in_shm)
+            future.set_exception(RuntimeError(f"Inference task {kind} of {url} failed: worker exited"))
+
+
+def _build_result(kind: str, url: str, meta: dict, vecs: list[np.ndarray], codec: VectorCodec):
+    if kind == 'embed':
+        return vecs
+    if kind in ('features', 'objects'):
+        return [ObjectFeature(url=url, bbox=BoundingBox(**bbox), features=codec.encode(vec))
+                for bbox, vec in zip(meta['bboxes'], vecs)]
+    obj_feat = ObjectFeature(url=url, bbox=BoundingBox(**meta['bbox']),
+                             features=codec.encode(vecs[0]) if len(vecs) > 0 else None)
+    return obj_feat, [BoundingBox(**item) for item in meta['candidates']]
+
+
+def _worker_main(model_cls: type, backend: str, threads: int, task_queue, result_queue):
+    torch.set_num_threads(threads)
+    model = model_cls(backend=backend, cache_enabled=False)
+    result_queue.put(model.model_name)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, kind, shm_name, specs, url, scale = task
+        result_queue.put((task_id, os.getpid()))
+        in_shm = None
+        try:
+            in_shm = SharedMemory(name=shm_name) if shm_name is not None else None
+            # the views of the input block are only referenced by the task
+            meta, vecs = _run_task(model, kind, _unpack(in_shm, specs), url, scale)
+
+            out_shm, out_specs = _pack(vecs)
+            result_queue.put((task_id, None, meta, out_shm.name if out_shm is not None else None, out_specs))
+            if out_shm is not None:
+                out_shm.close()
+        except Exception as e:
+            LOGGER.error(f"Inference task {kind} of {url} failed: {e}")
+            result_queue.put((task_id, str(e), None, None, None))
+        finally:
+            # runs after the except block, the traceback holding the views is released by then
+            if in_shm is not None:
+                in_shm.close()
+
+
+def _run_task(model, kind: str, arrays: list[np.ndarray], url: str, scale: float) -> (dict, list[np.ndarray]):
+    if kind == 'embed':
+        return None, model.embed([Image(arr, 'RGB') for arr in arrays])
+    img = scaled_image(arrays[0], scale)
+    if kind == 'features':
+        return _objects_result(model, model.extract_features_images([img], [url])[0])
+    if kind == 'objects':
+        return _objects_result(model, model.extract_objects_features_image(img, url))
+    obj_feat, candidate_list = model.extract_primary_features_image(img, url)
+    meta = {
+        'bbox': obj_feat.bbox.to_dict(),
+        'candidates': [item.to_dict() for item in candidate_list],
+    }
+    if obj_feat.features is None:
+        return meta, []
+    return meta, [model.codec.decode(obj_feat.features)]
+
+
+def _objects_result(model, obj_feats: list[ObjectFeature]) -> (dict, list[np.ndarray]):
+    return ({'bboxes': [obj_feat.bbox.to_dict() for obj_feat in obj_feats]},
+            [model.codec.decode(obj_feat.features) for obj_feat in obj_feats])
+
+
+def _pack(arrays: list[np.ndarray]) -> (SharedMemory, list[(int, tuple, str)]):
+    """
+    Copy arrays into one shared memory block
+    :param arrays: arrays to copy
+    :return: shared memory block (None if nothing to copy), (offset, shape, dtype) of each array
+    """
+    arrays = [np.ascontiguousarray(arr) for arr in arrays]
+    size = sum(arr.nbytes for arr in arrays)
+    if size == 0:
+        return None, [(0, arr.shape, arr.dtype.str) for arr in arrays]
+    shm = SharedMemory(create=True, size=size)
+    specs, offset = [], 0
+    for arr in arrays:
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf, offset=offset)[...] = arr
+        specs.append((offset, arr.shape, arr.dtype.str))
+        offset += arr.nbytes
+    return shm, specs
+
+
+def _unpack(shm: SharedMemory, specs: list[(int, tuple, str)]) -> list[np.ndarray]:
+    """
+    View arrays in the shared memory block without copy
+    :param shm: shared memory block
+    :param specs: (offset, shape, dtype) of each array
+    :return: array views, valid until the block is closed
+    """
+    if shm is None:
+        return [np.zeros(shape, dtype=dtype) for _, shape, dtype in specs]
+    return [np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset) for offset, shape, dtype in specs]
+
+
+def _release(shm: SharedMemory):
+    if shm is None:
+        return
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,159 @@
+import queue
+import threading
+
+import requests
+
+from config import (
+    EMBEDDING_BATCH_SIZE,
+    INGEST_DOWNLOAD_TIMEOUT,
+    INGEST_DOWNLOAD_WORKERS,
+    INGEST_QUEUE_SIZE,
+    INGEST_WRITE_WORKERS,
+)
+from logger import LOGGER
+
+# end of the items of a stage
+_DONE = object()
+
+
+class IngestionEngine(object):
+    """
+    Staged ingestion of image urls: download -> embed -> write.
+    Images are downloaded by I/O threads, embedded in batches by the calling thread
+    and written by writer threads, so the model is not idle during http fetches and
+    index round trips. The stages are connected by bounded queues, a slow stage blocks
+    the stages before it instead of buffering the whole bucket in memory.
+    """
+
+    def __init__(self,
+                 embed_fn: callable,
+                 write_fn: callable,
+                 batch_size: int = EMBEDDING_BATCH_SIZE,
+                 download_workers: int = INGEST_DOWNLOAD_WORKERS,
+                 write_workers: int = INGEST_WRITE_WORKERS,
+                 queue_size: int = INGEST_QUEUE_SIZE,
+                 fetch_fn: callable = None):
+        """
+        :param embed_fn: (urls, contents) -> results of the urls, eg: model.extract_primary_features_batch
+        :param write_fn: (urls, results) -> number of images written successfully
+        :param batch_size: max number of images of one embed call
+        :param download_workers: number of download threads
+        :param write_workers: number of writer threads, 1 for clients that are not thread safe
+        :param queue_size: max number of downloaded images waiting for the model
+        :param fetch_fn: url -> encoded image bytes, None if failed, http get by default
+        """
+        self.embed_fn = embed_fn
+        self.write_fn = write_fn
+        self.batch_size = max(1, batch_size)
+        self.download_workers = max(1, download_workers)
+        self.write_workers = max(1, write_workers)
+        self.queue_size = max(1, queue_size)
+        self.fetch_fn = fetch_fn if fetch_fn is not None else fetch_content
+        self.lock = threading.Lock()
+        self.success_count = 0
+        self.processed = 0
+
+    def run(self, urls: list[str]) -> int:
+        """
+        Ingest the urls
+        :param urls: image urls
+        :return: number of images written successfully
+        """
+        self.success_count = 0
+        self.processed = 0
+        url_queue = queue.Queue()
+        for url in urls:
+            url_queue.put(url)
+        fetched = queue.Queue(maxsize=self.queue_size)
+        batches = queue.Queue(maxsize=max(1, self.queue_size // self.batch_size))
+
+        downloaders = [threading.Thread(target=self._download, args=(url_queue, fetched), daemon=True)
+                       for _ in range(self.download_workers)]
+        writers = [threading.Thread(target=self._write, args=(batches, len(urls)), daemon=True)
+                   for _ in range(self.write_workers)]
+        for t in downloaders + writers:
+            t.start()
+        try:
+            self._embed(fetched, batches)
+            # every downloader has put its end item
+            for t in downloaders:
+                t.join()
+        finally:
+            for _ in writers:
+                batches.put(_DONE)
+            for t in writers:
+                t.join()
+        LOGGER.info(f"Ingest {self.success_count} images successfully, total: {len(urls)}")
+        return self.success_count
+
+    def _download(self, url_queue: queue.Queue, fetched: queue.Queue):
+        while True:
+            try:
+                url = url_queue.get_nowait()
+            except queue.Empty:
+                fetched.put(_DONE)
+                return
+            content = self.fetch_fn(url)
+            if content is None:
+                with self.lock:
+                    self.processed += 1
+                continue
+            fetched.put((url, content))
+
+    def _embed(self, fetched: queue.Queue, batches: queue.Queue):
+        running = self.download_workers
+        while running > 0:
+            # block for the first image, then take what is already downloaded
+            items = []
+            while running > 0 and len(items) < self.batch_size:
+                try:
+                    item = fetched.get() if len(items) == 0 else fetched.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    running -= 1
+                    continue
+                items.append(item)
+            if len(items) == 0:
+                continue
+            urls = [url for url, _ in items]
+            try:
+                res = self.embed_fn(urls, [content for _, content in items])
+            except Exception as e:
+                LOGGER.error(f"Embed {len(urls)} images failed: {e}")
+                with self.lock:
+                    self.processed += len(urls)
+                continue
+            batches.put((urls, res))
+
+    def _write(self, batches: queue.Queue, total: int):
+        while True:
+            item = batches.get()
+            if item is _DONE:
+                return
+            urls, res = item
+            try:
+                count = self.write_fn(urls, res)
+            except Exception as e:
+                LOGGER.error(f"Write {len(urls)} images failed: {e}")
+                count = 0
+            with self.lock:
+                self.success_count += count
+                self.processed += len(urls)
+                LOGGER.info(f"Process files {self.processed}/{total}, succ count: {self.success_count}")
+
+
+def fetch_content(url: str, timeout: float = INGEST_DOWNLOAD_TIMEOUT) -> bytes:
+    """
+    Download the encoded image
+    :param url: image url
+    :param timeout: timeout in seconds
+    :return: image bytes, None if failed
+    """
+    try:
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+    except Exception as e:
+        LOGGER.error(f"Download {url} failed: {e}")
+        return None
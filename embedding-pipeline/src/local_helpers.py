@@ -0,0 +1,447 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from config import (
+    ES_INDEX,
+    VECTOR_DIMENSION,
+    VECTOR_STORE_PATH,
+    VECTOR_STORE_DTYPE,
+    VECTOR_STORE_NLIST,
+    VECTOR_STORE_NPROBE,
+)
+from logger import LOGGER
+from vector_codec import VectorCodec
+
+
+class LocalIndex(object):
+    """
+    Vector index of one directory: memory-mapped vectors, json lines sidecar and optional IVF lists
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self.lock = threading.Lock()
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            info = json.load(f)
+        self.dim = info['dim']
+        self.dtype = np.dtype(info['dtype'])
+        self.vectors_path = os.path.join(index_dir, 'vectors')
+        self.meta_path = os.path.join(index_dir, 'meta.jsonl')
+        self.assign_path = os.path.join(index_dir, 'assign.i32')
+        self.ivf_path = os.path.join(index_dir, 'ivf.npz')
+
+        self.docs = []
+        self.ids = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.docs = [json.loads(line) for line in f if len(line.strip()) > 0]
+        # rows written without the sidecar line of a crash are dropped
+        row_size = self.dim * self.dtype.itemsize
+        rows = os.path.getsize(self.vectors_path) // row_size if os.path.exists(self.vectors_path) else 0
+        self.count = min(rows, len(self.docs))
+        self.docs = self.docs[:self.count]
+        if rows > self.count:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(self.count * row_size)
+        self.live = np.ones(self.count, dtype=bool)
+        for row, doc in enumerate(self.docs):
+            self._set_id(doc.get('_id'), row)
+        self.vectors = None
+        self._load_ivf()
+
+    def insert(self, docs: list[dict], vectors: np.ndarray) -> int:
+        """
+        Append documents and their vectors
+        :param docs: documents without the features, '_id' is the document id
+        :param vectors: (n, dim) vectors
+        :return: number of documents inserted
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"Expect vectors of dim {self.dim}, got shape {vectors.shape}")
+        with self.lock:
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.meta_path, 'a') as f:
+                f.write(''.join(json.dumps(doc) + '\n' for doc in docs))
+            start = self.count
+            self.count += len(docs)
+            self.docs.extend(docs)
+            # the live flags grow geometrically, the rows past count are spare capacity
+            if self.count > len(self.live):
+                live = np.ones(max(self.count, 2 * len(self.live)), dtype=bool)
+                live[:start] = self.live[:start]
+                self.live = live
+            for i, doc in enumerate(docs):
+                self._set_id(doc.get('_id'), start + i)
+            if self.centroids is not None:
+                assign = self._assign(vectors.astype(np.float32))
+                with open(self.assign_path, 'ab') as f:
+                    f.write(assign.astype(np.int32).tobytes())
+                for i, c in enumerate(assign):
+                    self.tail_lists[int(c)].append(start + i)
+        return len(docs)
+
+    def search(self, vec: np.ndarray, k: int = 10, nprobe: int = VECTOR_STORE_NPROBE) -> list[(dict, float)]:
+        """
+        Search the nearest documents by dot product
+        :param vec: normalized query vector
+        :param k: number of documents
+        :param nprobe: number of IVF lists to scan, all vectors are scanned without IVF index
+        :return: (document, similarity) list, the most similar first
+        """
+        vec = np.asarray(vec, dtype=np.float32)
+        vectors, count, rows = self._snapshot(vec, nprobe)
+        if count == 0:
+            return []
+        if rows is None:
+            scores = _dot_chunks(vectors, vec, count)
+            rows = np.arange(count)
+        else:
+            scores = vectors[rows].astype(np.float32) @ vec
+        alive = self.live[rows]
+        rows, scores = rows[alive], scores[alive]
+        if len(rows) == 0:
+            return []
+        top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.docs[int(rows[i])], float(scores[i])) for i in top]
+
+    def get_vectors(self, ids: list[str]) -> (list[int], np.ndarray):
+        """
+        Stored vectors of the documents
+        :param ids: document ids
+        :return: positions of the ids found, float32 (n, dim) vectors of them
+        """
+        with self.lock:
+            vectors = self._map()
+            found = [(i, self.ids[id]) for i, id in enumerate(ids) if id in self.ids]
+        if len(found) == 0:
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+        rows = np.asarray([row for _, row in found])
+        return [i for i, _ in found], vectors[rows].astype(np.float32)
+
+    def build_ivf(self, nlist: int = VECTOR_STORE_NLIST, iterations: int = 10, sample_size: int = 0) -> int:
+        """
+        Train IVF centroids with spherical k-means and assign all vectors
+        :param nlist: number of lists, capped by the number of vectors
+        :param iterations: k-means iterations
+        :param sample_size: number of training vectors, 0 means 64 per list
+        :return: number of lists
+        """
+        with self.lock:
+            count = self.count
+            vectors = self._map()
+        if count == 0:
+            return 0
+        nlist = min(nlist, count)
+        sample_size = sample_size if sample_size > 0 else nlist * 64
+        rng = np.random.default_rng(0)
+        sample = vectors[np.sort(rng.choice(count, min(sample_size, count), replace=False))].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members) > 0:
+                    centroids[c] = members.sum(axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        assign = np.concatenate([np.argmax(vectors[start:start + 65536].astype(np.float32) @ centroids.T, axis=1)
+                                 for start in range(0, count, 65536)]).astype(np.int32)
+        with self.lock:
+            np.savez(self.ivf_path, centroids=centroids)
+            # vectors appended while training are assigned now
+            extra = self._map()[count:self.count].astype(np.float32)
+            if len(extra) > 0:
+                assign = np.concatenate([assign, np.argmax(extra @ centroids.T, axis=1).astype(np.int32)])
+            assign.tofile(self.assign_path)
+            self._load_ivf()
+        LOGGER.info(f"Build ivf index of {self.index_dir}: {nlist} lists, {len(assign)} vectors")
+        return nlist
+
+    def _snapshot(self, vec: np.ndarray, nprobe: int) -> (np.ndarray, int, np.ndarray):
+        with self.lock:
+            vectors = self._map()
+            if self.centroids is None:
+                return vectors, self.count, None
+            probes = np.argsort(-(self.centroids @ vec))[:nprobe]
+            parts = []
+            for c in probes:
+                parts.append(self.lists[c])
+                if len(self.tail_lists[c]) > 0:
+                    parts.append(np.asarray(self.tail_lists[c], dtype=np.int64))
+            return vectors, self.count, np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int64)
+
+    def _map(self) -> np.ndarray:
+        if self.count == 0:
+            return np.zeros((0, self.dim), dtype=self.dtype)
+        # remap after the file grew
+        if self.vectors is None or len(self.vectors) < self.count:
+            self.vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(self.count, self.dim))
+        return self.vectors
+
+    def _load_ivf(self):
+        self.centroids = None
+        self.lists = []
+        self.tail_lists = []
+        if not os.path.exists(self.ivf_path) or not os.path.exists(self.assign_path):
+            return
+        centroids = np.load(self.ivf_path)['centroids']
+        assign = np.fromfile(self.assign_path, dtype=np.int32)[:self.count]
+        if len(assign) < self.count:
+            LOGGER.warning(f"IVF index of {self.index_dir} is behind the vectors, rebuild it")
+            return
+        self.centroids = centroids
+        # inverted lists: rows of each list, rows appended later go to the tail lists
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(centroids))]
+        self.tail_lists = [[] for _ in range(len(centroids))]
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _set_id(self, id: str, row: int):
+        if id is None:
+            return
+        old = self.ids.get(id)
+        if old is not None:
+            self.live[old] = False
+        self.ids[id] = row
+
+
+class LocalIndexClient(object):
+    """
+    In-process vector store with the insert and search surface of EsClient
+    """
+
+    def __init__(self, path: str = VECTOR_STORE_PATH, dtype: str = VECTOR_STORE_DTYPE):
+        """
+        :param path: root directory of the indexes
+        :param dtype: float32 or float16 vectors on disk
+        """
+        self.path = path
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.indexes = {}
+        os.makedirs(path, exist_ok=True)
+
+    def exist_index(self, index_name: str) -> bool:
+        return os.path.exists(os.path.join(self.path, index_name, 'index.json'))
+
+    def create_index(self, index_name: str, dim: int = VECTOR_DIMENSION) -> bool:
+        """
+        Create index
+        :param index_name: index name
+        :param dim: vector dimension
+        :return: true if the index exists or is created
+        """
+        if self.exist_index(index_name):
+            LOGGER.debug(f"Local index {index_name} already exists")
+            return True
+        try:
+            index_dir = os.path.join(self.path, index_name)
+            os.makedirs(index_dir, exist_ok=True)
+            with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+                json.dump({'dim': dim, 'dtype': self.dtype}, f)
+            LOGGER.debug(f"Successfully create local index: {index_name}")
+            return True
+        except Exception as e:
+            LOGGER.error(f"Failed to create local index: {e}")
+            return False
+
+    def delete_index(self, index_name: str) -> bool:
+        with self.lock:
+            self.indexes.pop(index_name, None)
+        shutil.rmtree(os.path.join(self.path, index_name), ignore_errors=True)
+        return True
+
+    def insert_doc(self, index_name: str, doc: dict, id: str = None) -> bool:
+        """
+        Insert document
+        :param index_name: index name
+        :param doc: document with a 'features' vector
+        :param id: document id
+        :return:
+        """
+        return self.insert_batch(index_name, [{'_id': id, '_source': doc}]) == 1
+
+    def insert_batch(self, index_name: str, docs: list[dict]) -> int:
+        """
+        Insert batch documents
+        :param index_name: index name
+        :param docs: documents to insert, in the bulk format of EsClient.insert_batch
+        :return: number of documents inserted
+        """
+        if len(docs) == 0:
+            return 0
+        try:
+            metas, vectors = [], []
+            for doc in docs:
+                source = dict(doc['_source'])
+                vectors.append(np.asarray(source.pop('features'), dtype=np.float32))
+                source['_id'] = doc.get('_id')
+                metas.append(source)
+            return self.get_index(index_name).insert(metas, np.stack(vectors))
+        except Exception as e:
+            LOGGER.error(f"Failed to insert documents to local index: {e}")
+            return 0
+
+    def query(self, index_name: str, vec: np.ndarray, k: int = 10,
+              nprobe: int = VECTOR_STORE_NPROBE) -> list[(dict, float)]:
+        """
+        Query nearest documents
+        :param index_name: index name
+        :param vec: normalized query vector
+        :param k: number of documents
+        :param nprobe: number of IVF lists to scan
+        :return: (document, dot product) list
+        """
+        try:
+            return self.get_index(index_name).search(vec, k, nprobe)
+        except Exception as e:
+            LOGGER.error(f"Failed to query local index: {e}")
+            return []
+
+    def get_vectors(self, index_name: str, ids: list[str]) -> (list[int], np.ndarray):
+        try:
+            return self.get_index(index_name).get_vectors(ids)
+        except Exception as e:
+            LOGGER.error(f"Failed to get vectors from local index: {e}")
+            return [], None
+
+    def build_index(self, index_name: str, nlist: int = VECTOR_STORE_NLIST) -> int:
+        return self.get_index(index_name).build_ivf(nlist)
+
+    def count(self, index_name: str) -> int:
+        return self.get_index(index_name).count
+
+    def ids(self, index_name: str) -> set[str]:
+        index = self.get_index(index_name)
+        with index.lock:
+            return set(index.ids)
+
+    def get_index(self, index_name: str) -> LocalIndex:
+        with self.lock:
+            index = self.indexes.get(index_name)
+            if index is None:
+                if not self.exist_index(index_name):
+                    raise Exception(f"Local index {index_name} does not exist")
+                index = LocalIndex(os.path.join(self.path, index_name))
+                self.indexes[index_name] = index
+            return index
+
+
+def create_img_index(local_cli: LocalIndexClient, index_name: str = ES_INDEX, dims: int = VECTOR_DIMENSION) -> bool:
+    return local_cli.create_index(index_name, dims)
+
+
+def insert_img_doc_ops(local_cli: LocalIndexClient, index_name: str = ES_INDEX, codec: VectorCodec = None):
+    """
+    Insert image document to the local index
+    :param local_cli: local index client
+    :param index_name: index name
+    :param codec: vector codec of the features, None means float vectors
+    :param (img_key, img_url, bbox, bbox_score, label, features, id)
+    :return: true if insert successfully, false otherwise
+    """
+    insert_docs = insert_img_docs_ops(local_cli, index_name, codec)
+
+    def wrapper(img_key: str, img_url: str,
+                bbox: str, bbox_score: float, label: str,
+                features: np.ndarray, id: str = None) -> bool:
+        return insert_docs([(img_key, img_url, bbox, bbox_score, label, features, id)]) == 1
+
+    return wrapper
+
+
+def insert_img_docs_ops(local_cli: LocalIndexClient, index_name: str = ES_INDEX, codec: VectorCodec = None):
+    """
+    Insert image documents to the local index with one append of the vector and sidecar files
+    :param local_cli: local index client
+    :param index_name: index name
+    :param codec: vector codec of the features, None means float vectors
+    :param [(img_key, img_url, bbox, bbox_score, label, features, id)]
+    :return: number of documents inserted
+    """
+
+    def wrapper(records: list[(str, str, str, float, str, np.ndarray, str)]) -> int:
+        docs = [{
+            '_id': id,
+            '_source': {
+                'image_key': img_key,
+                'image_url': img_url,
+                'bbox': bbox,
+                'bbox_score': bbox_score,
+                'label': label,
+                'features': features if codec is None else codec.decode(features),
+            }
+        } for img_key, img_url, bbox, bbox_score, label, features, id in records]
+        return local_cli.insert_batch(index_name, docs)
+
+    return wrapper
+
+
+def knn_query_docs_ops(local_cli: LocalIndexClient, index_name: str = ES_INDEX, codec: VectorCodec = None):
+    def wrapper(vec: np.ndarray, k: int = 10, num_candidates: int = 100) -> list[(str, str, str, float, str, float)]:
+        """
+        Query documents from the local index
+        :param vec: query vector
+        :param k: k nearest neighbors
+        :param num_candidates: unused, the IVF lists to scan are set by VECTOR_STORE_NPROBE
+        :return: list of records: (image_key, image_url, bbox, bbox_score, label, score)
+        """
+        query = vec if codec is None else codec.decode(vec)
+        res = []
+        for doc, dot in local_cli.query(index_name, query, k):
+            res.append((
+                doc['image_key'],
+                doc['image_url'],
+                doc['bbox'],
+                doc['bbox_score'],
+                doc['label'],
+                (1.0 + dot) / 2.0,
+            ))
+        return res
+
+    return wrapper
+
+
+def rerank_docs_ops(local_cli: LocalIndexClient, index_name: str = ES_INDEX, codec: VectorCodec = None):
+    def wrapper(vec: np.ndarray, records: list[(str, str, str, float, str, float)],
+                k: int = 10) -> list[(str, str, str, float, str, float)]:
+        """
+        Rescore the candidates of an approximate search with the stored vectors of the local index
+        :param vec: query vector
+        :param records: candidate records: (image_key, image_url, bbox, bbox_score, label, score)
+        :param k: number of records to keep
+        :return: top k records, candidates without stored vector rank last with their first pass score
+        """
+        if len(records) == 0:
+            return []
+        query = np.asarray(vec, dtype=np.float32) if codec is None else codec.decode(vec)
+        found, vectors = local_cli.get_vectors(index_name, [record[0] for record in records])
+        scores = [record[5] for record in records]
+        exact = np.zeros(len(records), dtype=bool)
+        if len(found) > 0:
+            for i, dot in zip(found, vectors @ query):
+                scores[i] = (1.0 + float(dot)) / 2.0
+            exact[found] = True
+        # the scores of the two passes are not comparable, the exact ones come first
+        order = np.lexsort((-np.asarray(scores), ~exact))[:k]
+        return [records[i][:5] + (scores[i],) for i in order]
+
+    return wrapper
+
+
+def _dot_chunks(vectors: np.ndarray, vec: np.ndarray, count: int, chunk: int = 65536) -> np.ndarray:
+    """
+    Dot products of the query with all vectors, the mapped file is read in chunks
+    """
+    return np.concatenate([vectors[start:min(start + chunk, count)].astype(np.float32) @ vec
+                           for start in range(0, count, chunk)])
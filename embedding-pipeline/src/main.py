@@ -1,10 +1,88 @@
-from httpserver import start_http_server
+import sys
 
 
 def http_serve():
+    # imported here, so that spawned inference workers do not load the http server
+    from httpserver import start_http_server
+
     print('Start http service...')
     start_http_server()
 
 
+def caption_job(bucket_name: str, index_name: str = None):
+    from captioning import do_es_captioning
+    from config import ES_INDEX
+    from es_helpers import EsClient
+    from model import ClipcapCoco
+
+    count = do_es_captioning(bucket_name, ClipcapCoco(), EsClient(), index_name or ES_INDEX)
+    print(f'Caption {count} images of {bucket_name}')
+
+
+def milvus_load_job(bucket_name: str, table_name: str = None, incremental: str = 'true'):
+    from config import DEFAULT_TABLE
+    from embedding import do_milvus_embedding
+    from milvus_helpers import MilvusClient
+    from model import VitBase224
+    from mysql_helpers import MysqlClient
+
+    model = VitBase224()
+    try:
+        count = do_milvus_embedding(bucket_name, model, MilvusClient(), MysqlClient(), table_name or DEFAULT_TABLE,
+                                    incremental=incremental.lower() == 'true')
+    finally:
+        model.close()
+    print(f'Load {count} images of {bucket_name} to milvus')
+
+
+def sample_urls(bucket_name: str, count: int) -> list[str]:
+    from config import MINIO_PROXY_ENDPOINT
+    from embedding import list_object_names
+
+    return [f'http://{MINIO_PROXY_ENDPOINT}/file/{bucket_name}/{name}'
+            for name in list_object_names(bucket_name, count)]
+
+
+def fit_scale_job(bucket_name: str, count: str = '1000'):
+    from model import VitBase224, fit_vector_scale
+
+    scale = fit_vector_scale(VitBase224(cache_enabled=False), sample_urls(bucket_name, int(count)))
+    print(f'Fit int8 vector scale: {scale}, restart the service to use it')
+
+
+def onnx_parity_job(bucket_name: str, count: str = '20'):
+    import onnx_backend
+
+    # the model of the http service
+    urls = sample_urls(bucket_name, int(count))
+    print(f'Embedding parity: {onnx_backend.parity_report("vit_base_patch16_224", urls)}')
+    print(f'Detection parity: {onnx_backend.detection_parity_report(urls)}')
+
+
+def fit_projection_job(bucket_name: str, dim: str, count: str = '2000'):
+    from model import VitBase224, fit_projection
+
+    file_path = fit_projection(VitBase224(cache_enabled=False), sample_urls(bucket_name, int(count)), int(dim))
+    print(f'Fit projection to {dim} dims: {file_path}, restart the service with PROJECTION_ENABLED=true '
+          f'and load the buckets again, the indexes have the projected dimension')
+
+
 if __name__ == '__main__':
-    http_serve()
+    # python main.py caption <bucket> [index]
+    # python main.py load-milvus <bucket> [table] [incremental, true by default]
+    # python main.py fit-scale <bucket> [sample count]
+    # python main.py fit-projection <bucket> <dim> [sample count]
+    # python main.py onnx-parity <bucket> [sample count]
+    # otherwise start the http service
+    if len(sys.argv) > 2 and sys.argv[1] == 'caption':
+        caption_job(*sys.argv[2:4])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'load-milvus':
+        milvus_load_job(*sys.argv[2:5])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'fit-scale':
+        fit_scale_job(*sys.argv[2:4])
+    elif len(sys.argv) > 3 and sys.argv[1] == 'fit-projection':
+        fit_projection_job(*sys.argv[2:5])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'onnx-parity':
+        onnx_parity_job(*sys.argv[2:4])
+    else:
+        http_serve()
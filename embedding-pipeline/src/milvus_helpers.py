@@ -2,7 +2,8 @@ import sys
 
 from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility, SearchResult
 
-from config import MILVUS_HOST, MILVUS_PORT, VECTOR_DIMENSION, METRIC_TYPE, INDEX_TYPE, DEFAULT_TABLE, NLIST
+from config import MILVUS_HOST, MILVUS_PORT, VECTOR_DIMENSION, METRIC_TYPE, INDEX_TYPE, DEFAULT_TABLE, NLIST, VECTOR_TYPE
+from config import MILVUS_INSERT_BATCH
 from logger import LOGGER
 
 
@@ -29,7 +30,20 @@ class MilvusClient(object):
             return False
 
     def create_collection(self, collection_name: str = DEFAULT_TABLE,
-                          dim: int = VECTOR_DIMENSION) -> Collection:
+                          dim: int = VECTOR_DIMENSION,
+                          index: bool = True,
+                          drop: bool = True) -> Collection:
+        """
+        Create collection
+        :param collection_name: collection name in Milvus
+        :param dim: vector dimension
+        :param index: create the index now, bulk loads build it after the insertion instead
+        :param drop: drop the existing collection, otherwise it is kept for incremental loads
+        :return: collection object
+        """
+        if not drop and self.exist_collection(collection_name):
+            LOGGER.debug(f"Collection {collection_name} already exists")
+            return Collection(collection_name)
         if self.delete_collection(collection_name):
             LOGGER.debug(f"Successfully drop collection: {collection_name}")
 
@@ -42,7 +56,7 @@ class MilvusClient(object):
         schema = CollectionSchema(fields=fields, description='reverse image search')
         collection = Collection(name=collection_name, schema=schema)
 
-        if self.create_index(collection):
+        if not index or self.create_index(collection):
             LOGGER.debug(f"Successfully create collection: {collection_name}")
         return collection
 
@@ -54,6 +68,10 @@ class MilvusClient(object):
         :return: True if create index successfully, False otherwise
         """
         if index_params is None:
+            if VECTOR_TYPE != 'float32':
+                # milvus has no half or int8 vector field, choose IVF_SQ8 as INDEX_TYPE for a compact index
+                LOGGER.warning(f"Milvus stores float32 vectors, vector type {VECTOR_TYPE} is ignored, "
+                               f"index type: {INDEX_TYPE}")
             index_params = {
                 'metric_type': METRIC_TYPE,
                 'index_type': INDEX_TYPE,
@@ -62,11 +80,13 @@ class MilvusClient(object):
         collection.create_index(field_name='vec', index_params=index_params)
         return True
 
-    def insert_batch(self, collection_name: str, vectors: list[list[float]]) -> list[int]:
+    def insert_batch(self, collection_name: str, vectors: list[list[float]], load: bool = False) -> list[int]:
         """
         Insert vectors to Milvus
         :param collection_name: collection name in Milvus
         :param vectors: vectors to insert
+        :param load: load the collection after the insertion, a loaded collection
+            serves the new vectors without loading again
         :return: primary keys of vectors
         """
         try:
@@ -74,7 +94,8 @@ class MilvusClient(object):
             data = [vectors]
             mr = collection.insert(data)
             ids = mr.primary_keys
-            collection.load()
+            if load:
+                collection.load()
             LOGGER.debug(
                 f"Insert vectors to Milvus in collection: {collection_name} with {len(vectors)} rows")
             return ids
@@ -99,6 +120,22 @@ class MilvusClient(object):
             LOGGER.error(f"Failed to load data to Milvus: {e}")
             return -1
 
+    def load_collection(self, collection_name: str = DEFAULT_TABLE, index: bool = False) -> Collection:
+        """
+        Seal the inserted vectors and load the collection for search
+        :param collection_name: collection name in Milvus
+        :param index: build the index before loading, for collections created without index
+        :return: collection object
+        """
+        collection = self.get_collection(collection_name)
+        # num_entities seals the inserted segments in pymilvus 2.1
+        num = collection.num_entities
+        if index or not collection.has_index():
+            self.create_index(collection)
+            LOGGER.debug(f"Successfully build index of {num} rows: {collection_name}")
+        collection.load()
+        return collection
+
     def get_collection(self, collection_name: str) -> Collection:
         """
         Get collection by name
@@ -125,11 +162,21 @@ class MilvusClient(object):
     def search_vectors(self, collection_name: str = DEFAULT_TABLE, vectors: list[float] = None,
                        top_k: int = 10) -> SearchResult:
         # Search vector in milvus collection
+        return self.search_vectors_batch(collection_name, [vectors], top_k)
+
+    def search_vectors_batch(self, collection_name: str = DEFAULT_TABLE, vectors: list[list[float]] = None,
+                             top_k: int = 10) -> SearchResult:
+        """
+        Search many vectors in one request
+        :param collection_name: collection name in Milvus
+        :param vectors: query vectors
+        :param top_k: hits of each query vector
+        :return: search result, a hit list per query vector, None if failed
+        """
         try:
             collection = self.get_collection(collection_name)
             search_params = {"metric_type": METRIC_TYPE, "params": {"nprobe": 16}}
-            data = [vectors]
-            res = collection.search(data, anns_field="vec", param=search_params, limit=top_k)
+            res = collection.search(vectors, anns_field="vec", param=search_params, limit=top_k)
             LOGGER.debug(f"Successfully search in collection: {res}")
             return res
         except Exception as e:
@@ -144,14 +191,110 @@ def insert_milvus_ops(milvus_cli: MilvusClient, collection_name: str = DEFAULT_T
     return wrapper
 
 
+class MilvusBatchWriter(object):
+    """
+    Buffered writer of a collection, vectors are inserted in column batches and the ids of each
+    batch are passed to on_flush with the metadata of the vectors, eg: to insert the mysql rows.
+    The collection is loaded once by close.
+    """
+
+    def __init__(self, milvus_cli: MilvusClient, collection_name: str = DEFAULT_TABLE,
+                 on_flush: callable = None, batch_size: int = MILVUS_INSERT_BATCH):
+        """
+        :param milvus_cli: milvus client
+        :param collection_name: collection name in Milvus
+        :param on_flush: (ids, metas) -> None, called after each insert, the vectors are counted as failed if it raises
+        :param batch_size: max vectors of one insert
+        """
+        self.milvus_cli = milvus_cli
+        self.collection_name = collection_name
+        self.on_flush = on_flush
+        self.batch_size = max(1, batch_size)
+        self.vectors = []
+        self.metas = []
+        self.success_count = 0
+        self.failed_count = 0
+
+    def add(self, vector: list[float], meta=None):
+        """
+        Buffer vector, insert the buffer if it is full
+        :param vector: vector to insert
+        :param meta: metadata of the vector, passed to on_flush
+        """
+        self.add_batch([vector], [meta])
+
+    def add_batch(self, vectors: list[list[float]], metas: list = None):
+        """
+        Buffer vectors, they are inserted in the same batch
+        :param vectors: vectors to insert, eg: all objects of an image
+        :param metas: metadata of the vectors, passed to on_flush
+        """
+        self.vectors.extend(vectors)
+        self.metas.extend(metas if metas is not None else [None] * len(vectors))
+        if len(self.vectors) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Insert the buffered vectors
+        :return: number of vectors inserted
+        """
+        if len(self.vectors) == 0:
+            return 0
+        vectors, metas = self.vectors, self.metas
+        self.vectors, self.metas = [], []
+        try:
+            ids = self.milvus_cli.insert_batch(self.collection_name, vectors)
+        except Exception as e:
+            LOGGER.error(f"Failed to insert {len(vectors)} vectors: {e}")
+            self.failed_count += len(vectors)
+            return 0
+        if self.on_flush is not None:
+            try:
+                self.on_flush(ids, metas)
+            except Exception as e:
+                # the vectors are in the collection without their metadata
+                LOGGER.error(f"Failed to handle the insert of {len(ids)} vectors, orphaned ids: {list(ids)}: {e}")
+                self.failed_count += len(ids)
+                return 0
+        self.success_count += len(ids)
+        return len(ids)
+
+    def close(self, index: bool = False) -> int:
+        """
+        Insert the buffered vectors and load the collection
+        :param index: build the index before loading, for collections created without index
+        :return: number of vectors inserted by the writer
+        """
+        self.flush()
+        self.milvus_cli.load_collection(self.collection_name, index)
+        return self.success_count
+
+
 def search_milvus_ops(milvus_cli: MilvusClient, collection_name: str = DEFAULT_TABLE, top_k: int = 10) -> callable:
     def wrapper(vector: list[float]) -> list[(int, float)]:
         sr = milvus_cli.search_vectors(collection_name, vector, top_k)
         if sr is None:
             return []
-        res = []
-        for it in sr:
-            res.append((it[0].id, it[0].distance))
-        return res
+        # all top k hits of the query vector
+        return [(hit.id, hit.distance) for hit in sr[0]]
+
+    return wrapper
+
+
+def search_milvus_batch_ops(milvus_cli: MilvusClient, collection_name: str = DEFAULT_TABLE,
+                            top_k: int = 10) -> callable:
+    def wrapper(vectors: list[list[float]]) -> list[list[(int, float)]]:
+        """
+        Search many vectors in one request
+        :param vectors: query vectors
+        :return: (id, distance) hits of each query vector
+        """
+        if len(vectors) == 0:
+            return []
+        sr = milvus_cli.search_vectors_batch(collection_name, vectors, top_k)
+        if sr is None:
+            return [[] for _ in vectors]
+        return [[(hit.id, hit.distance) for hit in hits] for hits in sr]
 
     return wrapper
@@ -1,17 +1,44 @@
-from pydantic import BaseModel
+import numpy as np
 from towhee import pipe, ops, AutoConfig
-
+from towhee._types import Image
+
+import image_helper
+from config import (
+    DECODE_MIN_SIZE,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_ENABLED,
+    INFERENCE_BACKEND,
+    MAX_OBJECTS,
+    OBJECT_RANK,
+    SEARCH_IMAGE_CACHE_SIZE,
+    SEARCH_IMAGE_CACHE_TTL,
+    TEXT_EMBEDDING_CACHE_SIZE,
+    VECTOR_DIMENSION,
+)
+from embedding_cache import EmbeddingCache, LRUCache
 from logger import LOGGER
+from projection import load_projection, fit_pca, save_projection, project
+from vector_codec import VectorCodec, vector_json
+
 
+class BoundingBox(object):
+    __slots__ = ('box', 'label', 'score')
 
-class BoundingBox(BaseModel):
-    box: tuple[int, int, int, int]
-    label: str
-    score: float
+    def __init__(self, box: tuple[int, int, int, int], label: str, score: float):
+        self.box = tuple(int(item) for item in box)
+        self.label = label
+        self.score = float(score)
 
     def __str__(self):
         return f"box: {self.box}, label: {self.label}, score: {self.score}"
 
+    def __repr__(self):
+        return f"BoundingBox({self})"
+
+    def __eq__(self, other):
+        return (isinstance(other, BoundingBox) and self.box == other.box
+                and self.label == other.label and self.score == other.score)
+
     def to_dict(self):
         return {
             "box": list(self.box),
@@ -20,10 +47,16 @@ class BoundingBox(BaseModel):
         }
 
 
-class ObjectFeature(BaseModel):
-    url: str
-    bbox: BoundingBox
-    features: list[float]
+class ObjectFeature(object):
+    """
+    Features of a detected object, the vector is a numpy array until serialized
+    """
+    __slots__ = ('url', 'bbox', 'features')
+
+    def __init__(self, url: str, bbox: BoundingBox, features: np.ndarray = None):
+        self.url = url
+        self.bbox = bbox
+        self.features = features
 
     def to_dict(self) -> dict:
         """
@@ -33,7 +66,7 @@ class ObjectFeature(BaseModel):
         return {
             'url': self.url,
             'bbox': self.bbox.to_dict(),
-            'features': self.features
+            'features': vector_json(self.features)
         }
 
     def __str__(self):
@@ -42,24 +75,43 @@ class ObjectFeature(BaseModel):
 
 class ImageFeatureModel(object):
 
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, backend: str = INFERENCE_BACKEND,
+                 cache_enabled: bool = EMBEDDING_CACHE_ENABLED):
+        """
+        :param model_name: timm model name
+        :param backend: inference backend of detect and embed, torch or onnx
+        :param cache_enabled: cache primary features by image md5
+        """
         self.auto_config = AutoConfig.LocalCPUConfig()
         self.model_name = model_name
+        self.backend = backend
+        self.max_objects = MAX_OBJECTS
+        self.object_rank = OBJECT_RANK
+        self.decode_min_size = DECODE_MIN_SIZE
+
+        # operators created once, shared by the primary feature engine and the batch api
+        self.decode_op = ops.image_decode.cv2_rgb()
+        self.crop_op = ops.towhee.image_crop()
+        self.detect_op = _create_detect_op(backend)
+        self.embed_op = _create_embed_op(model_name, backend)
+        # optional pca after normalization, the stored vectors have the projected dimension
+        self.projection = load_projection(model_name)
+        self.dim = VECTOR_DIMENSION if self.projection is None else self.projection.shape[1]
+        self.codec = VectorCodec(model_name)
+
+        # primary feature cache keyed by image md5
+        self.cache = None
+        if cache_enabled:
+            self.cache = create_cache(model_name, backend, self.projection)
+        # decoded search images and their detections keyed by image md5, for searching a chosen box
+        self.image_cache = LRUCache(SEARCH_IMAGE_CACHE_SIZE, SEARCH_IMAGE_CACHE_TTL)
 
-        self.detect_pipeline = (
+        self.extract_pipeline = (
             pipe.input('url')
             .map('url', 'img', ops.image_decode.cv2_rgb())  # decode image
-            .flat_map('img', ('box', 'label', 'score'), ops.object_detection.yolo())  # detect object
-            .filter(('img', 'box', 'label', 'score'), ('img', 'box', 'label', 'score'),
-                    'score', lambda x: x > 0.5)
-        )  # detect pipeline for detect objects in image
-
-        self.extract_pipeline = (
-            self.detect_pipeline
-            .flat_map(('img', 'box'), 'object', ops.towhee.image_crop())  # crop object
+            # detect objects, crop them and extract features in one forward pass
+            .flat_map('img', ('box', 'label', 'score', 'vec'), self._detect_embed)
             .map('box', 'sbox', lambda x: ",".join(str(item) for item in x))  # box string
-            .map('object', 'vec', ops.image_embedding.timm(model_name=model_name))  # extract feature
-            .map('vec', 'vec', ops.towhee.np_normalize())
         )  # extract pipeline for extract features from objects
 
     def pipeline(self):
@@ -75,111 +127,400 @@ class ImageFeatureModel(object):
         :param url: url or local file path
         :return: object features
         """
-        p = (
-            self.pipeline()
-            .output('url', 'box', 'label', 'score', 'vec')
-        )
-        obj_feat_list = []
-        res = p(url)
-        if res.size == 0:
-            return obj_feat_list
-
-        for i in range(res.size):
-            it = res.get()
-            obj_feat = ObjectFeature(url=it[0],
-                                     bbox=BoundingBox(box=tuple(it[1]),
-                                                      label=it[2],
-                                                      score=it[3]),
-                                     features=it[4].tolist())
-            # append to list
-            obj_feat_list.append(obj_feat)
-            # take the first 3 objects
-            if i > 2:
-                break
-        return obj_feat_list
-
-    def extract_primary_features(self, url: str) -> (ObjectFeature, list[BoundingBox]):
+        # crops of all objects are embedded in one forward pass
+        return self.extract_features_batch([url])[0] or []
+
+    def extract_primary_features(self, url: str, content: bytes = None,
+                                 key: str = None) -> (ObjectFeature, list[BoundingBox]):
         """
         Extract feature from local file or url
         :param url: url or local file path
+        :param content: encoded image bytes of the url, decoded instead of fetching the url if given
+        :param key: md5 of the image content, looks up and fills the embedding cache if given
         :return: object features, candidate bbox list: (box, label, score)
         """
+        cached = cached_primary_features(self.cache, key, url, self.codec)
+        if cached is not None:
+            fill_search_image(self.image_cache, key, self.decode, url if content is None else content, cached)
+            return cached
+        img = self.decode(url if content is None else content)
+        if img is None:
+            return None, []
+        obj_feat, candidate_list = self.extract_primary_features_image(img, url)
+        cache_primary_features(self.cache, key, obj_feat, candidate_list, self.codec)
+        cache_search_image(self.image_cache, key, img, [obj_feat.bbox] + candidate_list)
+        return obj_feat, candidate_list
 
-        decode_p = (
-            pipe.input('url')
-            .map('url', 'img', ops.image_decode.cv2_rgb())  # decode image
-            .output('img')
-        )
+    def extract_primary_features_image(self, img: np.ndarray, url: str = '') -> (ObjectFeature, list[BoundingBox]):
+        """
+        Extract primary object feature from a decoded image
+        :param img: decoded RGB image
+        :param url: url of the image, only kept in the result
+        :return: object features, candidate bbox list: (box, label, score)
+        """
+        bbox, candidate_list = self._primary_bbox(img, url)
+        obj_feat = ObjectFeature(url=url, bbox=bbox, features=None)
+        vecs = self._embed_batch(self._crop(img, bbox.box))
+        if len(vecs) > 0:
+            obj_feat.features = self.codec.encode(vecs[0])
+        return obj_feat, candidate_list
+
+    def extract_objects_features(self, url: str, content: bytes = None, key: str = None) -> list[ObjectFeature]:
+        """
+        Extract features of the primary object and all the candidate objects
+        :param url: url or local file path
+        :param content: encoded image bytes of the url, decoded instead of fetching the url if given
+        :param key: md5 of the image content, fills the primary feature cache if given
+        :return: object features, the primary object first, empty if decode failed
+        """
+        img = self.decode(url if content is None else content)
+        if img is None:
+            return []
+        obj_feats = self.extract_objects_features_image(img, url)
+        if len(obj_feats) > 0:
+            cache_primary_features(self.cache, key, obj_feats[0], [item.bbox for item in obj_feats[1:]], self.codec)
+        cache_search_image(self.image_cache, key, img, [item.bbox for item in obj_feats])
+        return obj_feats
 
-        decode_res = decode_p(url)
-        if decode_res.size == 0:
-            return None, []
-        img = decode_res.get()[0]
-        full_height, full_width, _ = img.shape
-        detect_p = (
-            pipe.input('img')
-            .flat_map('img', ('box', 'label', 'score'), ops.object_detection.yolo())  # detect object
-            .output('box', 'label', 'score')
-        )
+    def extract_box_features(self, url: str, box: tuple[int, int, int, int], key: str = None) -> ObjectFeature:
+        """
+        Extract features of a box chosen in a searched image, reusing the cached image of the key
+        :param url: url of the searched image, decoded if the key is not cached
+        :param box: box in the coordinates of the full image
+        :param key: md5 of the image content
+        :return: object features of the box, labeled if it is a detected box, None if decode failed
+        """
+        img, bboxes = search_image(self.image_cache, key, self.decode, url)
+        if img is None:
+            return None
+        bbox = box_bbox(img, box, bboxes)
+        vecs = self._embed_batch(self._crop(img, bbox.box))
+        return ObjectFeature(url=url, bbox=bbox, features=self.codec.encode(vecs[0]) if len(vecs) > 0 else None)
+
+    def extract_objects_features_image(self, img: np.ndarray, url: str = '') -> list[ObjectFeature]:
+        """
+        Extract features of the primary object and the top max_objects - 1 candidates from a decoded image
+        :param img: decoded RGB image
+        :param url: url of the image, only kept in the result
+        :return: object features, the primary object first
+        """
+        bbox, candidate_list = self._primary_bbox(img, url)
+        if self.max_objects == 1:
+            candidate_list = []
+        elif self.max_objects > 1:
+            candidate_list = _select_bboxes(candidate_list, self.max_objects - 1, self.object_rank)
+        bboxes = [bbox] + candidate_list
+        crops = []
+        for item in bboxes:
+            crops.extend(self._crop(img, item.box))
+        vecs = self._embed_batch(crops, max(len(crops), 1))
+        return [ObjectFeature(url=url, bbox=item, features=self.codec.encode(vec)) for item, vec in zip(bboxes, vecs)]
+
+    def decode(self, src):
+        """
+        Decode image to RGB
+        :param src: url, local file path, encoded image bytes or decoded ndarray
+        :return: decoded RGB image, None if decode failed
+        """
+        return decode_image(self.decode_op, src, self.decode_min_size)
 
-        detect_res = detect_p(url)
-        box = [0, 0, 0 + full_width, 0 + full_height]
-        label = ''
-        score = 0.0
-        candidate_list = []
+    def extract_features_batch(self, urls: list[str],
+                               batch_size: int = EMBEDDING_BATCH_SIZE,
+                               contents: list[bytes] = None) -> list[list[ObjectFeature]]:
+        """
+        Extract features of detected objects for a batch of images
+        :param urls: url or local file path list
+        :param batch_size: max number of crops in one forward pass
+        :param contents: encoded image bytes of the urls, None items are fetched from the url
+        :return: object features of each image, in the same order as urls, None if the image failed to decode
+        """
+        if contents is None:
+            contents = [None] * len(urls)
+        imgs = [self.decode(url if content is None else content) for url, content in zip(urls, contents)]
+        return self.extract_features_images(imgs, urls, batch_size)
+
+    def extract_features_images(self, imgs: list[np.ndarray], urls: list[str],
+                                batch_size: int = EMBEDDING_BATCH_SIZE) -> list[list[ObjectFeature]]:
+        """
+        Extract features of detected objects for a batch of decoded images
+        :param imgs: decoded RGB images, None items are skipped
+        :param urls: urls of the images, only kept in the result
+        :param batch_size: max number of crops in one forward pass
+        :return: object features of each image, in the same order as imgs, None for the None images
+        """
+        crops, owners, bboxes = [], [], []
+        for i, img in enumerate(imgs):
+            if img is None:
+                continue
+            for bbox in self._detect(img):
+                crops.extend(self._crop(img, bbox.box))
+                owners.append(i)
+                bboxes.append(bbox)
+
+        vecs = self._embed_batch(crops, batch_size)
+        res = [None if img is None else [] for img in imgs]
+        for i, bbox, vec in zip(owners, bboxes, vecs):
+            res[i].append(ObjectFeature(url=urls[i], bbox=bbox, features=self.codec.encode(vec)))
+        return res
+
+    def extract_primary_features_batch(self, urls: list[str],
+                                       batch_size: int = EMBEDDING_BATCH_SIZE,
+                                       keys: list[str] = None,
+                                       contents: list[bytes] = None) -> list[(ObjectFeature, list[BoundingBox])]:
+        """
+        Extract primary object feature for a batch of images
+        :param urls: url or local file path list
+        :param batch_size: max number of crops in one forward pass
+        :param keys: md5 of the image contents, None items are not cached
+        :param contents: encoded image bytes of the urls, None items are fetched from the url
+        :return: (object feature, candidate bbox list) of each image, in the same order as urls
+        """
+        if keys is None:
+            keys = [None] * len(urls)
+        if contents is None:
+            contents = [None] * len(urls)
+        res = [(None, []) for _ in urls]
+        crops, owners = [], []
+        for i, url in enumerate(urls):
+            cached = cached_primary_features(self.cache, keys[i], url, self.codec)
+            if cached is not None:
+                fill_search_image(self.image_cache, keys[i], self.decode,
+                                  url if contents[i] is None else contents[i], cached)
+                res[i] = cached
+                continue
+            img = self.decode(url if contents[i] is None else contents[i])
+            if img is None:
+                continue
+            bbox, candidate_list = self._primary_bbox(img, url)
+            res[i] = (ObjectFeature(url=url, bbox=bbox, features=None), candidate_list)
+            cache_search_image(self.image_cache, keys[i], img, [bbox] + candidate_list)
+            crops.extend(self._crop(img, bbox.box))
+            owners.append(i)
+
+        vecs = self._embed_batch(crops, batch_size)
+        for i, vec in zip(owners, vecs):
+            res[i][0].features = self.codec.encode(vec)
+            cache_primary_features(self.cache, keys[i], *res[i], self.codec)
+        return res
+
+    def embed(self, crops: list[np.ndarray], batch_size: int = EMBEDDING_BATCH_SIZE) -> list[np.ndarray]:
+        """
+        Embed cropped images
+        :param crops: cropped RGB images
+        :param batch_size: max number of crops in one forward pass
+        :return: normalized vectors, in the same order as crops
+        """
+        return self._embed_batch(crops, batch_size)
 
-        if detect_res.size == 0:
+    def detect_crops(self, urls: list[str]) -> list:
+        """
+        Detect objects of the images and crop them, e.g. samples to fit the vector scale or projection
+        :param urls: url or local file path list
+        :return: cropped images of the detected objects, images failed to decode are skipped
+        """
+        crops = []
+        for url in urls:
+            img = self.decode(url)
+            if img is None:
+                continue
+            for bbox in self._detect(img):
+                crops.extend(self._crop(img, bbox.box))
+        return crops
+
+    def close(self):
+        """
+        Close the embedding cache of the model
+        """
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def _detect_embed(self, img) -> list[(list[int], str, float, np.ndarray)]:
+        """
+        Detect objects in the decoded image and embed all the crops in one forward pass
+        :param img: decoded image
+        :return: (box, label, score, vec) of each object
+        """
+        bboxes = self._detect(img)
+        crops = []
+        for bbox in bboxes:
+            crops.extend(self._crop(img, bbox.box))
+        vecs = self._embed_batch(crops, max(len(crops), 1))
+        return [(list(bbox.box), bbox.label, bbox.score, vec) for bbox, vec in zip(bboxes, vecs)]
+
+    def _primary_bbox(self, img, url: str = '') -> (BoundingBox, list[BoundingBox]):
+        """
+        Detect objects, the first is the primary object, the full image if nothing is detected
+        :param img: decoded image
+        :param url: url of the image, only for logging
+        :return: primary bbox, candidate bbox list
+        """
+        detected = _detect_bboxes(self.detect_op, img, threshold=None)
+        if len(detected) == 0:
             LOGGER.debug(f'No object detected of {url}')
-        else:
-            for i in range(detect_res.size):
-                detect_item = detect_res.get()
-                if i == 0:
-                    box, label, score = detect_item[0], detect_item[1], detect_item[2]
-                else:
-                    candidate_list.append(BoundingBox(box=detect_item[0],
-                                                      label=detect_item[1],
-                                                      score=detect_item[2]))
-
-        extract_p = (
-            pipe.input('img', 'box')
-            .flat_map(('img', 'box'), 'object', ops.towhee.image_crop())  # crop object
-            .map('box', 'sbox', lambda x: ",".join(str(item) for item in x))  # box string
-            .map('object', 'vec', ops.image_embedding.timm(model_name=self.model_name))  # extract feature
-            .map('vec', 'vec', ops.towhee.np_normalize())
-            .output('vec')
-        )
+            full_height, full_width = _full_size(img)
+            return BoundingBox(box=(0, 0, full_width, full_height), label='', score=0.0), []
+        return detected[0], detected[1:]
+
+    def _detect(self, img, threshold: float = 0.5) -> list[BoundingBox]:
+        """
+        Detect objects in the decoded image, keep the top max_objects ranked by object_rank
+        :param img: decoded image
+        :param threshold: min score of the objects, None means no filter
+        :return: bbox list
+        """
+        return _select_bboxes(_detect_bboxes(self.detect_op, img, threshold), self.max_objects, self.object_rank)
 
-        extract_res = extract_p(img, box)
-        bbox = BoundingBox(box=tuple(box), label=label, score=score)
-        if extract_res.size == 0:
-            return ObjectFeature(url=url, bbox=bbox, features=None), candidate_list
+    def _crop(self, img, box: tuple[int, int, int, int]) -> list:
+        return _crop_box(self.crop_op, img, box)
 
-        extract_item = extract_res.get()
-        return ObjectFeature(url=url, bbox=bbox, features=extract_item[0].tolist()), candidate_list
+    def _embed_batch(self, crops: list, batch_size: int = EMBEDDING_BATCH_SIZE) -> list[np.ndarray]:
+        """
+        Embed crops with stacked forward passes, L2 normalize and project the vectors
+        :param crops: cropped images
+        :param batch_size: max number of crops in one forward pass
+        :return: normalized vectors, in the same order as crops
+        """
+        return project(_embed_normalized(self.embed_op, crops, batch_size), self.projection)
 
 
 class Resnet50(ImageFeatureModel):
 
-    def __init__(self):
-        super().__init__('resnet50')
+    def __init__(self, backend: str = INFERENCE_BACKEND, cache_enabled: bool = EMBEDDING_CACHE_ENABLED):
+        super().__init__('resnet50', backend, cache_enabled)
 
 
 class VitTiny224(ImageFeatureModel):
 
-    def __init__(self):
-        super().__init__('vit_tiny_patch16_224')
+    def __init__(self, backend: str = INFERENCE_BACKEND, cache_enabled: bool = EMBEDDING_CACHE_ENABLED):
+        super().__init__('vit_tiny_patch16_224', backend, cache_enabled)
 
 
 class VitBase224(ImageFeatureModel):
 
-    def __init__(self):
-        super().__init__('vit_base_patch16_224')
+    def __init__(self, backend: str = INFERENCE_BACKEND, cache_enabled: bool = EMBEDDING_CACHE_ENABLED):
+        super().__init__('vit_base_patch16_224', backend, cache_enabled)
+
+
+class MultiObjectFeature(object):
+    __slots__ = ('url', 'bbox', 'features')
+
+    def __init__(self, url: str, bbox: BoundingBox, features: dict[str, np.ndarray]):
+        self.url = url
+        self.bbox = bbox
+        self.features = features
+
+    def to_dict(self) -> dict:
+        """
+        Convert MultiObjectFeature to dict
+        :return:  dict
+        """
+        return {
+            'url': self.url,
+            'bbox': self.bbox.to_dict(),
+            'features': {name: vector_json(vec) for name, vec in self.features.items()}
+        }
+
+    def __str__(self):
+        return self.to_dict().__str__()
+
+
+class MultiHeadFeatureModel(object):
+    """
+    Detect and crop objects once, then embed the crops with several timm models
+    """
+
+    def __init__(self, model_names: list[str], backend: str = INFERENCE_BACKEND):
+        """
+        :param model_names: timm model names of the embedding heads
+        :param backend: inference backend of detect and embed, torch or onnx
+        """
+        self.auto_config = AutoConfig.LocalCPUConfig()
+        self.model_names = model_names
+        self.backend = backend
+        self.max_objects = MAX_OBJECTS
+        self.object_rank = OBJECT_RANK
+        self.decode_min_size = DECODE_MIN_SIZE
+
+        self.decode_op = ops.image_decode.cv2_rgb()
+        self.detect_op = _create_detect_op(backend)
+        self.crop_op = ops.towhee.image_crop()
+        self.embed_ops = {name: _create_embed_op(name, backend) for name in model_names}
+
+        vec_columns = tuple(f'vec{i}' for i in range(len(model_names)))
+        self.extract_pipeline = (
+            pipe.input('url')
+            .map('url', 'img', ops.image_decode.cv2_rgb())  # decode image
+            # detect objects once, crops are embedded by each head in one forward pass
+            .flat_map('img', ('box', 'label', 'score') + vec_columns, self._detect_embed)
+            .map('box', 'sbox', lambda x: ",".join(str(item) for item in x))  # box string
+        )
+
+    def pipeline(self):
+        """
+        Get feature pipeline, vector columns follow the order of model_names
+        :return: pipeline: output('url', 'box', 'label', 'score', 'vec0', 'vec1', ...)
+        """
+        return self.extract_pipeline
+
+    def extract_features(self, url: str) -> list[MultiObjectFeature]:
+        """
+        Extract features of each model from local file or url
+        :param url: url or local file path
+        :return: object features, a vector per model per box
+        """
+        return self.extract_features_batch([url])[0]
+
+    def extract_features_batch(self, urls: list[str],
+                               batch_size: int = EMBEDDING_BATCH_SIZE) -> list[list[MultiObjectFeature]]:
+        """
+        Extract features of each model for a batch of images, objects are detected once
+        :param urls: url or local file path list
+        :param batch_size: max number of crops in one forward pass
+        :return: object features of each image, in the same order as urls
+        """
+        crops, owners, bboxes = [], [], []
+        for i, url in enumerate(urls):
+            img = decode_image(self.decode_op, url, self.decode_min_size)
+            if img is None:
+                continue
+            for bbox in self._detect(img):
+                crops.extend(_crop_box(self.crop_op, img, bbox.box))
+                owners.append(i)
+                bboxes.append(bbox)
+
+        head_vecs = {name: _embed_normalized(op, crops, batch_size) for name, op in self.embed_ops.items()}
+        res = [[] for _ in urls]
+        for j, (i, bbox) in enumerate(zip(owners, bboxes)):
+            features = {name: vecs[j] for name, vecs in head_vecs.items()}
+            res[i].append(MultiObjectFeature(url=urls[i], bbox=bbox, features=features))
+        return res
+
+    def _detect_embed(self, img) -> list[tuple]:
+        """
+        Detect objects in the decoded image and embed all the crops with each head
+        :param img: decoded image
+        :return: (box, label, score, vec0, vec1, ...) of each object
+        """
+        bboxes = self._detect(img)
+        crops = []
+        for bbox in bboxes:
+            crops.extend(_crop_box(self.crop_op, img, bbox.box))
+        batch_size = max(len(crops), 1)
+        head_vecs = [_embed_normalized(self.embed_ops[name], crops, batch_size) for name in self.model_names]
+        return [(list(bbox.box), bbox.label, bbox.score) + tuple(vecs[j] for vecs in head_vecs)
+                for j, bbox in enumerate(bboxes)]
+
+    def _detect(self, img) -> list[BoundingBox]:
+        return _select_bboxes(_detect_bboxes(self.detect_op, img), self.max_objects, self.object_rank)
 
 
 class ImageCaptioning(object):
 
     def __init__(self, op: callable = ops.image_captioning.clipcap(model_name='clipcap_coco')):
         self.auto_config = AutoConfig.LocalCPUConfig()
+        self.op = op
+        self.decode_op = ops.image_decode.cv2_rgb()
         self.pipeline = (
             pipe.input('url')
             .map('url', 'img', ops.image_decode.cv2_rgb())  # decode image
@@ -198,6 +539,25 @@ class ImageCaptioning(object):
             return ''
         return res.get()[0]
 
+    def generate_captions(self, imgs: list) -> list[str]:
+        """
+        Generate captions of many images, the caption operators take a single image per call
+        :param imgs: urls, local file paths or decoded images
+        :return: captions, in the same order as imgs, empty if decode or captioning failed
+        """
+        captions = []
+        for img in imgs:
+            decoded = decode_image(self.decode_op, img)
+            if decoded is None:
+                captions.append('')
+                continue
+            try:
+                captions.append(self.op(decoded))
+            except Exception as e:
+                LOGGER.error(f'Caption image failed: {e}')
+                captions.append('')
+        return captions
+
 
 class ClipcapCoco(ImageCaptioning):
 
@@ -217,8 +577,14 @@ class ImageText(object):
                  img_op: callable = ops.image_text_embedding.clip(model_name='clip_vit_base_patch16',
                                                                   modality='image'),
                  text_op: callable = ops.image_text_embedding.clip(model_name='clip_vit_base_patch16',
-                                                                   modality='text')):
+                                                                   modality='text'),
+                 text_cache_size: int = TEXT_EMBEDDING_CACHE_SIZE):
         self.auto_config = AutoConfig.LocalCPUConfig()
+        self.img_op = img_op
+        self.text_op = text_op
+        self.decode_op = ops.image_decode.cv2_rgb()
+        # text queries repeat a lot, their normalized vectors are kept in a LRU cache
+        self.text_cache = LRUCache(text_cache_size)
         self.img_pipe = (
             pipe.input('url')
             .map('url', 'img', ops.image_decode.cv2_rgb())
@@ -255,20 +621,67 @@ class ImageText(object):
             return []
         return res.get()[0].tolist()
 
+    def generate_image_embeddings(self, imgs: list,
+                                  batch_size: int = EMBEDDING_BATCH_SIZE) -> list[np.ndarray]:
+        """
+        Generate image embeddings of many images, the decoded images are passed to the operator in batches
+        :param imgs: urls, local file paths, encoded image bytes or decoded images
+        :param batch_size: max number of images in one operator call
+        :return: normalized vectors, in the same order as imgs, None if decode or embedding failed
+        """
+        decoded = [decode_image(self.decode_op, img) for img in imgs]
+        owners = [i for i, img in enumerate(decoded) if img is not None]
+        res = [None] * len(imgs)
+        for start in range(0, len(owners), batch_size):
+            batch = owners[start:start + batch_size]
+            try:
+                vecs = self.img_op([decoded[i] for i in batch])
+            except Exception as e:
+                LOGGER.error(f'Embed {len(batch)} images failed: {e}')
+                continue
+            # the clip operator returns a single vector for a single image
+            if len(batch) == 1:
+                vecs = [vecs]
+            for i, vec in zip(batch, _normalize(vecs)):
+                res[i] = vec
+        return res
+
     def generate_text_embedding(self, text: str) -> (list[float]):
         """
         Generate text embedding from
         :param text: text
         :return: text embedding
         """
-        p = (
-            self.text_pipeline()
-            .output('vec')
-        )
-        res = p(text)
-        if res.size == 0:
+        vecs = self.generate_text_embeddings([text])
+        if vecs[0] is None:
             return []
-        return res.get()[0].tolist()
+        return vecs[0].tolist()
+
+    def generate_text_embeddings(self, texts: list[str],
+                                 batch_size: int = EMBEDDING_BATCH_SIZE) -> list[np.ndarray]:
+        """
+        Generate text embeddings of many queries, cached vectors are reused
+        :param texts: texts
+        :param batch_size: max number of texts in one operator call
+        :return: normalized vectors, in the same order as texts, None if embedding failed
+        """
+        res = [self.text_cache.get(text) for text in texts]
+        missed = list(dict.fromkeys(text for text, vec in zip(texts, res) if vec is None))
+        embedded = {}
+        for start in range(0, len(missed), batch_size):
+            batch = missed[start:start + batch_size]
+            try:
+                vecs = self.text_op(batch)
+            except Exception as e:
+                LOGGER.error(f'Embed texts {batch} failed: {e}')
+                continue
+            # the clip operator returns a single vector for a single text
+            if len(batch) == 1:
+                vecs = [vecs]
+            for text, vec in zip(batch, _normalize(vecs)):
+                embedded[text] = vec
+                self.text_cache.put(text, vec)
+        return [vec if vec is not None else embedded.get(text) for text, vec in zip(texts, res)]
 
 
 class ClipVitBasePatch16(ImageText):
@@ -280,6 +693,314 @@ class ClipVitBasePatch16(ImageText):
                                                                modality='text'))
 
 
+def decode_image(decode_op: callable, src, min_size: int = 0):
+    """
+    Decode image to RGB
+    :param decode_op: decode operator of urls and local file paths
+    :param src: url, local file path, encoded image bytes or decoded ndarray
+    :param min_size: min short side of reduced jpeg decode, 0 means full size
+    :return: decoded RGB image, None if decode failed
+    """
+    if isinstance(src, Image):
+        return src
+    try:
+        if isinstance(src, np.ndarray):
+            return Image(src, 'RGB')
+        if isinstance(src, str) and min_size > 0:
+            src = image_helper.read_bytes(src)
+        if isinstance(src, (bytes, bytearray)):
+            if min_size > 0:
+                rgb, scale = image_helper.load_reduced_rgb_from_bytes(src, min_size)
+                return scaled_image(rgb, scale)
+            img = image_helper.load_rgb_from_bytes(src)
+            return None if img is None else Image(img, 'RGB')
+        return decode_op(src)
+    except Exception as e:
+        LOGGER.error(f'Decode image {src if isinstance(src, str) else type(src)} failed: {e}')
+        return None
+
+
+def scaled_image(data: np.ndarray, scale: float = 1.0) -> Image:
+    """
+    Wrap RGB data of a reduced decode
+    :param data: RGB data
+    :param scale: scale of the full image size to the data size
+    :return: image
+    """
+    img = Image(data, 'RGB')
+    img.decode_scale = scale
+    return img
+
+
+def image_scale(img) -> float:
+    """
+    Scale of the full image size to the decoded size
+    :param img: decoded image
+    :return: scale, 1.0 if decoded at full size
+    """
+    return getattr(img, 'decode_scale', 1.0)
+
+
+def create_cache(model_name: str, backend: str = INFERENCE_BACKEND, projection: np.ndarray = None) -> EmbeddingCache:
+    """
+    Create primary feature cache of the model, named by backend, projection and object config
+    :param model_name: timm model name
+    :param backend: inference backend
+    :param projection: projection matrix of the vectors, the fitted projection of the model if None
+    :return: embedding cache
+    """
+    name = model_name if backend == 'torch' else f'{model_name}.{backend}'
+    if projection is None:
+        projection = load_projection(model_name)
+    if projection is not None:
+        name = f'{name}.pca{projection.shape[1]}'
+    name = f'{name}.top{MAX_OBJECTS}-{OBJECT_RANK}.min{DECODE_MIN_SIZE}'
+    return EmbeddingCache(name)
+
+
+def cached_primary_features(cache: EmbeddingCache, key: str, url: str = '',
+                            codec: VectorCodec = None) -> (ObjectFeature, list[BoundingBox]):
+    """
+    Get primary features from the cache
+    :param cache: embedding cache, None means no cache
+    :param key: md5 of the image content, None means no cache
+    :param url: url of the image, only kept in the result
+    :param codec: vector codec of the features, None means float list
+    :return: object features, candidate bbox list, None if missed
+    """
+    if cache is None or key is None:
+        return None
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    meta, vec = entry
+    LOGGER.debug(f'Embedding cache hit of {key}, url: {url}')
+    features = vec if codec is None else codec.encode(vec)
+    return (ObjectFeature(url=url, bbox=BoundingBox(**meta['bbox']), features=features),
+            [BoundingBox(**item) for item in meta['candidates']])
+
+
+def cache_primary_features(cache: EmbeddingCache, key: str,
+                           obj_feat: ObjectFeature, candidate_list: list[BoundingBox],
+                           codec: VectorCodec = None):
+    """
+    Put primary features to the cache, vectors are cached as float32
+    :param cache: embedding cache, None means no cache
+    :param key: md5 of the image content, None means no cache
+    :param obj_feat: primary object features
+    :param candidate_list: candidate bbox list
+    :param codec: vector codec of the features, None means float list
+    """
+    if cache is None or key is None or obj_feat is None or obj_feat.features is None:
+        return
+    meta = {
+        'bbox': obj_feat.bbox.to_dict(),
+        'candidates': [item.to_dict() for item in candidate_list],
+    }
+    vec = np.asarray(obj_feat.features, dtype=np.float32) if codec is None else codec.decode(obj_feat.features)
+    cache.put(key, meta, vec)
+
+
+def cache_search_image(image_cache: LRUCache, key: str, img, bboxes: list[BoundingBox]):
+    """
+    Keep the decoded search image and its detections for searching a chosen box
+    :param image_cache: search image cache
+    :param key: md5 of the image content, None means no cache
+    :param img: decoded image
+    :param bboxes: detected bbox list
+    """
+    if key is None:
+        return
+    image_cache.put(key, (img, bboxes))
+
+
+def fill_search_image(image_cache: LRUCache, key: str, decode: callable, src,
+                      cached: (ObjectFeature, list[BoundingBox])):
+    """
+    Keep the search image of an embedding cache hit with the cached detections
+    :param image_cache: search image cache
+    :param key: md5 of the image content, None means no cache
+    :param decode: decode function of the src
+    :param src: url or encoded image bytes
+    :param cached: cached primary features: object features, candidate bbox list
+    """
+    if key is None or image_cache.get(key) is not None:
+        return
+    img = decode(src)
+    if img is not None:
+        obj_feat, candidate_list = cached
+        cache_search_image(image_cache, key, img, [obj_feat.bbox] + candidate_list)
+
+
+def search_image(image_cache: LRUCache, key: str, decode: callable, url: str) -> (object, list[BoundingBox]):
+    """
+    Get the decoded search image and its detections, the url is decoded and cached if missed
+    :param image_cache: search image cache
+    :param key: md5 of the image content, None means no cache
+    :param decode: decode function of the url
+    :param url: url of the image
+    :return: decoded image, None if decode failed, detected bbox list, empty if missed
+    """
+    cached = image_cache.get(key) if key is not None else None
+    if cached is not None:
+        return cached
+    img = decode(url)
+    if img is not None:
+        cache_search_image(image_cache, key, img, [])
+    return img, []
+
+
+def box_bbox(img, box: tuple[int, int, int, int], bboxes: list[BoundingBox]) -> BoundingBox:
+    """
+    Bbox of a chosen box, the detected bbox if the box is one of them
+    :param img: decoded image
+    :param box: box in the coordinates of the full image
+    :param bboxes: detected bbox list
+    :return: bbox clipped to the image
+    :raise ValueError: the box is outside the image
+    """
+    box = tuple(int(item) for item in box)
+    for bbox in bboxes:
+        if bbox.box == box:
+            return bbox
+    height, width = _full_size(img)
+    x1, y1, x2, y2 = max(0, box[0]), max(0, box[1]), min(width, box[2]), min(height, box[3])
+    if x1 >= x2 or y1 >= y2:
+        raise ValueError(f'box {box} is outside the image of {width}x{height}')
+    return BoundingBox(box=(x1, y1, x2, y2), label='', score=0.0)
+
+
+def _create_detect_op(backend: str = INFERENCE_BACKEND) -> callable:
+    if backend == 'onnx':
+        # onnxruntime, ultralytics and the export dependencies are only loaded for the onnx backend
+        import onnx_backend
+        return onnx_backend.OnnxYoloDetector()
+    return ops.object_detection.yolo()
+
+
+def _create_embed_op(model_name: str, backend: str = INFERENCE_BACKEND) -> callable:
+    if backend == 'onnx':
+        import onnx_backend
+        return onnx_backend.OnnxTimmEmbedding(model_name)
+    return ops.image_embedding.timm(model_name=model_name)
+
+
+def _detect_bboxes(detect_op: callable, img, threshold: float = 0.5) -> list[BoundingBox]:
+    """
+    Detect objects in the decoded image
+    :param detect_op: detect operator, returns (box, label, score) of each object
+    :param img: decoded image
+    :param threshold: min score of the objects, None means no filter
+    :return: bbox list
+    """
+    scale = image_scale(img)
+    bboxes = []
+    for box, label, score in detect_op(img):
+        if threshold is not None and score <= threshold:
+            continue
+        if scale != 1.0:
+            box = [int(round(item * scale)) for item in box]
+        bboxes.append(BoundingBox(box=tuple(box), label=label, score=score))
+    return bboxes
+
+
+def _crop_box(crop_op: callable, img, box: tuple[int, int, int, int]) -> list:
+    """
+    Crop the box from the decoded image
+    :param crop_op: crop operator
+    :param img: decoded image
+    :param box: box in the coordinates of the full image
+    :return: cropped images
+    """
+    scale = image_scale(img)
+    if scale != 1.0:
+        box = [int(round(item / scale)) for item in box]
+    return list(crop_op(img, list(box)))
+
+
+def _full_size(img) -> (int, int):
+    height, width = img.shape[:2]
+    scale = image_scale(img)
+    return int(round(height * scale)), int(round(width * scale))
+
+
+def _select_bboxes(bboxes: list[BoundingBox], max_objects: int = MAX_OBJECTS,
+                   rank: str = OBJECT_RANK) -> list[BoundingBox]:
+    """
+    Rank the objects and keep the top ones, so only they are cropped and embedded
+    :param bboxes: detected bbox list
+    :param max_objects: number of objects to keep, 0 means no limit
+    :param rank: rank by score or area
+    :return: top bbox list
+    """
+    if rank == 'area':
+        bboxes = sorted(bboxes, key=lambda b: -(b.box[2] - b.box[0]) * (b.box[3] - b.box[1]))
+    else:
+        bboxes = sorted(bboxes, key=lambda b: -b.score)
+    if max_objects > 0:
+        return bboxes[:max_objects]
+    return bboxes
+
+
+def _embed_normalized(embed_op: callable, crops: list, batch_size: int = EMBEDDING_BATCH_SIZE) -> list[np.ndarray]:
+    """
+    Embed crops with stacked forward passes and L2 normalize the vectors
+    :param embed_op: embedding operator, takes a list of images
+    :param crops: cropped images
+    :param batch_size: max number of crops in one forward pass
+    :return: normalized vectors, in the same order as crops
+    """
+    vecs = []
+    for start in range(0, len(crops), batch_size):
+        vecs.extend(_normalize(embed_op(crops[start:start + batch_size])))
+    return vecs
+
+
+def _normalize(vecs: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    L2 normalize vectors
+    :param vecs: vectors of the same dimension
+    :return: normalized float32 vectors
+    """
+    batch = np.stack(vecs).astype(np.float32)
+    norms = np.linalg.norm(batch, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return list(batch / norms)
+
+
+def fit_vector_scale(model: ImageFeatureModel, urls: list[str], percentile: float = 99.9) -> float:
+    """
+    Fit the int8 vector scale of the model to the objects of sample images
+    :param model: model
+    :param urls: sample image urls or local file paths
+    :param percentile: percentile of absolute values mapped to 127
+    :return: int8 scale
+    """
+    return model.codec.fit(model.embed(model.detect_crops(urls)), percentile)
+
+
+def fit_projection(model: ImageFeatureModel, urls: list[str], dim: int) -> str:
+    """
+    Fit the pca projection of the model to the objects of sample images, the model uses it from then on
+    :param model: model
+    :param urls: sample image urls or local file paths, more objects than dim
+    :param dim: projected dimension, e.g. 128 or 256
+    :return: artifact path
+    """
+    # fit on the unprojected vectors
+    vecs = _embed_normalized(model.embed_op, model.detect_crops(urls))
+    matrix = fit_pca(vecs, dim)
+    file_path = save_projection(model.model_name, matrix)
+    model.projection = matrix
+    model.dim = dim
+    if model.codec.vector_type == 'int8':
+        model.codec.fit(project(vecs, matrix))
+    if model.cache is not None:
+        model.cache.close()
+        model.cache = create_cache(model.model_name, model.backend, matrix)
+    return file_path
+
+
 def extract_features_ops(model: ImageFeatureModel) -> callable:
     """
     Extract feature from local file or url
@@ -287,7 +1008,7 @@ def extract_features_ops(model: ImageFeatureModel) -> callable:
     :return: (sbox, label, score, features)
     """
 
-    def wrapper(url: str) -> (str, str, float, list[float]):
+    def wrapper(url: str) -> (str, str, float, np.ndarray):
         obj_feat, candidate_boxes = model.extract_primary_features(url)
         if obj_feat is None:
             return '', '', 0.0, []
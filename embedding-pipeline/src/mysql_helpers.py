@@ -1,6 +1,9 @@
+import os
+import tempfile
+
 import pymysql
 
-from config import MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PWD, MYSQL_DB, DEFAULT_TABLE
+from config import MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PWD, MYSQL_DB, DEFAULT_TABLE, MYSQL_LOAD_DATA_ROWS
 from logger import LOGGER
 
 
@@ -22,8 +25,8 @@ class MysqlClient(object):
                                         database=MYSQL_DB, local_infile=True)
             self.cursor = self.conn.cursor()
 
-    def create_table(self, table_name: str = DEFAULT_TABLE):
-        # Create mysql table if not exists
+    def create_table(self, table_name: str = DEFAULT_TABLE, drop: bool = True):
+        # Create mysql table if not exists, the existing table is dropped unless incremental loads keep it
         self.test_connection()
         sql = """
         CREATE TABLE IF NOT EXISTS {}(
@@ -37,9 +40,10 @@ class MysqlClient(object):
         );
         """.format(table_name)
         try:
-            drop_sql = f"DROP TABLE IF EXISTS {table_name};"
-            self.cursor.execute(drop_sql)
-            LOGGER.debug(f"MYSQL delete table:{table_name}")
+            if drop:
+                drop_sql = f"DROP TABLE IF EXISTS {table_name};"
+                self.cursor.execute(drop_sql)
+                LOGGER.debug(f"MYSQL delete table:{table_name}")
             self.cursor.execute(sql)
             LOGGER.debug(f"MYSQL create table: {table_name} with sql: {sql}")
         except Exception as e:
@@ -64,6 +68,59 @@ class MysqlClient(object):
             LOGGER.error(f"MYSQL ERROR: {e} with sql: {add_data}")
             return False
 
+    def insert_batch(self, rows: list[(int, str, str, float, str)], table_name: str = DEFAULT_TABLE) -> int:
+        """
+        Insert rows with executemany in one transaction, rows of existing (image_key, box) are skipped
+        :param rows: [(id, image_key, box, score, label)]
+        :param table_name: table name
+        :return: number of rows inserted
+        """
+        if len(rows) == 0:
+            return 0
+        self.test_connection()
+        sql = ("INSERT IGNORE INTO {} "
+               "(id, image_key, box, score, label) "
+               "VALUES (%s, %s, %s, %s, %s)".format(table_name))
+        try:
+            count = self.cursor.executemany(sql, rows)
+            self.conn.commit()
+            LOGGER.debug(f"MYSQL insert {count} rows to table: {table_name}")
+            return count
+        except Exception as e:
+            self.conn.rollback()
+            LOGGER.error(f"MYSQL ERROR: {e} with sql: {sql}")
+            return 0
+
+    def load_data(self, rows: list[(int, str, str, float, str)], table_name: str = DEFAULT_TABLE) -> int:
+        """
+        Load rows through a tsv file with LOAD DATA LOCAL INFILE, for very large batches,
+        rows of existing (image_key, box) are skipped
+        :param rows: [(id, image_key, box, score, label)]
+        :param table_name: table name
+        :return: number of rows loaded
+        """
+        if len(rows) == 0:
+            return 0
+        self.test_connection()
+        fd, path = tempfile.mkstemp(suffix='.tsv')
+        sql = ("LOAD DATA LOCAL INFILE %s INTO TABLE {} "
+               "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+               "(id, image_key, box, score, label)".format(table_name))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for row in rows:
+                    f.write('\t'.join(_tsv_field(field) for field in row) + '\n')
+            count = self.cursor.execute(sql, (path,))
+            self.conn.commit()
+            LOGGER.debug(f"MYSQL load {count} rows to table: {table_name}")
+            return count
+        except Exception as e:
+            self.conn.rollback()
+            LOGGER.error(f"MYSQL ERROR: {e} with sql: {sql}")
+            return 0
+        finally:
+            os.remove(path)
+
     def scan_table(self, table_name: str = DEFAULT_TABLE):
         # Scan mysql table
         self.test_connection()
@@ -134,6 +191,21 @@ class MysqlClient(object):
             LOGGER.error(f"MYSQL ERROR: {e} with sql: {sql}")
             raise Exception("MYSQL ERROR: {} with sql: {}".format(e, sql))
 
+    def image_keys(self, table_name: str = DEFAULT_TABLE) -> set[str]:
+        """
+        Distinct image keys of the table, read from the idx_image_key index
+        :param table_name: table name
+        :return: image keys
+        """
+        self.test_connection()
+        sql = f"select distinct image_key from {table_name};"
+        try:
+            self.cursor.execute(sql)
+            return set(row[0] for row in self.cursor.fetchall())
+        except Exception as e:
+            LOGGER.error(f"MYSQL ERROR: {e} with sql: {sql}")
+            raise Exception("MYSQL ERROR: {} with sql: {}".format(e, sql))
+
     def records_by_ids(self, ids: list[int],
                        table_name: str = DEFAULT_TABLE) -> list[(int, str, str, float, str)]:
         """
@@ -142,6 +214,8 @@ class MysqlClient(object):
         :param table_name: table name
         :return: records: [(id, image_key, box, score, label)]
         """
+        if len(ids) == 0:
+            return []
         self.test_connection()
         sql = """select id, image_key, box, score, label 
             from  {}
@@ -168,6 +242,24 @@ def insert_mysql_ops(mysql_cli: MysqlClient, table_name: str = DEFAULT_TABLE) ->
     return wrapper
 
 
+def insert_mysql_batch_ops(mysql_cli: MysqlClient, table_name: str = DEFAULT_TABLE,
+                           load_data_rows: int = MYSQL_LOAD_DATA_ROWS) -> callable:
+    def wrapper(rows: list[(int, str, str, float, str)]) -> int:
+        """
+        Insert rows in one transaction
+        :param rows: [(id, image_key, box, score, label)]
+        :return: number of rows inserted
+        """
+        if 0 < load_data_rows <= len(rows):
+            count = mysql_cli.load_data(rows, table_name)
+            # the server may have local_infile disabled, the load is rolled back then
+            if count > 0:
+                return count
+        return mysql_cli.insert_batch(rows, table_name)
+
+    return wrapper
+
+
 def query_mysql_batch_ops(mysql_cli: MysqlClient, table_name: str = DEFAULT_TABLE) -> callable:
     def wrapper(ids: list[int]) -> list[(int, str, str, float, str)]:
         return mysql_cli.records_by_ids(ids, table_name)
@@ -183,3 +275,10 @@ def query_mysql_ops(mysql_cli: MysqlClient, table_name: str = DEFAULT_TABLE) ->
         return details[0]
 
     return wrapper
+
+
+def _tsv_field(value) -> str:
+    # escape the characters of the default LOAD DATA format
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
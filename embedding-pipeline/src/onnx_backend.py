@@ -0,0 +1,272 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+import timm
+import torch
+from PIL import Image as PILImage
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from towhee import ops
+from ultralytics import YOLO
+
+from config import (
+    YOLO_MODEL,
+    ONNX_MODEL_PATH,
+    ONNX_QUANTIZE,
+    ONNX_INTRA_OP_THREADS,
+)
+from logger import LOGGER
+
+
+def create_session(onnx_path: str, intra_op_threads: int = ONNX_INTRA_OP_THREADS):
+    """
+    Create onnxruntime CPU session
+    :param onnx_path: onnx model path
+    :param intra_op_threads: intra op thread count, 0 means onnxruntime default
+    :return: inference session
+    """
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads > 0:
+        so.intra_op_num_threads = intra_op_threads
+    LOGGER.debug(f"Create onnxruntime session of {onnx_path}, intra op threads: {intra_op_threads}")
+    return ort.InferenceSession(onnx_path, sess_options=so, providers=['CPUExecutionProvider'])
+
+
+def quantize(onnx_path: str) -> str:
+    """
+    Int8 dynamic quantization of onnx model
+    :param onnx_path: float32 onnx model path
+    :return: quantized onnx model path
+    """
+    int8_path = onnx_path.replace('.onnx', '.int8.onnx')
+    if not os.path.exists(int8_path):
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+        LOGGER.info(f"Quantize onnx model {onnx_path} to {int8_path}")
+    return int8_path
+
+
+def export_timm(model_name: str, output_dir: str = ONNX_MODEL_PATH, int8: bool = ONNX_QUANTIZE) -> str:
+    """
+    Export timm embedding model to onnx, the graph outputs the same features as ops.image_embedding.timm
+    :param model_name: timm model name
+    :param output_dir: output directory
+    :param int8: quantize the model with int8 dynamic quantization
+    :return: onnx model path
+    """
+    onnx_path = os.path.join(output_dir, f'{model_name}.onnx')
+    if not os.path.exists(onnx_path):
+        os.makedirs(output_dir, exist_ok=True)
+        model = timm.create_model(model_name, pretrained=True)
+        model.eval()
+        size = timm.data.resolve_data_config({}, model=model)['input_size']
+        dummy = torch.randn(1, *size)
+        torch.onnx.export(_TimmFeatures(model), dummy, onnx_path,
+                          input_names=['input'], output_names=['features'],
+                          dynamic_axes={'input': {0: 'batch'}, 'features': {0: 'batch'}},
+                          opset_version=14)
+        LOGGER.info(f"Export timm model {model_name} to {onnx_path}")
+    if int8:
+        return quantize(onnx_path)
+    return onnx_path
+
+
+def export_yolo(weights: str = YOLO_MODEL, output_dir: str = ONNX_MODEL_PATH, int8: bool = ONNX_QUANTIZE) -> str:
+    """
+    Export ultralytics yolo detector to onnx, class names are saved to a sidecar json file
+    :param weights: yolo weights name or path
+    :param output_dir: output directory
+    :param int8: quantize the model with int8 dynamic quantization
+    :return: onnx model path
+    """
+    name = os.path.splitext(os.path.basename(weights))[0]
+    onnx_path = os.path.join(output_dir, f'{name}.onnx')
+    if not os.path.exists(onnx_path):
+        os.makedirs(output_dir, exist_ok=True)
+        model = YOLO(weights)
+        exported = model.export(format='onnx', dynamic=True)
+        os.replace(exported, onnx_path)
+        with open(_names_path(onnx_path), 'w') as f:
+            json.dump({int(k): v for k, v in model.names.items()}, f)
+        LOGGER.info(f"Export yolo model {weights} to {onnx_path}")
+    if int8:
+        return quantize(onnx_path)
+    return onnx_path
+
+
+class OnnxTimmEmbedding(object):
+    """
+    Drop-in replacement of ops.image_embedding.timm running on onnxruntime
+    """
+
+    def __init__(self, model_name: str, int8: bool = ONNX_QUANTIZE,
+                 intra_op_threads: int = ONNX_INTRA_OP_THREADS):
+        self.model_name = model_name
+        self.session = create_session(export_timm(model_name, int8=int8), intra_op_threads)
+        # preprocess the same way as the timm operator
+        data_config = timm.data.resolve_data_config({}, model=timm.create_model(model_name, pretrained=False))
+        self.transform = timm.data.create_transform(**data_config)
+
+    def __call__(self, data):
+        imgs = data if isinstance(data, list) else [data]
+        if len(imgs) == 0:
+            return []
+        inputs = np.stack([self.transform(PILImage.fromarray(np.asarray(img))).numpy() for img in imgs])
+        features = self.session.run(None, {'input': inputs.astype(np.float32)})[0]
+        if isinstance(data, list):
+            return list(features)
+        return features[0]
+
+
+class OnnxYoloDetector(object):
+    """
+    Yolo detector running on onnxruntime, returns (box, label, score) of each object
+    like ops.object_detection.yolo
+    """
+
+    def __init__(self, weights: str = YOLO_MODEL, int8: bool = ONNX_QUANTIZE,
+                 intra_op_threads: int = ONNX_INTRA_OP_THREADS,
+                 input_size: int = 640, conf_threshold: float = 0.25, iou_threshold: float = 0.45):
+        onnx_path = export_yolo(weights, int8=False)
+        with open(_names_path(onnx_path)) as f:
+            self.names = {int(k): v for k, v in json.load(f).items()}
+        if int8:
+            onnx_path = quantize(onnx_path)
+        self.session = create_session(onnx_path, intra_op_threads)
+        self.input_size = input_size
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+
+    def __call__(self, img: np.ndarray) -> list[(list[int], str, float)]:
+        height, width = img.shape[:2]
+        scale = self.input_size / max(height, width)
+        new_w, new_h = int(round(width * scale)), int(round(height * scale))
+        pad_w, pad_h = (self.input_size - new_w) // 2, (self.input_size - new_h) // 2
+
+        # letterbox to a square input
+        canvas = np.full((self.input_size, self.input_size, 3), 114, dtype=np.uint8)
+        canvas[pad_h:pad_h + new_h, pad_w:pad_w + new_w] = cv2.resize(np.asarray(img), (new_w, new_h))
+        inputs = canvas.transpose(2, 0, 1)[np.newaxis].astype(np.float32) / 255.0
+
+        # output: (1, 4 + num_classes, num_anchors), boxes are (cx, cy, w, h)
+        pred = self.session.run(None, {self.session.get_inputs()[0].name: inputs})[0][0].T
+        class_ids = pred[:, 4:].argmax(axis=1)
+        scores = pred[np.arange(len(pred)), 4 + class_ids]
+        keep = scores > self.conf_threshold
+        pred, class_ids, scores = pred[keep], class_ids[keep], scores[keep]
+
+        xywh = pred[:, :4].copy()
+        xywh[:, 0] = (pred[:, 0] - pred[:, 2] / 2 - pad_w) / scale
+        xywh[:, 1] = (pred[:, 1] - pred[:, 3] / 2 - pad_h) / scale
+        xywh[:, 2:] = pred[:, 2:4] / scale
+        indices = cv2.dnn.NMSBoxes(xywh.tolist(), scores.tolist(), self.conf_threshold, self.iou_threshold)
+
+        res = []
+        for i in sorted(np.array(indices).flatten(), key=lambda j: -scores[j]):
+            x, y, w, h = xywh[i]
+            box = [max(0, int(x)), max(0, int(y)), min(width, int(x + w)), min(height, int(y + h))]
+            res.append((box, self.names.get(int(class_ids[i]), str(class_ids[i])), float(scores[i])))
+        return res
+
+
+def parity_report(model_name: str, urls: list[str], int8: bool = ONNX_QUANTIZE) -> dict:
+    """
+    Compare the onnx embedding vectors with the pytorch vectors of ops.image_embedding.timm
+    :param model_name: timm model name
+    :param urls: sample image urls or local file paths
+    :param int8: compare against the int8 quantized model
+    :return: report: {'model_name', 'int8', 'count', 'min', 'mean', 'p5'} of cosine similarities
+    """
+    decode_op = ops.image_decode.cv2_rgb()
+    torch_op = ops.image_embedding.timm(model_name=model_name)
+    onnx_op = OnnxTimmEmbedding(model_name, int8=int8)
+
+    sims = []
+    for url in urls:
+        try:
+            img = decode_op(url)
+        except Exception as e:
+            LOGGER.error(f"Decode image {url} failed: {e}")
+            continue
+        torch_vec = np.asarray(torch_op(img), dtype=np.float32)
+        onnx_vec = np.asarray(onnx_op(img), dtype=np.float32)
+        sims.append(float(np.dot(torch_vec, onnx_vec) /
+                          (np.linalg.norm(torch_vec) * np.linalg.norm(onnx_vec))))
+
+    report = {'model_name': model_name, 'int8': int8, 'count': len(sims)}
+    if len(sims) > 0:
+        report.update({
+            'min': float(np.min(sims)),
+            'mean': float(np.mean(sims)),
+            'p5': float(np.percentile(sims, 5)),
+        })
+    LOGGER.info(f"Onnx parity report: {report}")
+    return report
+
+
+def detection_parity_report(urls: list[str], weights: str = YOLO_MODEL,
+                            iou_threshold: float = 0.5, score_threshold: float = 0.5) -> dict:
+    """
+    Compare the detections of the onnx yolo detector with ops.object_detection.yolo,
+    a pytorch box is matched if an onnx box of the same label overlaps it by iou_threshold
+    :param urls: sample image urls or local file paths
+    :param weights: ultralytics weights of the onnx detector
+    :param iou_threshold: min iou of a matched box
+    :param score_threshold: min score of the compared boxes, like the detect of the model
+    :return: report: {'count', 'torch_boxes', 'onnx_boxes', 'matched', 'recall'}
+    """
+    decode_op = ops.image_decode.cv2_rgb()
+    torch_op = ops.object_detection.yolo()
+    onnx_op = OnnxYoloDetector(weights, int8=False)
+
+    report = {'count': 0, 'torch_boxes': 0, 'onnx_boxes': 0, 'matched': 0}
+    for url in urls:
+        try:
+            img = decode_op(url)
+        except Exception as e:
+            LOGGER.error(f"Decode image {url} failed: {e}")
+            continue
+        torch_boxes = [(box, label) for box, label, score in torch_op(img) if score > score_threshold]
+        onnx_boxes = [(box, label) for box, label, score in onnx_op(img) if score > score_threshold]
+        report['count'] += 1
+        report['torch_boxes'] += len(torch_boxes)
+        report['onnx_boxes'] += len(onnx_boxes)
+        for box, label in torch_boxes:
+            if any(label == other_label and _iou(box, other) >= iou_threshold for other, other_label in onnx_boxes):
+                report['matched'] += 1
+    report['recall'] = report['matched'] / report['torch_boxes'] if report['torch_boxes'] > 0 else 1.0
+    LOGGER.info(f"Onnx detection parity report: {report}")
+    return report
+
+
+class _TimmFeatures(torch.nn.Module):
+    """
+    Wrap a timm model to output the pooled features like the timm operator:
+    class token of transformers, global average pooling of conv nets
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        features = self.model.forward_features(x)
+        if features.dim() == 3:
+            features = features[:, 0]
+        if features.dim() == 4:
+            features = features.mean(dim=(2, 3))
+        return features
+
+
+def _names_path(onnx_path: str) -> str:
+    return onnx_path.replace('.onnx', '.names.json')
+
+
+def _iou(a: list[int], b: list[int]) -> float:
+    inter_w = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    inter_h = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
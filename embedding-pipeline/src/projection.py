@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+from config import PROJECTION_ENABLED, PROJECTION_PATH, VECTOR_DIMENSION
+from logger import LOGGER
+
+
+def projection_path(model_name: str, path: str = PROJECTION_PATH) -> str:
+    return os.path.join(path, f'{model_name}.npy')
+
+
+def load_projection(model_name: str, path: str = PROJECTION_PATH,
+                    enabled: bool = PROJECTION_ENABLED) -> np.ndarray:
+    """
+    Load the projection matrix of the model
+    :param model_name: model name
+    :param path: directory of the projection artifacts
+    :param enabled: projection enabled or not
+    :return: (dim + 1, k) matrix, the last row is the bias, None if disabled or not fitted
+    """
+    if not enabled:
+        return None
+    file_path = projection_path(model_name, path)
+    if not os.path.exists(file_path):
+        LOGGER.warning(f"Projection of {model_name} is not fitted, {file_path} not found")
+        return None
+    matrix = np.load(file_path).astype(np.float32)
+    LOGGER.info(f"Load projection of {model_name}: {matrix.shape[0] - 1} -> {matrix.shape[1]} dims")
+    return matrix
+
+
+def vector_dimension(model_name: str, default: int = VECTOR_DIMENSION) -> int:
+    """
+    Dimension of the stored vectors of the model
+    :param model_name: model name
+    :param default: dimension without projection
+    :return: projected dimension if the projection is enabled and fitted, default otherwise
+    """
+    matrix = load_projection(model_name)
+    return default if matrix is None else matrix.shape[1]
+
+
+def fit_pca(vecs: list[np.ndarray], dim: int) -> np.ndarray:
+    """
+    Fit PCA projection of normalized vectors
+    :param vecs: sample vectors, more samples than dim
+    :param dim: projected dimension
+    :return: (input dim + 1, dim) matrix, the last row is the bias
+    """
+    samples = np.stack(vecs).astype(np.float64)
+    if len(samples) < dim:
+        raise ValueError(f"Need at least {dim} samples to fit {dim} dims, got {len(samples)}")
+    mean = samples.mean(axis=0)
+    _, s, vt = np.linalg.svd(samples - mean, full_matrices=False)
+    components = vt[:dim].T
+    explained = float((s[:dim] ** 2).sum() / (s ** 2).sum())
+    LOGGER.info(f"Fit pca {samples.shape[1]} -> {dim} dims, explained variance: {explained:.4f}")
+    return np.vstack([components, -mean @ components]).astype(np.float32)
+
+
+def save_projection(model_name: str, matrix: np.ndarray, path: str = PROJECTION_PATH) -> str:
+    os.makedirs(path, exist_ok=True)
+    file_path = projection_path(model_name, path)
+    np.save(file_path, matrix)
+    return file_path
+
+
+def project(vecs: list[np.ndarray], matrix: np.ndarray) -> list[np.ndarray]:
+    """
+    Project normalized vectors and L2 normalize them again
+    :param vecs: normalized vectors
+    :param matrix: projection matrix, None means no projection
+    :return: projected normalized vectors
+    """
+    if matrix is None or len(vecs) == 0:
+        return vecs
+    batch = np.stack(vecs) @ matrix[:-1] + matrix[-1]
+    norms = np.linalg.norm(batch, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return list((batch / norms).astype(np.float32))
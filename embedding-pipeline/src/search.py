@@ -1,22 +1,28 @@
-from pydantic import BaseModel
-from towhee import pipe
+import numpy as np
 
 from config import (
+    CLIP_ES_INDEX,
     DEFAULT_TABLE,
     ES_INDEX,
+    RERANK_CANDIDATES,
+    TOP_K,
 )
-from es_helpers import EsClient, knn_query_docs_ops
+from es_helpers import EsClient, knn_query_docs_ops, knn_msearch_docs_ops, knn_query_clip_ops
+from local_helpers import LocalIndexClient, knn_query_docs_ops as local_knn_query_docs_ops
 from logger import LOGGER
-from milvus_helpers import MilvusClient, search_milvus_ops
-from model import ImageFeatureModel, ObjectFeature, BoundingBox
-from mysql_helpers import MysqlClient, query_mysql_ops
+from milvus_helpers import MilvusClient, search_milvus_batch_ops
+from model import ImageFeatureModel, ImageText, ObjectFeature, BoundingBox
+from mysql_helpers import MysqlClient, query_mysql_batch_ops
 
 
-class SearchResult(BaseModel):
-    image_key: str
-    box: str
-    label: str
-    score: float
+class SearchResult(object):
+    __slots__ = ('image_key', 'box', 'label', 'score')
+
+    def __init__(self, image_key: str, box: str, label: str, score: float):
+        self.image_key = image_key
+        self.box = box
+        self.label = label
+        self.score = float(score)
 
     def __str__(self):
         return f"image_key: {self.image_key}, box: {self.box}, label: {self.label}, score: {self.score}"
@@ -34,7 +40,9 @@ def do_milvus_search(img_url: str,
                      model: ImageFeatureModel,
                      milvus_client: MilvusClient,
                      mysql_cli: MysqlClient,
-                     table_name: str = DEFAULT_TABLE) -> (ObjectFeature, list[BoundingBox], list[SearchResult]):
+                     table_name: str = DEFAULT_TABLE,
+                     img_content: bytes = None,
+                     img_key: str = None) -> (ObjectFeature, list[BoundingBox], list[SearchResult]):
     """
     Search similar images for the given image.
     :param img_url: given image path
@@ -42,66 +50,226 @@ def do_milvus_search(img_url: str,
     :param milvus_client: milvus client
     :param mysql_cli: mysql client
     :param table_name: table name
-    :return: list of similar images: [(image_url, similarity), ...]
+    :param img_content: encoded image bytes of img_url, saves fetching the image again
+    :param img_key: md5 of the image content, for the embedding cache
+    :return: object features, candidate bbox list, similar images
     """
-    obj_feat, candidate_box = model.extract_primary_features(img_url)
+    obj_feat, candidate_box = model.extract_primary_features(img_url, img_content, img_key)
     if obj_feat is None:
         return None, candidate_box, []
     if obj_feat.features is None:
         return obj_feat, candidate_box, []
 
-    p_search_pre = (
-        pipe.input('vec')
-        .flat_map('vec', ('vec_id', 'distance'), search_milvus_ops(milvus_client, table_name, 10))
-        .map('vec_id', ('id', 'image_key', 'box', 'score', 'label'), query_mysql_ops(mysql_cli, table_name))
-        .output('image_key', 'box', 'label', 'distance')
-    )
-
-    res = p_search_pre(obj_feat.features)
-    size = res.size
-    LOGGER.info(f"Search result size: {size}")
-    if size == 0:
-        return obj_feat, []
-    res_list = []
-    for i in range(size):
-        it = res.get()
-        search_res = SearchResult(image_key=it[0], box=it[1], label=it[2], score=it[3])
-        res_list.append(search_res)
+    vec = model.codec.decode(obj_feat.features).tolist()
+    hits = search_milvus_batch_ops(milvus_client, table_name, TOP_K)([vec])[0]
+    res_list = milvus_search_results([hits], mysql_cli, table_name)[0]
+    LOGGER.info(f"Search result size: {len(res_list)}")
     return obj_feat, candidate_box, res_list
 
 
+def do_milvus_multi_search(img_url: str,
+                           model: ImageFeatureModel,
+                           milvus_client: MilvusClient,
+                           mysql_cli: MysqlClient,
+                           table_name: str = DEFAULT_TABLE,
+                           img_content: bytes = None,
+                           img_key: str = None) -> list[(ObjectFeature, list[SearchResult])]:
+    """
+    Search similar images for every object of the given image, crops of all the objects are embedded
+    in one batch and searched with one multi-vector milvus request
+    :param img_url: given image path
+    :param model: model instance
+    :param milvus_client: milvus client
+    :param mysql_cli: mysql client
+    :param table_name: table name
+    :param img_content: encoded image bytes of img_url, saves fetching the image again
+    :param img_key: md5 of the image content, for the embedding cache
+    :return: (object features, similar images) of each object, the primary object first
+    """
+    obj_feats = model.extract_objects_features(img_url, img_content, img_key)
+    vecs = [model.codec.decode(obj_feat.features).tolist() for obj_feat in obj_feats]
+    hits_list = search_milvus_batch_ops(milvus_client, table_name, TOP_K)(vecs)
+    return list(zip(obj_feats, milvus_search_results(hits_list, mysql_cli, table_name)))
+
+
+def milvus_search_results(hits_list: list[list[(int, float)]],
+                          mysql_cli: MysqlClient,
+                          table_name: str = DEFAULT_TABLE) -> list[list[SearchResult]]:
+    """
+    Resolve the metadata of milvus hits with one mysql query
+    :param hits_list: (vector id, distance) list of each query vector
+    :param mysql_cli: mysql client
+    :param table_name: table name
+    :return: similar images of each query vector, in the order of the hits
+    """
+    ids = list(dict.fromkeys(vec_id for hits in hits_list for vec_id, _ in hits))
+    records = {record[0]: record for record in query_mysql_batch_ops(mysql_cli, table_name)(ids)}
+    res = []
+    for hits in hits_list:
+        res_list = []
+        for vec_id, distance in hits:
+            record = records.get(vec_id)
+            if record is None:
+                continue
+            _, image_key, box, _, label = record
+            res_list.append(SearchResult(image_key=image_key, box=box, label=label, score=distance))
+        res.append(res_list)
+    return res
+
+
 def do_es_search(img_url: str,
                  model: ImageFeatureModel,
                  es_cli: EsClient,
-                 index_name: str = ES_INDEX) -> (ObjectFeature, list[BoundingBox], list[SearchResult]):
-    obj_feat, candidate_box = model.extract_primary_features(img_url)
+                 index_name: str = ES_INDEX,
+                 img_content: bytes = None,
+                 img_key: str = None,
+                 rerank: callable = None) -> (ObjectFeature, list[BoundingBox], list[SearchResult]):
+    obj_feat, candidate_box = model.extract_primary_features(img_url, img_content, img_key)
+    return es_search_features(obj_feat, candidate_box, es_cli, index_name, rerank)
+
+
+def es_search_features(obj_feat: ObjectFeature,
+                       candidate_box: list[BoundingBox],
+                       es_cli: EsClient,
+                       index_name: str = ES_INDEX,
+                       rerank: callable = None) -> (ObjectFeature, list[BoundingBox], list[SearchResult]):
+    """
+    Search similar images with extracted primary features
+    :param obj_feat: primary object features
+    :param candidate_box: candidate bbox list
+    :param es_cli: es client
+    :param index_name: index name
+    :param rerank: local_helpers.rerank_docs_ops, rescore a wider first pass with the exact vectors
+    :return: object features, candidate bbox list, similar images
+    """
     if obj_feat is None:
         return None, candidate_box, []
     if obj_feat.features is None:
         return obj_feat, candidate_box, []
 
-    p_search_pre = (
-        pipe.input('vec').
-        filter(('vec',), ('vec',), 'vec', lambda x: x is not None and len(x) > 0).
-        map('vec', 'k', lambda x: 10).
-        map('vec', 'candidates', lambda x: 20).
-        flat_map(('vec', 'k', 'candidates'),
-                 ('image_key', 'image_url', 'bbox', 'bbox_score', 'label', 'score'),
-                 knn_query_docs_ops(es_cli, index_name)).
-        filter(('image_url', 'bbox', 'label', 'score'),
-               ('image_url', 'bbox', 'label', 'score'),
-               'score', lambda x: x > 0.65).
-        output('image_url', 'bbox', 'label', 'score')
-    )
-
-    res = p_search_pre(obj_feat.features)
-    size = res.size
-    LOGGER.info(f"Search result size: {size}")
-    if size == 0:
-        return obj_feat, []
-    res_list = []
-    for i in range(size):
-        it = res.get()
-        search_res = SearchResult(image_key=it[0], box=it[1], label=it[2], score=it[3])
-        res_list.append(search_res)
+    if len(obj_feat.features) == 0:
+        return obj_feat, candidate_box, []
+
+    # query with the vector buffer directly, it is only serialized in the es request
+    if rerank is None:
+        hits = knn_query_docs_ops(es_cli, index_name)(obj_feat.features, 10, 20)
+    else:
+        candidates = knn_query_docs_ops(es_cli, index_name)(obj_feat.features,
+                                                            RERANK_CANDIDATES, 2 * RERANK_CANDIDATES)
+        hits = rerank(obj_feat.features, candidates, 10)
+    res_list = _es_search_results(hits)
+    LOGGER.info(f"Search result size: {len(res_list)}")
     return obj_feat, candidate_box, res_list
+
+
+def do_es_multi_search(img_url: str,
+                       model: ImageFeatureModel,
+                       es_cli: EsClient,
+                       index_name: str = ES_INDEX,
+                       img_content: bytes = None,
+                       img_key: str = None,
+                       rerank: callable = None) -> list[(ObjectFeature, list[SearchResult])]:
+    """
+    Search similar images for every object of the given image
+    :param img_url: given image path
+    :param model: model instance
+    :param es_cli: es client
+    :param index_name: index name
+    :param img_content: encoded image bytes of img_url, saves fetching the image again
+    :param img_key: md5 of the image content, for the embedding cache
+    :param rerank: local_helpers.rerank_docs_ops, rescore a wider first pass with the exact vectors
+    :return: (object features, similar images) of each object, the primary object first
+    """
+    obj_feats = model.extract_objects_features(img_url, img_content, img_key)
+    return es_multi_search_features(obj_feats, es_cli, index_name, rerank)
+
+
+def es_multi_search_features(obj_feats: list[ObjectFeature],
+                             es_cli: EsClient,
+                             index_name: str = ES_INDEX,
+                             rerank: callable = None) -> list[(ObjectFeature, list[SearchResult])]:
+    """
+    Search similar images of many objects with one es multi search request
+    :param obj_feats: object features
+    :param es_cli: es client
+    :param index_name: index name
+    :param rerank: local_helpers.rerank_docs_ops, rescore a wider first pass with the exact vectors
+    :return: (object features, similar images) of each object with features
+    """
+    obj_feats = [obj_feat for obj_feat in obj_feats if obj_feat.features is not None and len(obj_feat.features) > 0]
+    vecs = [obj_feat.features for obj_feat in obj_feats]
+    if rerank is None:
+        hits_list = knn_msearch_docs_ops(es_cli, index_name)(vecs, 10, 20)
+    else:
+        candidates_list = knn_msearch_docs_ops(es_cli, index_name)(vecs, RERANK_CANDIDATES, 2 * RERANK_CANDIDATES)
+        hits_list = [rerank(vec, candidates, 10) for vec, candidates in zip(vecs, candidates_list)]
+    res = [(obj_feat, _es_search_results(hits)) for obj_feat, hits in zip(obj_feats, hits_list)]
+    LOGGER.info(f"Multi search result size: {[len(res_list) for _, res_list in res]}")
+    return res
+
+
+def do_local_search(img_url: str,
+                    model: ImageFeatureModel,
+                    local_cli: LocalIndexClient,
+                    index_name: str = ES_INDEX,
+                    img_content: bytes = None,
+                    img_key: str = None) -> (ObjectFeature, list[BoundingBox], list[SearchResult]):
+    """
+    Search similar images in the in-process local index
+    :param img_url: given image path
+    :param model: model instance
+    :param local_cli: local index client
+    :param index_name: index name
+    :param img_content: encoded image bytes of img_url, saves fetching the image again
+    :param img_key: md5 of the image content, for the embedding cache
+    :return: object features, candidate bbox list, similar images
+    """
+    obj_feat, candidate_box = model.extract_primary_features(img_url, img_content, img_key)
+    if obj_feat is None:
+        return None, candidate_box, []
+    if obj_feat.features is None or len(obj_feat.features) == 0:
+        return obj_feat, candidate_box, []
+
+    hits = local_knn_query_docs_ops(local_cli, index_name, model.codec)(obj_feat.features, 10)
+    res_list = _es_search_results(hits)
+    LOGGER.info(f"Search result size: {len(res_list)}")
+    return obj_feat, candidate_box, res_list
+
+
+def _es_search_results(hits: list[(str, str, str, float, str, float)]) -> list[SearchResult]:
+    return [SearchResult(image_key=image_url, box=bbox, label=label, score=score)
+            for _, image_url, bbox, _, label, score in hits if score > 0.65]
+
+
+def do_es_text_search(text: str,
+                      model: ImageText,
+                      es_cli: EsClient,
+                      index_name: str = CLIP_ES_INDEX) -> list[SearchResult]:
+    """
+    Search images of the clip index by text
+    :param text: query text
+    :param model: clip image text model
+    :param es_cli: es client
+    :param index_name: clip index name
+    :return: similar images
+    """
+    vec = model.generate_text_embeddings([text])[0]
+    return es_text_search_features(vec, es_cli, index_name)
+
+
+def es_text_search_features(vec: np.ndarray,
+                            es_cli: EsClient,
+                            index_name: str = CLIP_ES_INDEX) -> list[SearchResult]:
+    """
+    Search images of the clip index with an embedded text query
+    :param vec: normalized clip text vector, None if embedding failed
+    :param es_cli: es client
+    :param index_name: clip index name
+    :return: similar images
+    """
+    if vec is None:
+        return []
+    hits = knn_query_clip_ops(es_cli, index_name)(vec, 10, 100)
+    res_list = [SearchResult(image_key=image_url, box='', label='', score=score) for _, image_url, score in hits]
+    LOGGER.info(f"Text search result size: {len(res_list)}")
+    return res_list
@@ -0,0 +1,54 @@
+import threading
+
+from batcher import MicroBatcher
+
+
+def test_micro_batcher():
+    batch_sizes = []
+
+    def batch_fn(requests: list[int]) -> list[int]:
+        batch_sizes.append(len(requests))
+        return [x * 2 for x in requests]
+
+    batcher = MicroBatcher(batch_fn, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(10)]
+    results = [future.result() for future in futures]
+    batcher.close()
+    print(batch_sizes)
+    assert results == [i * 2 for i in range(10)]
+    assert max(batch_sizes) <= 4
+    assert len(batch_sizes) < 10
+
+
+def test_micro_batcher_error():
+    def batch_fn(requests: list[int]) -> list[int]:
+        raise ValueError('failed')
+
+    batcher = MicroBatcher(batch_fn, max_batch_size=4, max_wait_ms=1)
+    future = batcher.submit(1)
+    assert isinstance(future.exception(), ValueError)
+    batcher.close()
+
+
+def test_micro_batcher_results_mismatch():
+    batcher = MicroBatcher(lambda requests: requests[:1], max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(4)]
+    # every future of the batch fails, none is left pending
+    assert all(isinstance(future.exception(timeout=5), ValueError) for future in futures)
+    batcher.close()
+
+
+def test_micro_batcher_concurrent():
+    batcher = MicroBatcher(lambda requests: requests, max_batch_size=8, max_wait_ms=20)
+    results = {}
+
+    def call(i: int):
+        results[i] = batcher.submit(i).result()
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+    assert results == {i: i for i in range(16)}
@@ -0,0 +1,30 @@
+import threading
+
+from checkpoint import Checkpoint
+
+
+def test_resume(tmp_path):
+    checkpoint = Checkpoint('test_job', path=str(tmp_path))
+    checkpoint.add(['a.jpg', 'b.jpg'])
+    checkpoint.add(['b.jpg', 'c.jpg'])
+    assert len(checkpoint) == 3
+
+    resumed = Checkpoint('test_job', path=str(tmp_path))
+    assert 'a.jpg' in resumed
+    assert 'c.jpg' in resumed
+    assert 'd.jpg' not in resumed
+
+    resumed.reset()
+    assert len(Checkpoint('test_job', path=str(tmp_path))) == 0
+
+
+def test_concurrent_add(tmp_path):
+    checkpoint = Checkpoint('test_job', path=str(tmp_path))
+    threads = [threading.Thread(target=checkpoint.add, args=([f'{i}-{j}.jpg' for j in range(50)],))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(checkpoint) == 400
+    assert len(Checkpoint('test_job', path=str(tmp_path))) == 400
@@ -1,13 +1,15 @@
 from towhee import pipe
 
+from checkpoint import Checkpoint
 from config import ES_HOST, ES_PORT, ES_INDEX, MINIO_BUCKET_NAME
 from embedding import (
     do_milvus_embedding,
     embedding_es_pipe,
     do_es_embedding,
+    insert_milvus_features,
 )
 from es_helpers import EsClient, create_img_index
-from milvus_helpers import MilvusClient
+from milvus_helpers import MilvusClient, MilvusBatchWriter
 from model import VitBase224
 from model import extract_features_ops
 from mysql_helpers import MysqlClient
@@ -48,6 +50,33 @@ def test_do_milvus_embedding():
     print(count)
 
 
+def test_incremental_embedding():
+    es_cli = EsClient(host=ES_HOST, port=ES_PORT)
+    index_name = 'test_incremental'
+    model = VitBase224()
+    first = do_es_embedding(MINIO_BUCKET_NAME, model, es_cli, index_name, 20)
+    # every image of the bucket has a primary object, the full image if nothing is detected
+    assert first == 20
+    # the images of the first run are skipped
+    second = do_es_embedding(MINIO_BUCKET_NAME, model, es_cli, index_name, 40, incremental=True)
+    print("first: ", first, "second: ", second)
+    assert second == 20
+    assert len(es_cli.scan_values(index_name, 'image_key')) == 40
+    assert do_es_embedding(MINIO_BUCKET_NAME, model, es_cli, index_name, 40, incremental=True) == 0
+    es_cli.es.indices.delete(index=index_name)
+
+
+def test_insert_milvus_features_skip(tmp_path):
+    skipped = Checkpoint('skip', str(tmp_path))
+    writer = MilvusBatchWriter(None, 'test_collection')
+    urls = ['http://localhost:10086/file/imgsch/failed.jpg', 'http://localhost:10086/file/imgsch/empty.jpg']
+    # the image failed to decode is retried, the image without objects is skipped
+    assert insert_milvus_features(urls, [None, []], None, writer, skipped) == 0
+    assert urls[0] not in skipped
+    assert urls[1] in skipped
+    assert len(writer.vectors) == 0
+
+
 def test_load():
     vit_model = VitBase224()
 
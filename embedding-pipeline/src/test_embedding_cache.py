@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, LRUCache
+
+
+def test_memory_and_disk_hit(tmp_path):
+    cache = EmbeddingCache('test_model', path=str(tmp_path), memory_size=1, disk_size_mb=1)
+    meta = {'bbox': {'box': [0, 0, 10, 10], 'label': 'cat', 'score': 0.9}, 'candidates': []}
+    vec = np.random.rand(8).astype(np.float32)
+    cache.put('a' * 32, meta, vec)
+    cache.put('b' * 32, meta, vec * 2)
+
+    # 'a' is out of the memory tier, read from disk
+    got_meta, got_vec = cache.get('a' * 32)
+    print(got_meta)
+    assert got_meta == meta
+    assert np.allclose(got_vec, vec)
+    assert cache.get('c' * 32) is None
+    cache.close()
+
+    reopened = EmbeddingCache('test_model', path=str(tmp_path), memory_size=1, disk_size_mb=1)
+    _, got_vec = reopened.get('b' * 32)
+    assert np.allclose(got_vec, vec * 2)
+    reopened.close()
+
+
+def test_disk_eviction(tmp_path):
+    dim = 128 * 1024  # 512KB per vector, 2 slots in 1MB
+    cache = EmbeddingCache('test_model', path=str(tmp_path), memory_size=0, disk_size_mb=1)
+    for key in ['a', 'b', 'c']:
+        cache.put(key * 32, {}, np.ones(dim, dtype=np.float32))
+    assert cache.get('a' * 32) is None
+    assert cache.get('b' * 32) is not None
+    assert cache.get('c' * 32) is not None
+    cache.close()
+
+
+def test_single_owner(tmp_path):
+    vec = np.random.rand(8).astype(np.float32)
+    owner = EmbeddingCache('test_model', path=str(tmp_path), memory_size=0, disk_size_mb=1)
+    owner.put('a' * 32, {}, vec)
+    owner.flush()
+
+    # a second cache of the directory only has the memory tier
+    other = EmbeddingCache('test_model', path=str(tmp_path), memory_size=1, disk_size_mb=1)
+    assert not other.writable
+    assert other.get('a' * 32) is None
+    other.put('b' * 32, {}, vec)
+    assert owner.get('b' * 32) is None
+    assert other.get('b' * 32) is not None
+    other.close()
+    owner.close()
+
+    # the lock is released on close
+    reopened = EmbeddingCache('test_model', path=str(tmp_path), memory_size=0, disk_size_mb=1)
+    assert reopened.writable
+    assert np.allclose(reopened.get('a' * 32)[1], vec)
+    reopened.close()
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # 'b' is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(2, ttl=0.05)
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None
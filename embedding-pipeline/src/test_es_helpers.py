@@ -1,7 +1,7 @@
 from towhee import pipe, ops
 
 from config import ES_HOST, ES_PORT, ES_INDEX
-from es_helpers import EsClient, knn_query_docs_ops
+from es_helpers import EsClient, EsBulkWriter, bulk_img_doc_ops, bulk_update_field_ops, knn_query_docs_ops
 from model import VitBase224
 
 
@@ -104,6 +104,37 @@ def test_insert_batch():
     print("res: ", res)
 
 
+def test_bulk_writer():
+    es_cli = EsClient(host=ES_HOST, port=ES_PORT)
+    flushed = []
+    writer = EsBulkWriter(es_cli, ES_INDEX, flush_docs=2, on_flush=flushed.extend)
+    insert_doc = bulk_img_doc_ops(writer)
+    for i in range(5):
+        key = f'bulk_writer_test_{i}'
+        img_url = f'http://localhost:10086/file/imgsch/{key}.jpg'
+        insert_doc(key, img_url, '0,0,10,10', 0.9, 'cat', [1.0] + [0.0] * 767, key)
+    # 4 documents are flushed by count, the last one by close
+    assert writer.success_count == 4
+    res = writer.close()
+    print("res: ", res, "failed: ", writer.failed)
+    assert res == 5
+    assert len(writer.failed) == 0
+    # on_flush gets the accepted documents of each flush
+    assert sorted(doc['_id'] for doc in flushed) == [f'bulk_writer_test_{i}' for i in range(5)]
+
+
+def test_bulk_update_field():
+    es_cli = EsClient(host=ES_HOST, port=ES_PORT)
+    writer = EsBulkWriter(es_cli, ES_INDEX)
+    bulk_img_doc_ops(writer)('update_test_0', 'http://localhost:10086/file/imgsch/update_test_0.jpg',
+                             '0,0,10,10', 0.9, 'cat', [1.0] + [0.0] * 767, 'update_test_0')
+    writer.close()
+    # the missing document fails, only the updated id is returned
+    updated = bulk_update_field_ops(es_cli, ES_INDEX)([('update_test_0', 'a cat'), ('update_test_missing', 'a dog')])
+    print("updated: ", updated)
+    assert updated == ['update_test_0']
+
+
 def test_create_index():
     es_cli = EsClient(host=ES_HOST, port=ES_PORT)
     index_name = 'imgsch'
@@ -64,3 +64,31 @@ def test_thumbnail_bytes():
     print("origin:", len(bs))
     bs = image_helper.thumbnail_bytes(bs, 50, 60)
     print("thumbnail:", len(bs))
+
+
+def test_load_reduced_rgb_from_bytes():
+    with open('../data/bicycle.jpg', 'rb') as f:
+        bs = f.read()
+    full = image_helper.load_rgb_from_bytes(bs)
+    rgb, scale = image_helper.load_reduced_rgb_from_bytes(bs, 64)
+    print(full.shape, rgb.shape, scale)
+    assert min(rgb.shape[:2]) >= 64
+    # decoded at a reduced DCT scale
+    assert rgb.shape[0] < full.shape[0] and rgb.shape[1] < full.shape[1]
+    assert scale > 1.0
+    assert abs(max(rgb.shape[:2]) * scale - max(full.shape[:2])) < 1e-6
+
+
+def test_load_rgb_exif_orientation():
+    from io import BytesIO
+    from PIL import Image
+
+    img = Image.new('RGB', (40, 20))
+    exif = img.getexif()
+    # rotated 90 degrees, the displayed image is 20 wide and 40 high
+    exif[0x0112] = 6
+    buf = BytesIO()
+    img.save(buf, 'JPEG', exif=exif.tobytes())
+    bs = buf.getvalue()
+    rgb, _ = image_helper.load_reduced_rgb_from_bytes(bs, 0)
+    assert image_helper.load_rgb_from_bytes(bs).shape == rgb.shape == (40, 20, 3)
@@ -0,0 +1,44 @@
+from inference_pool import InferencePool
+from model import VitTiny224
+
+
+def test_extract_primary_features():
+    pool = InferencePool(VitTiny224, workers=2, cache_enabled=False)
+    obj_feat, candidate_box = pool.extract_primary_features('../data/objects.png')
+    print(obj_feat)
+    print(candidate_box)
+    assert len(obj_feat.features) == 192
+
+    expected, _ = VitTiny224(cache_enabled=False).extract_primary_features('../data/objects.png')
+    assert obj_feat.bbox.box == expected.bbox.box
+    pool.close()
+
+
+def test_extract_features_batch():
+    pool = InferencePool(VitTiny224, workers=2, cache_enabled=False)
+    urls = ['../data/objects.png', '../data/bicycle.jpg']
+    res = pool.extract_features_batch(urls)
+    assert len(res) == len(urls)
+    for obj_features in res:
+        for obj_feat in obj_features:
+            print(obj_feat)
+            assert len(obj_feat.features) == 192
+    pool.close()
+
+
+def test_worker_exit():
+    pool = InferencePool(VitTiny224, workers=1, cache_enabled=False, task_timeout=30)
+    pid = pool.processes[0].pid
+    pool.processes[0].kill()
+    pool.processes[0].join()
+    try:
+        pool.extract_features_batch(['../data/objects.png'])
+    except RuntimeError as e:
+        # the task submitted before the respawn may have been taken by the dead worker
+        print(e)
+    # the worker is respawned and runs the later tasks
+    res = pool.extract_features_batch(['../data/objects.png'])
+    assert len(res[0]) > 0
+    assert len(pool.processes) == 1
+    assert pool.processes[0].pid != pid
+    pool.close()
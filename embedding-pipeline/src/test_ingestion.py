@@ -0,0 +1,50 @@
+import threading
+import time
+
+from ingestion import IngestionEngine
+
+
+def test_ingestion_engine():
+    embed_sizes = []
+    written = []
+    lock = threading.Lock()
+
+    def fetch(url: str) -> bytes:
+        time.sleep(0.01)
+        # failed downloads are skipped
+        return None if url.endswith('7') else url.encode()
+
+    def embed(urls: list[str], contents: list[bytes]) -> list[str]:
+        embed_sizes.append(len(urls))
+        return [content.decode().upper() for content in contents]
+
+    def write(urls: list[str], res: list[str]) -> int:
+        with lock:
+            written.extend(res)
+        return len(res)
+
+    urls = [f'url{i}' for i in range(100)]
+    engine = IngestionEngine(embed, write, batch_size=8, download_workers=4, write_workers=2,
+                             queue_size=16, fetch_fn=fetch)
+    count = engine.run(urls)
+    print("embed batch sizes: ", embed_sizes)
+    assert count == 90
+    assert sorted(written) == sorted(url.upper() for url in urls if not url.endswith('7'))
+    assert max(embed_sizes) <= 8
+
+
+def test_ingestion_engine_errors():
+    def embed(urls: list[str], contents: list[bytes]) -> list[bytes]:
+        if b'url3' in contents:
+            raise Exception('embed failed')
+        return contents
+
+    def write(urls: list[str], res: list[bytes]) -> int:
+        if b'url5' in res:
+            raise Exception('write failed')
+        return len(res)
+
+    engine = IngestionEngine(embed, write, batch_size=1, download_workers=2, write_workers=1,
+                             fetch_fn=lambda url: url.encode())
+    assert engine.run([f'url{i}' for i in range(10)]) == 8
+    assert engine.run([]) == 0
@@ -0,0 +1,81 @@
+import numpy as np
+
+from local_helpers import LocalIndexClient, insert_img_doc_ops, knn_query_docs_ops, rerank_docs_ops
+
+
+def _random_vecs(n: int, dim: int) -> np.ndarray:
+    vecs = np.random.randn(n, dim).astype(np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+def test_insert_and_query(tmp_path):
+    local_cli = LocalIndexClient(str(tmp_path), dtype='float16')
+    assert local_cli.create_index('test_index', 64)
+    vecs = _random_vecs(100, 64)
+    docs = [{'_id': f'key{i}', '_source': {'image_key': f'key{i}', 'image_url': f'url{i}', 'bbox': '0,0,1,1',
+                                          'bbox_score': 0.9, 'label': 'cat', 'features': vec}}
+            for i, vec in enumerate(vecs)]
+    assert local_cli.insert_batch('test_index', docs) == 100
+
+    res = knn_query_docs_ops(local_cli, 'test_index')(vecs[7], 5)
+    print("result: ", res)
+    assert len(res) == 5
+    assert res[0][0] == 'key7'
+    assert res[0][5] > 0.99
+
+    # reopen from disk, the document inserted again supersedes the old one
+    local_cli = LocalIndexClient(str(tmp_path), dtype='float16')
+    assert local_cli.count('test_index') == 100
+    assert local_cli.ids('test_index') == set(f'key{i}' for i in range(100))
+    insert_img_doc_ops(local_cli, 'test_index')('key7', 'url7-new', '0,0,1,1', 0.9, 'cat', vecs[7], 'key7')
+    res = knn_query_docs_ops(local_cli, 'test_index')(vecs[7], 5)
+    assert res[0][1] == 'url7-new'
+    assert all(image_url != 'url7' for _, image_url, _, _, _, _ in res)
+
+
+def test_ivf_index(tmp_path):
+    local_cli = LocalIndexClient(str(tmp_path))
+    local_cli.create_index('test_index', 32)
+    vecs = _random_vecs(2000, 32)
+    local_cli.insert_batch('test_index', [{'_id': str(i), '_source': {'image_key': str(i), 'features': vec}}
+                                          for i, vec in enumerate(vecs)])
+    assert local_cli.build_index('test_index', 16) == 16
+
+    # vectors inserted after the build are found in the tail lists
+    extra = _random_vecs(10, 32)
+    local_cli.insert_batch('test_index', [{'_id': f'extra{i}', '_source': {'image_key': f'extra{i}', 'features': vec}}
+                                          for i, vec in enumerate(extra)])
+    for i in range(10):
+        res = local_cli.query('test_index', extra[i], 1, nprobe=16)
+        assert res[0][0]['image_key'] == f'extra{i}'
+
+    hits = 0
+    for i in range(0, 2000, 100):
+        res = local_cli.query('test_index', vecs[i], 1, nprobe=4)
+        hits += res[0][0]['image_key'] == str(i)
+    print("recall@1 of nprobe 4: ", hits / 20)
+    assert hits >= 15
+
+
+def test_rerank(tmp_path):
+    local_cli = LocalIndexClient(str(tmp_path))
+    local_cli.create_index('test_index', 32)
+    vecs = _random_vecs(50, 32)
+    local_cli.insert_batch('test_index', [{'_id': f'key{i}', '_source': {'image_key': f'key{i}', 'features': vec}}
+                                          for i, vec in enumerate(vecs)])
+
+    # candidates of an approximate first pass in the wrong order, one without stored vector
+    candidates = [(f'key{i}', f'url{i}', '0,0,1,1', 0.9, 'cat', 0.7) for i in range(10)]
+    candidates.append(('unknown', 'url', '0,0,1,1', 0.9, 'cat', 0.8))
+    res = rerank_docs_ops(local_cli, 'test_index')(vecs[3], candidates, 5)
+    print("rerank: ", res)
+    assert len(res) == 5
+    assert res[0][0] == 'key3'
+    assert abs(res[0][5] - 1.0) < 1e-4
+    assert all(a[5] >= b[5] for a, b in zip(res, res[1:]))
+
+    # the candidate without stored vector ranks after all the rescored ones, whatever its first pass score
+    candidates = [('key3', 'url3', '0,0,1,1', 0.9, 'cat', 0.7), ('unknown', 'url', '0,0,1,1', 0.9, 'cat', 0.99),
+                  ('key4', 'url4', '0,0,1,1', 0.9, 'cat', 0.7)]
+    res = rerank_docs_ops(local_cli, 'test_index')(vecs[3], candidates, 3)
+    assert [record[0] for record in res] == ['key3', 'key4', 'unknown']
@@ -1,5 +1,5 @@
 from config import DEFAULT_TABLE
-from milvus_helpers import MilvusClient, search_milvus_ops
+from milvus_helpers import MilvusClient, MilvusBatchWriter, search_milvus_ops, search_milvus_batch_ops
 from model import VitTiny224, VitBase224
 
 milvus_cli = MilvusClient()
@@ -22,6 +22,7 @@ def test_insert():
 
     vec_id = milvus_cli.insert(table_name, obj_feat.features)
     print('insert vec id:', vec_id)
+    milvus_cli.load_collection(table_name)
     res = milvus_cli.search_vectors(table_name, obj_feat.features, top_k)
     # print('search res:', res)
     # take all ids and distances from results
@@ -32,6 +33,44 @@ def test_insert():
         print('distance:', item[0].distance)
 
 
+def test_batch_writer():
+    table_name = "test_collection"
+    dim = 8
+    milvus_cli.create_collection(table_name, dim, index=False)
+
+    rows = []
+    writer = MilvusBatchWriter(milvus_cli, table_name, lambda ids, metas: rows.extend(zip(ids, metas)), batch_size=4)
+    for i in range(10):
+        vec = [0.0] * dim
+        vec[i % dim] = 1.0
+        writer.add(vec, f'meta{i}')
+    # 2 full batches are inserted, the rest by close
+    assert len(rows) == 8
+    assert writer.close(index=True) == 10
+    assert [meta for _, meta in rows] == [f'meta{i}' for i in range(10)]
+    assert milvus_cli.count(table_name) == 10
+
+    res = milvus_cli.search_vectors(table_name, [1.0] + [0.0] * (dim - 1), 2)
+    print('search res:', res)
+    assert res[0][0].id in [vec_id for vec_id, meta in rows if meta in ('meta0', 'meta8')]
+
+
+def test_batch_writer_on_flush_error():
+    table_name = "test_collection"
+    dim = 8
+    milvus_cli.create_collection(table_name, dim, index=False)
+
+    def on_flush(ids, metas):
+        raise RuntimeError('mysql is down')
+
+    writer = MilvusBatchWriter(milvus_cli, table_name, on_flush, batch_size=4)
+    for i in range(4):
+        writer.add([1.0] + [0.0] * (dim - 1), f'meta{i}')
+    # the vectors without metadata are counted as failed
+    assert writer.success_count == 0
+    assert writer.failed_count == 4
+
+
 def test_search_vectors():
     vit_model = VitTiny224()
     obj_feat, candidate_box = vit_model.extract_primary_features('../data/test.jpg')
@@ -59,3 +98,13 @@ def test_search_milvus_ops():
     for i in range(res.size):
         it = res.get()
         print(f'{i}, search_res: {it[0]}, distance: {it[1]}')
+
+
+def test_search_milvus_batch_ops():
+    table_name = 'test_collection'
+    vit_model = VitTiny224()
+    vecs = [obj_feat.features.tolist() for obj_feat in vit_model.extract_features('../data/objects.png')]
+    res = search_milvus_batch_ops(milvus_cli, table_name, 5)(vecs)
+    assert len(res) == len(vecs)
+    for i, hits in enumerate(res):
+        print(f'{i}, hits: {hits}')
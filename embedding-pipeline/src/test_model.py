@@ -1,12 +1,17 @@
 import numpy as np
 
 import image_helper
+from embedding_cache import LRUCache
 from model import (
     Resnet50,
     VitTiny224,
     VitBase224,
+    ClipcapCoco,
     ExpansionNet,
     ClipVitBasePatch16,
+    MultiHeadFeatureModel,
+    BoundingBox,
+    _select_bboxes,
 )
 
 
@@ -59,6 +64,91 @@ def test_vitBase224_url_extract_primary_features():
     assert len(obj_feat.features) == 768
 
 
+def test_vitBase224_bytes_extract_primary_features():
+    model = VitBase224()
+    with open('../data/objects.png', 'rb') as f:
+        content = f.read()
+    obj_feat, candidate_box = model.extract_primary_features('../data/objects.png', content)
+    print(obj_feat)
+    print(candidate_box)
+    assert len(obj_feat.features) == 768
+
+    img = model.decode(content)
+    img_feat, _ = model.extract_primary_features_image(img, '../data/objects.png')
+    assert img_feat.bbox.box == obj_feat.bbox.box
+
+
+def test_vitBase224_extract_box_features():
+    model = VitBase224(cache_enabled=True)
+    content = image_helper.read_bytes('../data/objects.png')
+    key = image_helper.md5_content(content)
+    obj_feat, candidate_box = model.extract_primary_features('../data/objects.png', content, key)
+    assert model.image_cache.get(key) is not None
+
+    # an embedding cache hit keeps the search image too
+    model.image_cache = LRUCache(8)
+    model.extract_primary_features('../data/objects.png', content, key)
+    assert model.image_cache.get(key) is not None
+
+    box_feat = model.extract_box_features('../data/objects.png', obj_feat.bbox.box, key)
+    print(box_feat.bbox)
+    assert box_feat.bbox.label == obj_feat.bbox.label
+    assert np.dot(box_feat.features, obj_feat.features) > 0.99
+
+    try:
+        model.extract_box_features('../data/objects.png', (100000, 100000, 100010, 100010), key)
+        assert False, 'a box outside the image should be rejected'
+    except ValueError as e:
+        print(e)
+    model.close()
+
+
+def test_vit224_extract_features_batch():
+    model = VitTiny224()
+    urls = ['../data/objects.png', '../data/bicycle.jpg']
+    res = model.extract_features_batch(urls, batch_size=4)
+    assert len(res) == len(urls)
+    for obj_features in res:
+        for obj_feat in obj_features:
+            print(obj_feat)
+            assert len(obj_feat.features) == 192
+
+
+def test_vitBase224_extract_primary_features_batch():
+    model = VitBase224()
+    urls = ['../data/objects.png', '../data/bicycle.jpg']
+    res = model.extract_primary_features_batch(urls)
+    assert len(res) == len(urls)
+    for obj_feat, candidate_box in res:
+        print(obj_feat)
+        print(candidate_box)
+        assert len(obj_feat.features) == 768
+
+
+def test_multi_head_extract_features():
+    model = MultiHeadFeatureModel(['vit_tiny_patch16_224', 'vit_base_patch16_224'])
+    obj_features = model.extract_features('../data/objects.png')
+    for obj_feat in obj_features:
+        print(obj_feat.bbox)
+        assert len(obj_feat.features['vit_tiny_patch16_224']) == 192
+        assert len(obj_feat.features['vit_base_patch16_224']) == 768
+
+
+def test_select_bboxes():
+    small = BoundingBox(box=(0, 0, 10, 10), label='cat', score=0.9)
+    large = BoundingBox(box=(0, 0, 100, 100), label='dog', score=0.6)
+    medium = BoundingBox(box=(0, 0, 50, 50), label='car', score=0.8)
+    bboxes = [large, small, medium]
+
+    assert _select_bboxes(bboxes, 0, 'score') == [small, medium, large]
+    assert _select_bboxes(bboxes, 0, 'area') == [large, medium, small]
+    # the top max_objects are kept
+    assert _select_bboxes(bboxes, 2, 'score') == [small, medium]
+    assert _select_bboxes(bboxes, 1, 'area') == [large]
+    assert _select_bboxes(bboxes, 5, 'score') == [small, medium, large]
+    assert _select_bboxes([], 2, 'score') == []
+
+
 def test_width_height():
     w, h = image_helper.get_image_dimensions('../data/objects.png')
     print(f'w: {w}, h: {h}')
@@ -92,6 +182,15 @@ def test_generate_caption():
     print(caption)
 
 
+def test_generate_captions():
+    caption_model = ClipcapCoco()
+    captions = caption_model.generate_captions(['../data/bicycle.jpg', '../data/objects.png', 'not-exists.jpg'])
+    print(captions)
+    assert len(captions) == 3
+    assert len(captions[0]) > 0
+    assert captions[2] == ''
+
+
 def test_imagetext_model():
     imagetext_model = ClipVitBasePatch16()
     img_url = '../data/bicycle.jpg'
@@ -107,3 +206,52 @@ def test_imagetext_model():
     dp = np.dot(img_arr, txt_arr)
 
     print(f'cos_sim: {dp}')
+
+
+def test_imagetext_text_embeddings_batch():
+    imagetext_model = ClipVitBasePatch16()
+    texts = ['a man rides a bicycle', 'a cat', 'a man rides a bicycle']
+    vecs = imagetext_model.generate_text_embeddings(texts)
+    assert len(vecs) == 3
+    assert np.allclose(vecs[0], vecs[2])
+    assert np.isclose(np.linalg.norm(vecs[1]), 1.0, atol=1e-4)
+    # served from the text cache
+    assert imagetext_model.generate_text_embeddings(['a cat'])[0] is vecs[1]
+
+
+def test_imagetext_image_embeddings_batch():
+    imagetext_model = ClipVitBasePatch16()
+    urls = ['../data/bicycle.jpg', '../data/not-exist.jpg', '../data/objects.png']
+    vecs = imagetext_model.generate_image_embeddings(urls)
+    assert len(vecs) == 3
+    assert vecs[1] is None
+    # the same vector as the single image pipeline
+    expected = np.asarray(imagetext_model.generate_image_embedding(urls[0]))
+    assert np.dot(vecs[0], expected) > 0.99
+
+
+def test_onnx_extract_primary_features():
+    model = VitBase224(backend='onnx')
+    obj_feat, candidate_box = model.extract_primary_features('../data/objects.png')
+    print(obj_feat)
+    print(candidate_box)
+    assert len(obj_feat.features) == 768
+
+
+def test_onnx_parity_report():
+    import onnx_backend
+
+    report = onnx_backend.parity_report('vit_base_patch16_224', ['../data/objects.png', '../data/bicycle.jpg'])
+    print(report)
+    assert report['count'] == 2
+    assert report['min'] > 0.99
+
+
+def test_onnx_detection_parity_report():
+    import onnx_backend
+
+    report = onnx_backend.detection_parity_report(['../data/objects.png', '../data/bicycle.jpg'])
+    print(report)
+    assert report['count'] == 2
+    assert report['torch_boxes'] > 0
+    assert report['recall'] >= 0.8
@@ -1,4 +1,4 @@
-from mysql_helpers import MysqlClient, query_mysql_ops
+from mysql_helpers import MysqlClient, query_mysql_ops, insert_mysql_batch_ops
 
 MYSQL_CLIENT = MysqlClient()
 
@@ -16,6 +16,22 @@ def test_query_mysql_ops():
     print(detail)
 
 
+def test_insert_batch():
+    table_name = 'test_bulk_tab'
+    MYSQL_CLIENT.create_table(table_name)
+    rows = [(i, f'img{i}', '0,0,10,10', 0.9, 'cat') for i in range(1, 4)]
+    assert insert_mysql_batch_ops(MYSQL_CLIENT, table_name)(rows) == 3
+    # an existing (image_key, box) is skipped
+    assert MYSQL_CLIENT.insert_batch([(10, 'img1', '0,0,10,10', 0.9, 'cat')], table_name) == 0
+
+    # tab and newline in the fields are escaped in the tsv
+    rows = [(i, f'img{i}', '0,0,10,10', 0.5, 'tab\tnew\nline') for i in range(4, 8)]
+    assert insert_mysql_batch_ops(MYSQL_CLIENT, table_name, load_data_rows=2)(rows) == 4
+    assert MYSQL_CLIENT.count_table(table_name) == 7
+    assert MYSQL_CLIENT.records_by_ids([5], table_name)[0][4] == 'tab\tnew\nline'
+    MYSQL_CLIENT.drop_table(table_name)
+
+
 def test_scan_table():
     res = MYSQL_CLIENT.scan_table()
     print("res:", len(res))
@@ -0,0 +1,22 @@
+import numpy as np
+
+from projection import fit_pca, save_projection, load_projection, project
+
+
+def test_fit_and_project(tmp_path):
+    # samples in a 16-dim subspace of 768 dims
+    basis = np.random.randn(16, 768)
+    vecs = np.random.randn(256, 16) @ basis
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+
+    matrix = fit_pca(list(vecs), 32)
+    assert matrix.shape == (769, 32)
+    save_projection('test_model', matrix, str(tmp_path))
+    loaded = load_projection('test_model', str(tmp_path), enabled=True)
+    assert np.allclose(loaded, matrix)
+    assert load_projection('test_model', str(tmp_path), enabled=False) is None
+
+    projected = np.stack(project(list(vecs[:8]), loaded))
+    assert projected.shape == (8, 32)
+    assert np.allclose(np.linalg.norm(projected, axis=1), 1.0, atol=1e-5)
+    print(projected @ projected.T)
@@ -7,7 +7,7 @@ from config import (
 from milvus_helpers import MilvusClient
 from model import VitBase224
 from mysql_helpers import MysqlClient
-from search import EsClient, do_es_search
+from search import EsClient, do_es_search, do_es_multi_search
 from search import do_milvus_search
 
 
@@ -45,3 +45,12 @@ def test_do_es_search():
     print(obj_feat)
     print(candidates)
     print(res)
+
+
+def test_do_es_multi_search():
+    es_cli = EsClient(host=ES_HOST, port=ES_PORT)
+    vit_model = VitBase224()
+    res = do_es_multi_search('../data/objects.png', vit_model, es_cli, ES_INDEX)
+    assert len(res) > 0
+    for obj_feat, res_list in res:
+        print(obj_feat.bbox, [str(item) for item in res_list])
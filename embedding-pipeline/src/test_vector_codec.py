@@ -0,0 +1,33 @@
+import numpy as np
+
+from vector_codec import VectorCodec, load_scale, vector_json
+
+
+def test_int8_round_trip(tmp_path):
+    vecs = np.random.randn(16, 768).astype(np.float32)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    codec = VectorCodec('test_model', vector_type='int8', path=str(tmp_path))
+    scale = codec.fit(list(vecs))
+    print("scale: ", scale)
+    assert load_scale('test_model', str(tmp_path)) == scale
+
+    for vec in vecs:
+        encoded = codec.encode(vec)
+        assert encoded.dtype == np.int8
+        assert all(isinstance(x, int) for x in vector_json(encoded))
+        decoded = codec.decode(encoded)
+        cos = np.dot(vec, decoded) / np.linalg.norm(decoded)
+        assert cos > 0.99
+
+
+def test_float16_and_float32(tmp_path):
+    vec = np.random.randn(768).astype(np.float32)
+    vec /= np.linalg.norm(vec)
+
+    half = VectorCodec('test_model', vector_type='float16', path=str(tmp_path)).encode(vec)
+    assert half.dtype == np.float16
+    assert np.allclose(vector_json(half), vec, atol=1e-3)
+
+    full = VectorCodec('test_model', vector_type='float32', path=str(tmp_path)).encode(vec)
+    assert full.dtype == np.float32
+    assert len(vector_json(full)) == 768
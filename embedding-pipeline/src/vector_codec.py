@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+
+from config import VECTOR_TYPE, VECTOR_SCALE_PATH
+from logger import LOGGER
+
+VECTOR_TYPES = ('float32', 'float16', 'int8')
+
+
+class VectorCodec(object):
+    """
+    Compact representation of normalized embedding vectors, vectors are numpy arrays of
+    float32, float16 or int8, int8 values are round(vec * scale) with a per-model scale,
+    so that they map to es byte vectors.
+    """
+
+    def __init__(self, model_name: str, vector_type: str = VECTOR_TYPE,
+                 scale: float = None, path: str = VECTOR_SCALE_PATH):
+        """
+        :param model_name: model name, the int8 scale is saved per model
+        :param vector_type: float32, float16 or int8
+        :param scale: int8 scale, loaded from path if not given
+        :param path: directory of the saved int8 scales
+        """
+        if vector_type not in VECTOR_TYPES:
+            raise ValueError(f"Unknown vector type {vector_type}, expect one of {VECTOR_TYPES}")
+        self.model_name = model_name
+        self.vector_type = vector_type
+        self.path = path
+        self.scale = scale if scale is not None else load_scale(model_name, path)
+
+    def encode(self, vec) -> np.ndarray:
+        """
+        Encode a float vector
+        :param vec: normalized float vector
+        :return: vector of the codec type
+        """
+        vec = np.asarray(vec, dtype=np.float32)
+        if self.vector_type == 'int8':
+            return np.clip(np.rint(vec * self.scale), -128, 127).astype(np.int8)
+        if self.vector_type == 'float16':
+            return vec.astype(np.float16)
+        return vec
+
+    def decode(self, vec) -> np.ndarray:
+        """
+        Decode a vector of the codec type
+        :param vec: encoded vector
+        :return: float32 vector
+        """
+        if self.vector_type == 'int8':
+            return np.asarray(vec, dtype=np.float32) / self.scale
+        return np.asarray(vec, dtype=np.float32)
+
+    def fit(self, vecs: list[np.ndarray], percentile: float = 99.9) -> float:
+        """
+        Fit the int8 scale to sample vectors of the model and save it,
+        values beyond the percentile of absolute values are clipped
+        :param vecs: normalized sample vectors
+        :param percentile: percentile of absolute values mapped to 127
+        :return: int8 scale
+        """
+        if len(vecs) == 0:
+            return self.scale
+        max_abs = float(np.percentile(np.abs(np.stack(vecs)), percentile))
+        if max_abs > 0:
+            self.scale = 127.0 / max_abs
+            save_scale(self.model_name, self.scale, self.path)
+        LOGGER.info(f"Fit int8 scale of {self.model_name}: {self.scale}, samples: {len(vecs)}")
+        return self.scale
+
+
+def load_scale(model_name: str, path: str = VECTOR_SCALE_PATH) -> float:
+    """
+    Load the int8 scale of the model
+    :param model_name: model name
+    :param path: directory of the saved scales
+    :return: scale, 127.0 if not fitted, the full range of normalized vectors
+    """
+    scale_path = os.path.join(path, f'{model_name}.json')
+    if not os.path.exists(scale_path):
+        return 127.0
+    with open(scale_path) as f:
+        return float(json.load(f)['scale'])
+
+
+def save_scale(model_name: str, scale: float, path: str = VECTOR_SCALE_PATH):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f'{model_name}.json'), 'w') as f:
+        json.dump({'model_name': model_name, 'scale': scale}, f)
+
+
+def vector_json(vec) -> list:
+    """
+    Json-able vector for es documents and queries
+    :param vec: float list or encoded numpy array
+    :return: int list of int8 vectors, float list otherwise, float16 values are rounded to 4 decimals
+    """
+    if not isinstance(vec, np.ndarray):
+        return vec
+    if vec.dtype == np.float16:
+        # short json of the half precision values
+        return np.round(vec.astype(np.float64), 4).tolist()
+    return vec.tolist()
+
+
+def es_element_type(vector_type: str = VECTOR_TYPE) -> str:
+    """
+    Element type of es dense_vector, es has no half precision type, float16 vectors are stored as float
+    :param vector_type: float32, float16 or int8
+    :return: byte or float
+    """
+    return 'byte' if vector_type == 'int8' else 'float'